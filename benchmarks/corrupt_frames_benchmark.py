@@ -0,0 +1,78 @@
+import os
+import time
+import argparse
+import tempfile
+import isx
+import multiprocessing
+import numpy as np
+from functools import partial
+from src.backend import RemoveCorruptFrames as rcf
+from src.backend.isxd import IsxdMovie
+from src.workutils.StartMethod import START_METHOD
+from benchmarks.synthetic import write_synthetic_movie
+
+# benchmark of the per-frame, batched and sidecar corrupt-frame scanners on a synthetic movie
+# run from the repository root: python -m benchmarks.corrupt_frames_benchmark
+
+def time_scan(scan, *args, **kwargs):
+    start = time.perf_counter()
+    result = scan(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the per-frame and batched corrupt-frame scanners')
+    parser.add_argument('--frames', type=int, default=1000)
+    parser.add_argument('--height', type=int, default=rcf.DEFAULT_ROI[0][1])
+    parser.add_argument('--width', type=int, default=rcf.DEFAULT_ROI[1][1] + 12)
+    parser.add_argument('--block-size', type=int, default=rcf.BLOCK_SIZE)
+    parser.add_argument('--chunk-size', type=int, default=rcf.CHUNK_SIZE)
+    parser.add_argument('--processes', type=int, default=rcf.NUM_PROCESSES)
+    parser.add_argument('--prefetch-depth', type=int, default=rcf.PREFETCH_DEPTH)
+    args = parser.parse_args()
+
+    black_segments = [[10, 14], [args.frames // 2, args.frames // 2 + 40]]
+    white_segments = [[args.frames - 5, args.frames - 1]]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'synthetic.isxd')
+        segments = [(first, last, 'black') for first, last in black_segments] + \
+                   [(first, last, 'white') for first, last in white_segments]
+        write_synthetic_movie(file_path, args.frames, args.height, args.width, segments=segments,
+                              band=[[args.height // 4, args.height], rcf.DEFAULT_ROI[1]])
+        movie = isx.Movie.read(file_path)
+        threshold, threshold_2 = rcf.get_thresholds(movie, test_n=30, padding_fraction=0.001)
+        frame_mask, frame_time = time_scan(rcf.scan_frames, movie, threshold, threshold_2, file_name='frame')
+        frame_segments = rcf.corrupt_segments(frame_mask)
+        (black, white), block_time = time_scan(rcf.scan_blocks, movie, block_size=args.block_size)
+        block_segments = rcf.corrupt_segments((black > threshold) | (white > threshold_2))
+        with IsxdMovie(file_path) as native_movie:
+            (black, white), inline_time = time_scan(rcf.scan_blocks, native_movie, block_size=args.block_size,
+                                                    prefetch_depth=0)
+            timings = {}
+            (black, white), native_time = time_scan(rcf.scan_blocks, native_movie, block_size=args.block_size,
+                                                    prefetch_depth=args.prefetch_depth, timings=timings)
+        native_segments = rcf.corrupt_segments((black > threshold) | (white > threshold_2))
+        with multiprocessing.get_context(START_METHOD).Pool(processes=args.processes) as pool:
+            (black, white), parallel_time = time_scan(rcf.compute_frame_statistics, file_path, movie, block_size=args.block_size,
+                                                      pool=pool, chunk_size=args.chunk_size)
+        parallel_segments = rcf.corrupt_segments((black > threshold) | (white > threshold_2))
+        # first call builds the statistics sidecar, the second one only re-thresholds it
+        rcf.find_corrupt_segments(file_path, block_size=args.block_size, thresholds=(threshold, threshold_2))
+        sidecar_segments, sidecar_time = time_scan(rcf.find_corrupt_segments, file_path, thresholds=(threshold, threshold_2))
+        del movie
+
+    expected = sorted(black_segments + white_segments)
+    print(f'expected segments: {expected}')
+    print(f'frame mode: {frame_segments}  {args.frames / frame_time:.0f} frames/s')
+    print(f'block mode: {block_segments}  {args.frames / block_time:.0f} frames/s')
+    print(f'block mode, native reader without read-ahead: {args.frames / inline_time:.0f} frames/s')
+    print(f'block mode, native reader: {native_segments}  {args.frames / native_time:.0f} frames/s  '
+          f'(I/O stalls {timings["io_wait_seconds"]:.3f} s, compute {timings["compute_seconds"]:.3f} s)')
+    print(f'block mode, {args.processes} processes: {parallel_segments}  {args.frames / parallel_time:.0f} frames/s')
+    print(f're-thresholding from the sidecar: {sidecar_segments}  {sidecar_time * 1000:.1f} ms')
+    print(f'speedup: {frame_time / block_time:.1f}x (block), {frame_time / native_time:.1f}x (native reader), '
+          f'{frame_time / parallel_time:.1f}x (parallel)')
+    if not (frame_segments == block_segments == native_segments == parallel_segments == sidecar_segments):
+        raise SystemExit('the scanners found different segments')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import time
+import argparse
+import queue
+import tempfile
+import traceback
+import multiprocessing
+from src.backend import RemoveCorruptFrames as rcf
+from src.backend.isxd import trim_isxd
+from src.workutils.StartMethod import START_METHOD
+from benchmarks.synthetic import write_synthetic_movie, random_segments
+
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# throughput suite of the dropped-frame path on a synthetic movie with injected corrupt segments
+# every scan mode / worker count runs in a fresh process so its peak RSS is its own, and the segments it finds are
+# checked against the injected ground truth
+# run from the repository root: python -m benchmarks.dropped_frames_suite --frames 5000 --workers 1 4
+
+# 'frame' needs the isx API, 'trim' is the whole DropFrames path (block scan then trimming the movie)
+MODES = ('frame', 'block', 'coarse', 'trim')
+
+# peak resident memory of this process and of its largest child process in MB, None where it cannot be measured
+def peak_rss_mb():
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+        return round(own, 1), round(children, 1) if children else None
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return round(getattr(info, 'peak_wset', info.rss) / (1024 * 1024), 1), None
+    return None, None
+
+# one benchmark case, run in its own process, the result (or the error it raised) is put on results
+def run_case(results, *args):
+    try:
+        results.put(measure_case(*args))
+    except Exception as e:
+        results.put({'error': f'{type(e).__name__}: {e}', 'traceback': traceback.format_exc()})
+
+def measure_case(file_path, scan_mode, workers, roi, block_size, prefetch_depth):
+    pool = multiprocessing.get_context(START_METHOD).Pool(processes=workers) if workers > 1 else None
+    try:
+        start = time.perf_counter()
+        report = rcf.detect_corrupt_frames(file_path, scan_mode='block' if scan_mode == 'trim' else scan_mode,
+                                           block_size=block_size, pool=pool, use_sidecar=False, roi=roi,
+                                           prefetch_depth=prefetch_depth)
+        if scan_mode == 'trim' and report is not None and report['segments']:
+            output_path = file_path.replace('.isxd', '_processed.isxd')
+            trim_isxd(file_path, output_path, report['segments'])
+            os.remove(output_path)
+        seconds = time.perf_counter() - start
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    rss, workers_rss = peak_rss_mb()
+    return {'segments': None if report is None else report['segments'], 'seconds': seconds,
+            'prefetch': None if report is None else report.get('prefetch'),
+            'peak_rss_mb': rss, 'workers_peak_rss_mb': workers_rss}
+
+# result of a case, waiting for it as long as its process is alive (a crash or a kill never puts anything on results)
+def wait_for_result(process, results, poll_seconds=1.0):
+    while True:
+        try:
+            return results.get(timeout=poll_seconds)
+        except queue.Empty:
+            if not process.is_alive():
+                # the result may have been put right before the process exited
+                try:
+                    return results.get(timeout=poll_seconds)
+                except queue.Empty:
+                    return {'error': f'the benchmark process exited with code {process.exitcode}'}
+
+# result of a case, with an 'error' entry instead of the measures when it failed
+def benchmark(file_path, movie, scan_mode, workers, roi, block_size, prefetch_depth):
+    context = multiprocessing.get_context(START_METHOD)
+    results = context.Queue()
+    process = context.Process(target=run_case, args=(results, file_path, scan_mode, workers, roi, block_size,
+                                                     prefetch_depth))
+    process.start()
+    result = wait_for_result(process, results)
+    process.join()
+    if 'error' in result:
+        result.update({'mode': scan_mode, 'workers': workers, 'matches_ground_truth': False})
+        return result
+    num_frames = movie.shape[0]
+    movie_mb = movie.shape[0] * movie.shape[1] * movie.shape[2] * movie.dtype.itemsize / (1024 * 1024)
+    result.update({'mode': scan_mode, 'workers': workers,
+                   'frames_per_second': round(num_frames / result['seconds'], 1),
+                   'mb_per_second': round(movie_mb / result['seconds'], 1),
+                   'matches_ground_truth': result['segments'] == movie.ground_truth()})
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput of the corrupt frame scanners on a synthetic movie')
+    parser.add_argument('--frames', type=int, default=2000)
+    parser.add_argument('--height', type=int, default=rcf.SENSOR_SHAPE[0])
+    parser.add_argument('--width', type=int, default=rcf.SENSOR_SHAPE[1])
+    parser.add_argument('--segments', type=int, default=10, help='number of injected corrupt runs')
+    parser.add_argument('--max-length', type=int, default=40, help='longest injected run, in frames')
+    parser.add_argument('--modes', nargs='+', default=['block', 'coarse', 'trim'], choices=MODES)
+    parser.add_argument('--workers', nargs='+', type=int, default=sorted({1, rcf.NUM_PROCESSES}),
+                        help='worker counts of the block and trim modes')
+    parser.add_argument('--block-size', type=int, default=rcf.BLOCK_SIZE)
+    parser.add_argument('--prefetch-depth', type=int, default=rcf.PREFETCH_DEPTH)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    segments = random_segments(args.frames, args.segments, max_length=args.max_length, seed=args.seed)
+    roi = rcf.scaled_roi((args.height, args.width))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'synthetic.isxd')
+        movie = write_synthetic_movie(file_path, args.frames, args.height, args.width, segments=segments,
+                                      seed=args.seed)
+        print(f'{args.frames} frames of {args.height}x{args.width}, injected segments: {movie.ground_truth()}')
+        for scan_mode in args.modes:
+            for workers in (args.workers if scan_mode in ('block', 'trim') else [1]):
+                result = benchmark(file_path, movie, scan_mode, workers, roi, args.block_size, args.prefetch_depth)
+                results.append(result)
+                if 'error' in result:
+                    print(f"{scan_mode:>6} {workers:>3} workers: FAILED {result['error']}")
+                    print(result.get('traceback', ''))
+                    continue
+                print(f"{scan_mode:>6} {workers:>3} workers: {result['frames_per_second']:>9} frames/s "
+                      f"{result['mb_per_second']:>8} MB/s  peak RSS {result['peak_rss_mb']} MB "
+                      f"(workers {result['workers_peak_rss_mb']} MB)  "
+                      f"{'ok' if result['matches_ground_truth'] else 'MISMATCH ' + str(result['segments'])}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'frames': args.frames, 'height': args.height, 'width': args.width, 'segments': segments,
+                       'results': results}, f, indent=4)
+    failed = [f"{result['mode']} ({result['workers']} workers)" for result in results if 'error' in result]
+    if failed:
+        raise SystemExit(f'some benchmark cases failed: {", ".join(failed)}')
+    if not all(result['matches_ground_truth'] for result in results):
+        raise SystemExit('some scanners did not find the injected segments')
+
+if __name__ == '__main__':
+    main()
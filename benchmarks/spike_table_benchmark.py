@@ -0,0 +1,85 @@
+import os
+import time
+import argparse
+import tempfile
+import pandas as pd
+from src.backend.spiketable import SpikeTable, wide_to_long, vertical_alignment, cell_names, load_spike_table, \
+    write_spikes, resolve_formats, spike_path, LONG_COLUMNS, STREAM_CHUNK_ROWS
+from benchmarks.synthetic import synthetic_spike_table, write_synthetic_spike_csv
+
+# benchmark of the wide to long spike table conversion of Timeseries.vertical_csv_alignment
+# run from the repository root: python -m benchmarks.spike_table_benchmark [--frames 100000 --cells 400]
+# the row by row conversion takes hours at full size, it only runs on the first --loop-frames frames and its time is
+# extrapolated, both conversions must give the same table on these frames
+
+# conversion used before spiketable.wide_to_long, two pandas lookups per cell of every row
+def loop_wide_to_long(df):
+    data = []
+    for row in range(2, len(df)):
+        at_time = df.loc[row]
+        row_len = at_time.size
+        for col in range(1, row_len):
+            if at_time.iloc[col] > 0:
+                if df.loc[row]['Time (s)'] != 0:
+                    new_row = [df.loc[row]['Time (s)'], df.columns[col], df.loc[row].iloc[col]]
+                    data.append(new_row)
+    return pd.DataFrame(data, columns=LONG_COLUMNS).sort_values(by=[LONG_COLUMNS[1], LONG_COLUMNS[0]])
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the row by row and vectorized spike table conversions')
+    parser.add_argument('--frames', type=int, default=100000)
+    parser.add_argument('--cells', type=int, default=400)
+    parser.add_argument('--event-rate', type=float, default=0.01)
+    parser.add_argument('--loop-frames', type=int, default=500)
+    parser.add_argument('--chunk-rows', type=int, default=STREAM_CHUNK_ROWS)
+    args = parser.parse_args()
+
+    sample = synthetic_spike_table(args.loop_frames, args.cells, event_rate=args.event_rate)
+    loop_df, loop_time = timed(loop_wide_to_long, sample)
+    vector_df, _ = timed(wide_to_long, sample)
+    if loop_df.to_csv(index=False) != vector_df.to_csv(index=False):
+        raise SystemExit('the conversions give different tables')
+    loop_estimate = loop_time * args.frames / args.loop_frames
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_csv = os.path.join(tmp_dir, 'spike-events.csv')
+        output_csv = os.path.join(tmp_dir, 'spike-events-aligned.csv')
+        table, write_time = timed(write_synthetic_spike_csv, input_csv, args.frames, args.cells, args.event_rate)
+        spikes, convert_time = timed(lambda: SpikeTable.from_wide(table).sorted())
+        long_df = spikes.to_frame()
+        _, csv_time = timed(lambda: vertical_alignment(input_csv, output_csv, chunk_rows=0))
+        with open(output_csv) as f:
+            in_memory = f.read()
+        _, stream_time = timed(lambda: vertical_alignment(input_csv, output_csv, chunk_rows=args.chunk_rows))
+        with open(output_csv) as f:
+            if f.read() != in_memory:
+                raise SystemExit('the streaming conversion gives a different CSV')
+        size = os.path.getsize(input_csv)
+        # reloading a day of spikes from each of its files
+        formats = resolve_formats(['csv', 'npz', 'columnar'])
+        write_spikes(spikes, output_csv, formats)
+        load_times = {spike_format: timed(load_spike_table, spike_path(output_csv, spike_format))[1]
+                      for spike_format in formats}
+    # LR renaming of every cell to a global index
+    mapping = dict(zip(cell_names(range(args.cells)), cell_names(range(args.cells, 2 * args.cells))))
+    _, rename_time = timed(spikes.renamed, mapping)
+    frame_bytes = long_df.astype({LONG_COLUMNS[1]: object}).memory_usage(deep=True).sum()
+
+    print(f'{args.frames} frames x {args.cells} cells, {len(long_df)} events, {size / 2**20:.0f} MB CSV '
+          f'(written in {write_time:.1f} s)')
+    print(f'row by row: {loop_time:.2f} s for {args.loop_frames} frames, about {loop_estimate / 60:.0f} min in full')
+    print(f'vectorized: {convert_time:.2f} s in memory, {csv_time:.2f} s from CSV to CSV')
+    print(f'streaming by {args.chunk_rows} rows: {stream_time:.2f} s from CSV to CSV')
+    print(f'renaming {args.cells} cells: {rename_time:.2f} s')
+    print(f'compact table: {spikes.nbytes / 2**20:.1f} MB, {frame_bytes / 2**20:.1f} MB as a DataFrame of strings')
+    print('reloading the day: ' + ', '.join(f'{spike_format} {seconds * 1000:.0f} ms'
+                                             for spike_format, seconds in load_times.items()))
+    print(f'speedup: {loop_estimate / convert_time:.0f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+from src.backend import RemoveCorruptFrames as rcf
+from src.backend.spiketable import TIME_COLUMN
+from src.backend.isxd import write_isxd
+
+# synthetic .isxd movies with known corrupt segments, for the benchmarks and for testing without rig data
+
+# kinds of injected corruption: a black band (dropped sensor rows read as zeros) or a saturated band
+SEGMENT_KINDS = ('black', 'white')
+
+# lazy (frames, height, width) uint16 movie of gaussian noise around a slowly drifting baseline
+# every segment (first, last, kind) covers band ([[top, bottom], [left, right]]) of its frames with zeros ('black')
+# or with the maximum 12 bit value ('white'), frames are generated one at a time when iterated
+class SyntheticMovie(object):
+    def __init__(self, num_frames, height, width, segments=(), band=None, seed=0):
+        self.shape = (num_frames, height, width)
+        self.dtype = np.dtype(np.uint16)
+        self.segments = [(int(first), int(last), kind) for first, last, kind in segments]
+        self.band = band if band is not None else default_band(height, width)
+        self.seed = seed
+        for first, last, kind in self.segments:
+            if kind not in SEGMENT_KINDS:
+                raise ValueError(f'Unknown segment kind: {kind}')
+            if first < 0 or last >= num_frames or last < first:
+                raise ValueError(f'Segment [{first}, {last}] is outside a movie of {num_frames} frames')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed)
+        kinds = np.full(self.shape[0], '', dtype=object)
+        for first, last, kind in self.segments:
+            kinds[first:last + 1] = kind
+        rows = slice(self.band[0][0], self.band[0][1])
+        cols = slice(self.band[1][0], self.band[1][1])
+        for frame_number in range(self.shape[0]):
+            baseline = 1000 + 100 * np.sin(2 * np.pi * frame_number / 1000)
+            frame = rng.normal(baseline, 50, size=self.shape[1:]).clip(0, 4095).astype(np.uint16)
+            if kinds[frame_number] == 'black':
+                frame[rows, cols] = 0
+            elif kinds[frame_number] == 'white':
+                frame[rows, cols] = 4095
+            yield frame
+
+    # injected segments as [first, last] lists, merged like the detector reports them
+    def ground_truth(self):
+        mask = np.zeros(self.shape[0], dtype=bool)
+        for first, last, _ in self.segments:
+            mask[first:last + 1] = True
+        return rcf.corrupt_segments(mask)
+
+# corruption band of the default ROI scaled to the frame size, starting a quarter of the way down the frame
+def default_band(height, width):
+    roi = rcf.scaled_roi((height, width))
+    return [[height // 4, roi[0][1]], roi[1]]
+
+# num_segments non-overlapping corrupt runs of random lengths between min_length and max_length frames, alternating
+# between the segment kinds and separated by at least one clean frame
+def random_segments(num_frames, num_segments, min_length=1, max_length=50, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(min_length, max_length + 1, size=num_segments)
+    free = num_frames - int(lengths.sum()) - num_segments
+    if free < 0:
+        raise ValueError(f'{num_segments} segments of up to {max_length} frames do not fit in {num_frames} frames')
+    # spread the clean frames at random between the segments
+    gaps = np.sort(rng.integers(0, free + 1, size=num_segments))
+    gaps = np.diff(np.concatenate(([0], gaps)))
+    segments = []
+    position = 0
+    for i, (gap, length) in enumerate(zip(gaps, lengths)):
+        first = position + int(gap)
+        segments.append((first, first + int(length) - 1, SEGMENT_KINDS[i % len(SEGMENT_KINDS)]))
+        position = first + int(length) + 1
+    return segments
+
+# write a synthetic movie to file_path and return it (its ground_truth() lists the injected segments)
+def write_synthetic_movie(file_path, num_frames, height, width, segments=(), band=None, seed=0,
+                          frame_header_footer=False):
+    movie = SyntheticMovie(num_frames, height, width, segments=segments, band=band, seed=seed)
+    write_isxd(file_path, movie, frame_header_footer=frame_header_footer)
+    return movie
+
+# wide spike event table like the ones isx exports: unix timestamps every period seconds and one column per cell
+# (' C000', ' C001'...) holding the deconvolved spike value, non-zero in about event_rate of the frames
+def synthetic_spike_table(num_frames, num_cells, event_rate=0.01, period=0.05, start=1696262102.0, seed=0):
+    rng = np.random.default_rng(seed)
+    values = np.where(rng.random((num_frames, num_cells)) < event_rate,
+                      rng.gamma(2.0, 0.5, size=(num_frames, num_cells)).round(6), 0.0)
+    table = pd.DataFrame(values, columns=[f' C{cell:03d}' for cell in range(num_cells)])
+    table.insert(0, TIME_COLUMN, (start + period * np.arange(num_frames)).round(6))
+    return table
+
+def write_synthetic_spike_csv(file_path, num_frames, num_cells, event_rate=0.01, seed=0):
+    table = synthetic_spike_table(num_frames, num_cells, event_rate=event_rate, seed=seed)
+    table.to_csv(file_path, index=False)
+    return table
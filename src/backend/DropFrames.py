@@ -4,6 +4,12 @@ import shutil
 from src.backend.RemoveCorruptFrames import run_process
 
 class DropFrames:
+    # both steps work on the whole directory, run_process starts its own pool (see StepScheduler)
+    step_io = {
+        'drop_frames': {'local': True},
+        'delete_corrupt_files': {'after': ['drop_frames'], 'local': True},
+    }
+
     def __init__(self, directory):
         super().__init__()
         self.directory = directory
@@ -3,11 +3,27 @@ import isx
 from pathlib import Path
 import matplotlib.pyplot as plt
 import pandas as pd
-from src.backend.process import Process
+from src.backend.process import Process, timed_step
+from src.backend.spiketable import global_cell_maps, rename_cells_file, stored_spike_paths, spike_path, DEFAULT_SPIKE_FORMATS
 
 class LongitudinalRegistration(Process):
-    def __init__(self, data_dir, output_folder_name, mouse):
-        super().__init__(data_dir, output_folder_name, mouse)
+    # files read and written by every step, as names of the per-day file lists of Process (see StepScheduler)
+    step_io = {
+        'calculate_dff': {'inputs': ['mc_files_series'], 'outputs': ['dff_files_series']},
+        'longitudinal_registration': {'inputs': ['cnmfe_files_series', 'dff_files_series'],
+                                      'outputs': ['lr_csv_file', 'cnmfe_cellset_lr_output', 'dff_files_lr_output']},
+        'store_cnmfe_cellset_output': {'after': ['longitudinal_registration'], 'local': True},
+        'calculate_max_projection': {'inputs': ['dff_files_lr_output'], 'outputs': ['maxdff_files_lr']},
+        'rename_cells_from_timeseries': {'inputs': ['lr_csv_file', 'timeseries_events'],
+                                         'outputs': ['lr_cells_from_day']},
+    }
+
+    # scratch_dir and retention place and clean up the intermediate movies, spike_formats are the files of the spike
+    # tables (see Process)
+    def __init__(self, data_dir, output_folder_name, mouse, scratch_dir=None, retention='all',
+                 spike_formats=DEFAULT_SPIKE_FORMATS):
+        super().__init__(data_dir, output_folder_name, mouse, scratch_dir=scratch_dir, retention=retention,
+                         spike_formats=spike_formats)
         #make new input/output files for longitudinal registratiohn processing
         """
         A movie list can be used as an optional second input to cnmfe lr output
@@ -30,34 +46,41 @@ class LongitudinalRegistration(Process):
         self.lr_csv_file = os.path.join(self.output_dir,'lr_index_table.csv')
         
     # calculate delta f/f from motion corrected recordings 
+    @timed_step
     def calculate_dff(self):
         print('Calculating deltaf/f0, please wait...\n')
         try:
             for day_i, day_label in enumerate(self.day_labels):
-                if not self.check_all_recordings_processed(self.dff_files_series, day_i):
-                    isx.dff(input_movie_files= self.mc_files_json[day_i],
-                            output_movie_files=self.dff_files_series[day_i],
-                            f0_type='mean')
+                if self.cached_step('calculate_dff', day_label, self.mc_files_json[day_i], self.dff_files_series[day_i],
+                                    {'f0_type': 'mean'},
+                                    lambda staged: isx.dff(input_movie_files= self.mc_files_json[day_i],
+                                                    output_movie_files=staged(self.dff_files_series[day_i]),
+                                                    f0_type='mean')) == 'ran':
                     print('A new df/f movie has been generated for',
                         day_label)
         except Exception as e:
             print(f'ERROR: {e}')
+            raise
 
+    @timed_step
     def longitudinal_registration(self):
         print('Longitudinal Registration begin...')
         try:
-            if not os.path.exists(self.lr_csv_file):  # skip if output file already exists
-                isx.longitudinal_registration(
-                    self.cnmfe_cellset_lr_input,
-                    self.cnmfe_cellset_lr_output,
-                    input_movie_files=self.dff_files_lr_input,
-                    output_movie_files=self.dff_files_lr_output,
-                    csv_file=self.lr_csv_file, accepted_cells_only=False)
-                print('Longitudinal registration for {} and {} time series completed'.format(self.day_labels[0], self.day_labels[0]))
-                print(os.path.exists(self.lr_csv_file))
+            inputs = self.cnmfe_cellset_lr_input + self.dff_files_lr_input
+            outputs = [self.lr_csv_file] + self.cnmfe_cellset_lr_output + self.dff_files_lr_output
+            if self.cached_step('longitudinal_registration', 'all', inputs, outputs, {'accepted_cells_only': False},
+                                lambda staged: isx.longitudinal_registration(
+                                    self.cnmfe_cellset_lr_input,
+                                    staged(self.cnmfe_cellset_lr_output),
+                                    input_movie_files=self.dff_files_lr_input,
+                                    output_movie_files=staged(self.dff_files_lr_output),
+                                    csv_file=staged(self.lr_csv_file), accepted_cells_only=False)) == 'ran':
+                print('Longitudinal registration for {} and {} time series completed'.format(self.day_labels[0], self.day_labels[-1]))
         except Exception as e:
             print(f"ERROR: {e}")
+            raise
 
+    @timed_step
     def store_cnmfe_cellset_output(self):
         for day_i, key in enumerate(self.series_rec_names):
             self.cnmfe_cellset_lr_series[key] = self.split2series(self.cnmfe_cellset_lr_output)[day_i]
@@ -66,19 +89,21 @@ class LongitudinalRegistration(Process):
         self.write_json('dff_files_lr.json', self.dff_lr_series)
 
 
+    @timed_step
     def calculate_max_projection(self):
         for day_i, day_label in enumerate(self.day_labels):
-            if not self.check_all_recordings_processed(self.maxdff_files_series, day_i):  # skip if file exists
-                isx.project_movie(
-                    input_movie_files=self.split2series(self.dff_files_lr_output)[day_i],
-                    output_image_file= self.maxdff_files_lr[day_i],
-                    stat_type='max')  # types: 'mean', 'min', or 'max'
+            dff_lr_files = self.split2series(self.dff_files_lr_output)[day_i]
+            if self.cached_step('calculate_max_projection', day_label, dff_lr_files, [self.maxdff_files_lr[day_i]],
+                                {'stat_type': 'max'},
+                                lambda staged: isx.project_movie(
+                                    input_movie_files=dff_lr_files,
+                                    output_image_file= staged(self.maxdff_files_lr[day_i]),
+                                    stat_type='max')) == 'ran':  # types: 'mean', 'min', or 'max'
                 print("maximal projection from {} dff time series completed".\
                     format(day_label))
-            else:
-                print(Path(self.maxdff_files_lr[day_i]).stem + " exists, process skipped")
 
     #create plots for max projection after LR 
+    @timed_step
     def display_max_projections(self):
         # set subplots, matching series No.
         cols = len(self.day_labels)
@@ -118,33 +143,24 @@ class LongitudinalRegistration(Process):
         return day_indexes 
      
     # for individual days, rename the local cellset name to the global cellset name for all days
+    # every day is renamed in one pass through the local to global mapping of its first cellset (see
+    # spiketable.global_cell_maps), so a cell renamed to the local name of another one is not renamed again
+    # the renaming and sorting run on the compact table (see spiketable.SpikeTable), the days are read from their
+    # fastest file and written in the spike_formats of the run
+    # every day goes through the step cache, keyed on the LR index table and the stored files of the day
+    @timed_step
     def rename_cells_from_timeseries(self):
+        files = self.timeseries_events
+        if not (os.path.exists(self.lr_csv_file) and all(stored_spike_paths(file) for file in files)):
+            raise FileNotFoundError('Could not find LR index table or vertically aligned timeseries spikes files')
         # read lr index table
         lr_df = pd.read_csv(self.lr_csv_file)
-        num_sessions = self.num_rec_per_series
-        idx = 0
-        j = 0
         day_indices = self.get_day_indices_from_lr()
-        cellset_idx = 0
-        files = self.timeseries_events
-        day_dfs = list(map(pd.read_csv, files))
-        lr_realignment_output = self.lr_cells_from_day
-        
-        if os.path.exists(self.lr_csv_file) & os.path.exists(files[j]):
-            for _ in range(0, (len(lr_df))):
-                if idx > (len(lr_df)- num_sessions[-1]):
-                    break
-                cellset_idx = int(lr_df.loc[idx]['local_cellset_index'])
-                j = day_indices.index(cellset_idx)
-
-                local_idx = int(lr_df.loc[idx]['local_cell_index'])
-                global_idx = int(lr_df.loc[idx]['global_cell_index'])
-                cell_to_replace = ' C' + str(local_idx).zfill(3)
-                new_cell_val = ' C' + str(global_idx).zfill(3)
-
-                day_dfs[j][' Cell Name'] = day_dfs[j][' Cell Name'].replace(cell_to_replace, new_cell_val)
-                idx += num_sessions[j]
-        else:
-            raise FileNotFoundError('Could not find LR index table or vertically aligned timeseries spikes files')
-        for csv_i in range(0, len(day_dfs)):
-            day_dfs[csv_i].sort_values(by=[' Cell Name', 'Time (s)']).to_csv(lr_realignment_output[csv_i], index=False)
+        cell_maps = global_cell_maps(lr_df, day_indices)
+        for day_i, (file, mapping, output) in enumerate(zip(files, cell_maps, self.lr_cells_from_day)):
+            outputs = [spike_path(output, spike_format) for spike_format in self.spike_formats]
+            self.cached_step('rename_cells_from_timeseries', self.day_labels[day_i],
+                             [self.lr_csv_file] + stored_spike_paths(file), outputs,
+                             {'cellset': day_indices[day_i], 'formats': list(self.spike_formats)},
+                             lambda staged, file=file, mapping=mapping, output=output:
+                                 rename_cells_file(file, staged(output), mapping, self.spike_formats))
@@ -7,23 +7,71 @@ import numpy as np
 import random
 import time
 import multiprocessing
+import json
+from functools import partial
+from src.backend.isxd import IsxdMovie, trim_isxd
+from src.workutils.Prefetcher import iterate_blocks, block_ranges
+from src.workutils.StartMethod import START_METHOD
+from src.backend.runreport import StepTimer, new_run_id, write_run_report
 
 """SOURCE AUTHOR: Mahir Patel, @mahir1010"""
 
-# Number of parallel processes
-NUM_PROCESSES = 2
+# Number of parallel processes, defaults to one per core
+NUM_PROCESSES = os.cpu_count() or 1
 
-# ROI 
-Left = 450 
+# Number of frames read and analysed together by the batched ('block') scanner
+BLOCK_SIZE = 64
+# Number of blocks read ahead on a background thread while the current one is analysed (0 reads inline)
+PREFETCH_DEPTH = 2
+# Number of frames of a movie handed to one worker process at a time
+CHUNK_SIZE = 2048
+# Minimum number of seconds between two progress reports of the batched scanner
+PROGRESS_INTERVAL = 2.0
+# Per-frame statistics are cached next to each movie in <movie name>.frame_stats.npz
+SIDECAR_SUFFIX = '.frame_stats.npz'
+# Bump when the statistics computed by block_statistics change so that old sidecars are rebuilt
+SIDECAR_VERSION = 1
+# Coarse-to-fine ('coarse') scanner: one frame out of COARSE_STRIDE is analysed at full resolution, and every frame
+# is checked on a grid of one ROI pixel out of PIXEL_STRIDE in each direction
+COARSE_STRIDE = 16
+PIXEL_STRIDE = 4
+# A JSON report of every detection run is written next to the movie in <movie name>_corrupt_frames.json
+REPORT_SUFFIX = '_corrupt_frames.json'
+# ROI calibration: CALIBRATION_FRAMES frames spread over the movie are analysed on a grid of one pixel out of
+# CALIBRATION_PIXEL_STRIDE in each direction, frames with at least CALIBRATION_MIN_FRACTION of their pixels more than
+# the median frame black or saturated carry artefacts. Pixels that are artefacts in at least CALIBRATION_MIN_HITS of
+# these frames more often than in clean frames belong to the band (normalization also scatters a few saturated pixels
+# over the whole frame), and the ROI is the narrowest row and column band holding every row and column with at least
+# CALIBRATION_PROFILE_FRACTION as many band pixels as the fullest one
+CALIBRATION_FRAMES = 1000
+CALIBRATION_PIXEL_STRIDE = 4
+CALIBRATION_MIN_FRACTION = 0.005
+CALIBRATION_MIN_HITS = 0.3
+CALIBRATION_PROFILE_FRACTION = 0.25
+# Calibrated ROIs are cached per frame size ('<height>x<width>') in this JSON file, next to the movies by default
+ROI_CACHE_NAME = 'corrupt_frame_roi.json'
+# sidecar entry of a movie the calibration found no artefacts in, holding the number of calibration frames read
+NO_ARTEFACTS_KEY = 'calibration_no_artefacts'
+
+# Default ROI ([[top, bottom], [left, right]]) of the corruption band on a full resolution SENSOR_SHAPE sensor, scaled to
+# the frame size of other movies when the band cannot be calibrated
+Left = 450
 Top = 0
 Width = 50
 Height = 800
+SENSOR_SHAPE = (800, 1280)
 
-roi = [[Top, Top + Height], [Left, Left + Width]]
+DEFAULT_ROI = [[Top, Top + Height], [Left, Left + Width]]
 normalize = lambda x: (((x - x.min()) / (x.max() - x.min()))*255).astype(np.uint8)
 # normalize = lambda x: x
 
-def get_thresholds(movie: isx.Movie, test_n=10, padding_fraction=0.01) -> int:
+# same as normalize, applied independently to every frame of a (frames, height, width) stack
+def normalize_block(block):
+    mins = block.min(axis=(1, 2), keepdims=True)
+    maxs = block.max(axis=(1, 2), keepdims=True)
+    return (((block - mins) / (maxs - mins))*255).astype(np.uint8)
+
+def get_thresholds(movie: isx.Movie, test_n=10, padding_fraction=0.01, roi=DEFAULT_ROI) -> int:
     indices = [random.randint(0, movie.timing.num_samples) for i in range(test_n)]
     max_hist = []
     max_hist_white = []
@@ -35,27 +83,287 @@ def get_thresholds(movie: isx.Movie, test_n=10, padding_fraction=0.01) -> int:
         histogram = np.histogram(img.flatten(), range(0, 257))[0]
         max_hist.append(histogram[0])
         max_hist_white.append(np.mean(histogram[-15:]))
-    padding = (Height * Width * padding_fraction)
+    padding = ((roi[0][1] - roi[0][0]) * (roi[1][1] - roi[1][0]) * padding_fraction)
     return np.median(max_hist) + padding, np.median(max_hist_white) + padding
 
 
 
 
-def process_isxd(file_path):
-    file_name = os.path.basename(file_path)
-    movie = None
+# open a movie with the memory-mapped native reader, falling back to the isx API for files it cannot parse
+def open_movie(file_path):
     try:
-        movie = isx.Movie.read(file_path)
-    except:
-        print("Invalid inscopix file")
-        return
-    segments = []
-    segment = None
-    is_corrupt = False
-    threshold,threshold_2 = get_thresholds(movie,test_n=30,padding_fraction=0.001)
-    print("Threshold Set to ", threshold, ' and',threshold_2)
+        return IsxdMovie(file_path)
+    except (ValueError, KeyError, OSError):
+        return isx.Movie.read(file_path)
+
+# reads the ROI of frames [start, stop) into one (frames, height, width) array
+# frames that cannot be read are left as zeros and flagged in the returned mask
+# with the native reader the block is a view of the memory-mapped file unless load is set, it is then copied so the
+# pages are read from disk by the caller (the prefetch thread) rather than by whoever analyses the block
+# with pixel_stride > 1 only one ROI pixel out of pixel_stride in each direction is kept, taken from the view before
+# the copy so only the sampled pixels are copied
+def read_roi_block(movie, start, stop, roi=DEFAULT_ROI, load=False, pixel_stride=1):
+    if isinstance(movie, IsxdMovie):
+        block = movie.get_frames(start, stop, roi)[:, ::pixel_stride, ::pixel_stride]
+        return (np.array(block) if load else block), np.ones(stop - start, dtype=bool)
+    block = None
+    readable = np.ones(stop - start, dtype=bool)
+    for i, frame_number in enumerate(range(start, stop)):
+        try:
+            frame = movie.get_frame_data(frame_number)[roi[0][0]:roi[0][1]:pixel_stride,
+                                                       roi[1][0]:roi[1][1]:pixel_stride]
+        except Exception:
+            readable[i] = False
+            continue
+        if block is None:
+            block = np.zeros((stop - start,) + frame.shape, dtype=frame.dtype)
+        block[i] = frame
+    return block, readable
+
+# vectorized version of the per-frame histogram test
+# histogram[0] of a normalized frame is its number of black pixels and np.mean(histogram[-15:])
+# is the number of pixels in the top 15 bins (241-255) divided by 15
+def block_statistics(block):
+    if block is None or block.size == 0:
+        return None, None
+    frames = normalize_block(block)
+    black = np.count_nonzero(frames == 0, axis=(1, 2))
+    white = np.count_nonzero(frames >= 241, axis=(1, 2)) / 15
+    return black, white
+
+# print the scan progress at most once every PROGRESS_INTERVAL seconds
+class ProgressReporter(object):
+    def __init__(self, file_name, total_frames, interval=PROGRESS_INTERVAL):
+        self.file_name = file_name
+        self.total_frames = total_frames
+        self.interval = interval
+        self.start_time = time.time()
+        self.last_report = self.start_time
+
+    def update(self, frames_done, force=False):
+        now = time.time()
+        if not force and (now - self.last_report) < self.interval:
+            return
+        self.last_report = now
+        elapsed = max(now - self.start_time, 1e-9)
+        fps = frames_done / elapsed
+        eta = (self.total_frames - frames_done) / fps if fps > 0 else float('inf')
+        print(f'\r {self.file_name} Frame:{frames_done}/{self.total_frames}  FPS:{round(fps)} ETA:{round(eta, 2)} seconds', end='')
+
+# batched scanner: reads frames [start, stop) of the movie in blocks of block_size frames and computes the statistics
+# of every frame of the block with a few numpy reductions
+# returns the black-pixel counts and white-tail means of the range, frames that could not be read are set to inf
+# progress is an optional ProgressReporter updated after every block
+# with pixel_stride > 1 only one ROI pixel out of pixel_stride in each direction is analysed
+# the next prefetch_depth blocks are read on a background thread while the current one is analysed, the time spent
+# waiting on reads and analysing blocks is accumulated in the optional timings dict
+def scan_blocks(movie, block_size=BLOCK_SIZE, start=0, stop=None, progress=None, pixel_stride=1,
+                prefetch_depth=PREFETCH_DEPTH, timings=None, roi=DEFAULT_ROI):
+    if stop is None:
+        stop = movie.timing.num_samples
+    black = np.full(stop - start, np.inf)
+    white = np.full(stop - start, np.inf)
+    read_block = partial(read_roi_block, movie, roi=roi, load=prefetch_depth > 0, pixel_stride=pixel_stride)
+    for block_start, block_stop, (block, readable) in iterate_blocks(read_block, block_ranges(start, stop, block_size),
+                                                                     depth=prefetch_depth, stats=timings):
+        block_black, block_white = block_statistics(block)
+        if block_black is not None:
+            in_range = slice(block_start - start, block_stop - start)
+            black[in_range] = np.where(readable, block_black, np.inf)
+            white[in_range] = np.where(readable, block_white, np.inf)
+        if progress is not None:
+            progress.update(block_stop)
+    return black, white
+
+# worker process entry point: opens the movie independently and returns the statistics of one chunk of frames
+def scan_chunk(file_path, block_size, prefetch_depth, roi, chunk):
+    start, stop = chunk
+    movie = open_movie(file_path)
+    timings = {}
+    black, white = scan_blocks(movie, block_size=block_size, start=start, stop=stop, prefetch_depth=prefetch_depth,
+                               timings=timings, roi=roi)
+    return black, white, timings
+
+# add the prefetch timings of one scan to a running total
+def add_timings(total, timings):
+    if total is not None:
+        for key, value in timings.items():
+            total[key] = total.get(key, 0) + value
+
+# compute the statistics of every frame of the movie
+# pool is an optional multiprocessing pool, the movie is then split in chunks of chunk_size frames scanned in parallel
+# (timings then add up the I/O stalls and compute time of all workers)
+def compute_frame_statistics(file_path, movie, block_size=BLOCK_SIZE, pool=None, chunk_size=CHUNK_SIZE,
+                             prefetch_depth=PREFETCH_DEPTH, timings=None, roi=DEFAULT_ROI):
     total_frames = movie.timing.num_samples
+    progress = ProgressReporter(os.path.basename(file_path), total_frames)
+    if pool is None:
+        black, white = scan_blocks(movie, block_size=block_size, progress=progress, prefetch_depth=prefetch_depth,
+                                   timings=timings, roi=roi)
+    else:
+        black = np.full(total_frames, np.inf)
+        white = np.full(total_frames, np.inf)
+        chunks = [(start, min(start + chunk_size, total_frames)) for start in range(0, total_frames, chunk_size)]
+        scan = partial(scan_chunk, file_path, block_size, prefetch_depth, roi)
+        frames_done = 0
+        for (start, stop), (chunk_black, chunk_white, chunk_timings) in zip(chunks, pool.imap(scan, chunks)):
+            black[start:stop] = chunk_black
+            white[start:stop] = chunk_white
+            add_timings(timings, chunk_timings)
+            frames_done += stop - start
+            progress.update(frames_done)
+    progress.update(total_frames, force=True)
+    print('\n')
+    return black, white
+
+def sidecar_path(file_path):
+    return os.path.splitext(file_path)[0] + SIDECAR_SUFFIX
+
+# the statistics depend on the movie content and on the ROI (frames are normalized over the ROI),
+# a sidecar can hold the statistics of several ROIs as long as the movie has not changed
+def roi_key(roi):
+    return 'roi_' + '_'.join(str(int(v)) for v in np.ravel(roi))
+
+def file_identity(file_path):
+    stat = os.stat(file_path)
+    return np.array([stat.st_size, stat.st_mtime_ns, SIDECAR_VERSION], dtype=np.int64)
+
+# read all entries of the sidecar if it still matches the movie, otherwise return an empty dict
+def read_sidecar(file_path):
+    path = sidecar_path(file_path)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with np.load(path) as sidecar:
+            if not np.array_equal(sidecar['identity'], file_identity(file_path)):
+                print(f'Stale frame statistics for {file_path}, rebuilding')
+                return {}
+            return {key: sidecar[key] for key in sidecar.files if key != 'identity'}
+    except Exception as e:
+        print(f'Could not read {path}: {e}')
+        return {}
+
+# write the sidecar next to the movie, through a temporary file so a crash never leaves a truncated sidecar
+def write_sidecar(file_path, entries):
+    path = sidecar_path(file_path)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as tmp:
+        np.savez(tmp, identity=file_identity(file_path), **entries)
+    os.replace(tmp_path, path)
+
+# return the black-pixel counts and white-tail means of every frame, from the sidecar when it is up to date
+# or by scanning the movie (and updating the sidecar) otherwise, and whether the sidecar was used
+def get_frame_statistics(file_path, block_size=BLOCK_SIZE, pool=None, chunk_size=CHUNK_SIZE, use_sidecar=True,
+                         prefetch_depth=PREFETCH_DEPTH, timings=None, roi=DEFAULT_ROI):
+    key = roi_key(roi)
+    entries = read_sidecar(file_path) if use_sidecar else {}
+    if key in entries:
+        return entries[key][0], entries[key][1], True
+    movie = open_movie(file_path)
     print(f"{file_path} Total Frames:{movie.timing.num_samples}")
+    black, white = compute_frame_statistics(file_path, movie, block_size=block_size, pool=pool, chunk_size=chunk_size,
+                                            prefetch_depth=prefetch_depth, timings=timings, roi=roi)
+    del movie
+    if use_sidecar:
+        entries[key] = np.stack([black, white])
+        try:
+            write_sidecar(file_path, entries)
+        except OSError as e:
+            print(f'Could not write frame statistics for {file_path}: {e}')
+    return black, white, False
+
+# same thresholds as get_thresholds but drawn from already computed statistics instead of the movie
+# frames whose statistics are not finite (unreadable or not scanned) are ignored
+# pixel_stride scales the padding to statistics computed on a sub-sampled ROI
+def thresholds_from_statistics(black, white, test_n=10, padding_fraction=0.01, pixel_stride=1, roi=DEFAULT_ROI):
+    readable = np.flatnonzero(np.isfinite(black) & np.isfinite(white))
+    if len(readable) == 0:
+        raise ValueError('No readable frames to compute thresholds from')
+    indices = np.random.choice(readable, size=min(test_n, len(readable)), replace=False)
+    height = len(range(roi[0][0], roi[0][1], pixel_stride))
+    width = len(range(roi[1][0], roi[1][1], pixel_stride))
+    padding = (height * width * padding_fraction)
+    return np.median(black[indices]) + padding, np.median(white[indices]) + padding
+
+# split a sorted array of frame indices into [start, stop) ranges of consecutive frames
+def index_ranges(indices):
+    if len(indices) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    return [(int(run[0]), int(run[-1]) + 1) for run in np.split(indices, breaks)]
+
+# coarse-to-fine scanner, returns the full resolution statistics of the frames it analysed (NaN for the others)
+# and a summary of the work done
+#  1. one frame out of stride is analysed at full resolution
+#  2. every frame is analysed on a grid of one ROI pixel out of pixel_stride in each direction (skipped if None)
+#  3. sampled frames above the full resolution thresholds and frames above the sub-sampled thresholds are analysed
+#     at full resolution, and the scan grows stride frames at a time around every corrupt frame until each corrupt
+#     run is bounded by clean frames analysed at full resolution
+# Guarantees, relative to scan_mode 'block' with the same thresholds:
+#  - every corrupt run of stride frames or more contains a sampled frame and is found with its exact extent
+#  - a shorter run is found, with its exact extent, when it contains a sampled frame or when one of its frames
+#    exceeds the sub-sampled thresholds. Black or saturated artefacts at least pixel_stride pixels wide in both
+#    directions keep the same share of the sub-sampled grid as of the ROI and are caught like at full resolution;
+#    thinner artefacts (single rows or columns) in runs shorter than stride can be missed
+#  - the final decision is always taken on full resolution statistics, so the coarse passes add no false positives
+def coarse_scan(movie, test_n=30, padding_fraction=0.001, thresholds=None, stride=COARSE_STRIDE,
+                pixel_stride=PIXEL_STRIDE, block_size=BLOCK_SIZE, file_name='', prefetch_depth=PREFETCH_DEPTH,
+                timings=None, roi=DEFAULT_ROI):
+    total_frames = movie.timing.num_samples
+    black = np.full(total_frames, np.nan)
+    white = np.full(total_frames, np.nan)
+    scanned = np.zeros(total_frames, dtype=bool)
+
+    def scan(indices):
+        indices = np.flatnonzero(np.isin(np.arange(total_frames), indices) & ~scanned)
+        for start, stop in index_ranges(indices):
+            black[start:stop], white[start:stop] = scan_blocks(movie, block_size=block_size, start=start, stop=stop,
+                                                               prefetch_depth=prefetch_depth, timings=timings, roi=roi)
+            scanned[start:stop] = True
+
+    sampled = np.unique(np.append(np.arange(0, total_frames, stride), total_frames - 1))
+    scan(sampled)
+    if thresholds is None:
+        thresholds = thresholds_from_statistics(black, white, test_n=test_n, padding_fraction=padding_fraction, roi=roi)
+    threshold, threshold_2 = thresholds
+    is_corrupt = lambda: scanned & ((black > threshold) | (white > threshold_2))
+    candidates = np.flatnonzero(is_corrupt())
+    cheap_flagged = 0
+    if pixel_stride:
+        progress = ProgressReporter(file_name, total_frames)
+        cheap_black, cheap_white = scan_blocks(movie, block_size=block_size, progress=progress, pixel_stride=pixel_stride,
+                                               prefetch_depth=prefetch_depth, timings=timings, roi=roi)
+        cheap_threshold, cheap_threshold_2 = thresholds_from_statistics(cheap_black, cheap_white, test_n=test_n,
+                                                                        padding_fraction=padding_fraction,
+                                                                        pixel_stride=pixel_stride, roi=roi)
+        cheap = np.flatnonzero((cheap_black > cheap_threshold) | (cheap_white > cheap_threshold_2))
+        cheap_flagged = len(cheap)
+        candidates = np.union1d(candidates, cheap)
+        print('\n')
+    scan(candidates)
+    # grow around corrupt frames until every run is bounded by scanned clean frames (or the movie ends)
+    while True:
+        corrupt = is_corrupt()
+        before = np.flatnonzero(corrupt[1:] & ~scanned[:-1])
+        after = np.flatnonzero(corrupt[:-1] & ~scanned[1:]) + 1
+        if len(before) == 0 and len(after) == 0:
+            break
+        grow = [np.arange(max(i - stride + 1, 0), i + 1) for i in before]
+        grow += [np.arange(i, min(i + stride, total_frames)) for i in after]
+        scan(np.unique(np.concatenate(grow)))
+    summary = {'stride': stride, 'pixel_stride': pixel_stride, 'sampled_frames': int(len(sampled)),
+               'subsampled_candidates': int(cheap_flagged), 'full_resolution_frames': int(np.count_nonzero(scanned))}
+    return black, white, (threshold, threshold_2), summary
+
+# run-length encode a boolean per-frame corruption mask into the list of [first, last] corrupt segments
+def corrupt_segments(mask):
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], np.asarray(mask, dtype=np.int8), [0]))))
+    return [[int(first), int(last) - 1] for first, last in zip(edges[::2], edges[1::2])]
+
+# original per-frame scanner, returns the per-frame corruption mask or None if interrupted
+def scan_frames(movie, threshold, threshold_2, file_name='', roi=DEFAULT_ROI):
+    total_frames = movie.timing.num_samples
+    corrupt = np.zeros(total_frames, dtype=bool)
     avg_fps = []
     for frame_number in range(0, movie.timing.num_samples):
         try:
@@ -67,19 +375,7 @@ def process_isxd(file_path):
                 histogram = np.histogram(frame.flatten(), range(0, 257))[0]
             except:
                 frame = None
-            if frame is None or histogram[0] > threshold or np.mean(histogram[-15:]) > threshold_2:
-                if is_corrupt:
-                    segment[1] = frame_number
-                else:
-                    if segment is None:
-                        segment = [frame_number, frame_number]
-                    else:
-                        segments.append(segment.copy())
-                        segment[0] = frame_number
-                        segment[1] = frame_number
-                    is_corrupt = True
-            else:
-                is_corrupt = False
+            corrupt[frame_number] = frame is None or histogram[0] > threshold or np.mean(histogram[-15:]) > threshold_2
             FPS = round(1 / (time.time() - start))
             avg_fps.append(FPS)
             if len(avg_fps) > 5:
@@ -87,35 +383,306 @@ def process_isxd(file_path):
             FPS = np.mean(avg_fps)
             print(f'{file_name}  FPS:{FPS} ETA:{round((total_frames - frame_number) / FPS, 2)} seconds', end='')
         except KeyboardInterrupt:
-            return
+            return None
         except Exception:
             continue
     print('\n')
-    append_last = False
-    try:
-        append_last = (segments[-1][0]!=segment[0] or segments[-1][1]!=segment[1])
-        segments.append(segment.copy())
-    except:
-        append_last = False
-    if (len(segments)==0 and segment is not None):
-        segments.append(segment.copy())
-    if len(segments):
-        final_segments = segments.copy()
-        print('\n', final_segments)
-        print('Trim started...')
-        isx.trim_movie(file_path, file_path.replace('.isxd', '_processed.isxd'), final_segments)
+    return corrupt
+
+# scan a movie and return a report of the run (None if the file cannot be scanned), its 'segments' entry holds the
+# list of corrupt [first, last] frame segments
+# scan_mode 'block' uses the batched scanner and the statistics sidecar, 'frame' the original one frame at a time loop,
+# 'coarse' the coarse-to-fine scanner (see coarse_scan for what it is guaranteed to find), which only reads a fraction
+# of the movie at full resolution and falls back to the sidecar statistics when they are up to date
+# in block and coarse mode thresholds can be given as (black threshold, white threshold) to skip their estimation
+# and prefetch_depth blocks of block_size frames are read ahead while the current block is analysed
+def detect_corrupt_frames(file_path, scan_mode='block', block_size=BLOCK_SIZE, pool=None, chunk_size=CHUNK_SIZE,
+                          test_n=30, padding_fraction=0.001, thresholds=None, use_sidecar=True,
+                          stride=COARSE_STRIDE, pixel_stride=PIXEL_STRIDE, prefetch_depth=PREFETCH_DEPTH,
+                          roi=DEFAULT_ROI):
+    file_name = os.path.basename(file_path)
+    start_time = time.time()
+    from_sidecar = False
+    coarse_summary = None
+    timings = {}
+    if scan_mode == 'coarse' and use_sidecar and roi_key(roi) in read_sidecar(file_path):
+        # the statistics of every frame are already known, thresholding them is cheaper than any coarse pass
+        scan_mode = 'block'
+    if scan_mode == 'frame':
+        movie = None
+        try:
+            movie = isx.Movie.read(file_path)
+        except:
+            print("Invalid inscopix file")
+            return None
+        threshold,threshold_2 = get_thresholds(movie,test_n=test_n,padding_fraction=padding_fraction,roi=roi)
+        print("Threshold Set to ", threshold, ' and',threshold_2)
+        print(f"{file_path} Total Frames:{movie.timing.num_samples}")
+        mask = scan_frames(movie, threshold, threshold_2, file_name=file_name, roi=roi)
+        if mask is None:
+            return None
+    elif scan_mode == 'coarse':
+        try:
+            movie = open_movie(file_path)
+            print(f"{file_path} Total Frames:{movie.timing.num_samples}")
+            black, white, thresholds, coarse_summary = coarse_scan(
+                movie, test_n=test_n, padding_fraction=padding_fraction, thresholds=thresholds, stride=stride,
+                pixel_stride=pixel_stride, block_size=block_size, file_name=file_name, prefetch_depth=prefetch_depth,
+                timings=timings, roi=roi)
+            del movie
+        except KeyboardInterrupt:
+            return None
+        except Exception as e:
+            print(f"Invalid inscopix file: {e}")
+            return None
+        threshold, threshold_2 = thresholds
+        print("Threshold Set to ", threshold, ' and',threshold_2)
+        mask = (black > threshold) | (white > threshold_2)
+    elif scan_mode == 'block':
+        try:
+            black, white, from_sidecar = get_frame_statistics(file_path, block_size=block_size, pool=pool,
+                                                              chunk_size=chunk_size, use_sidecar=use_sidecar,
+                                                              prefetch_depth=prefetch_depth, timings=timings,
+                                                              roi=roi)
+        except KeyboardInterrupt:
+            return None
+        except Exception as e:
+            print(f"Invalid inscopix file: {e}")
+            return None
+        if thresholds is None:
+            thresholds = thresholds_from_statistics(black, white, test_n=test_n, padding_fraction=padding_fraction,
+                                                    roi=roi)
+        threshold, threshold_2 = thresholds
+        print("Threshold Set to ", threshold, ' and',threshold_2)
+        mask = (black > threshold) | (white > threshold_2)
     else:
-        print(f"No dropped frames in {file_path}")
+        raise ValueError(f'Unknown scan mode: {scan_mode}')
+    elapsed = time.time() - start_time
+    report = {
+        'file': file_path,
+        'scan_mode': scan_mode,
+        'statistics_from_sidecar': bool(from_sidecar),
+        'roi': [[int(v) for v in axis] for axis in roi],
+        'thresholds': {'black': float(threshold), 'white': float(threshold_2)},
+        'test_n': test_n,
+        'padding_fraction': padding_fraction,
+        'frames_scanned': int(len(mask)) if coarse_summary is None else coarse_summary['full_resolution_frames'],
+        'corrupt_frames': int(np.count_nonzero(mask)),
+        'segments': corrupt_segments(mask),
+        'scan_seconds': round(elapsed, 3),
+        'frames_per_second': round(len(mask) / elapsed, 1) if elapsed > 0 else None,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    if coarse_summary is not None:
+        report['coarse'] = coarse_summary
+    if timings:
+        report['prefetch'] = {'depth': prefetch_depth, 'block_size': block_size, 'blocks': int(timings['blocks']),
+                              'io_wait_seconds': round(timings['io_wait_seconds'], 3),
+                              'compute_seconds': round(timings['compute_seconds'], 3),
+                              'read_seconds': round(timings['read_seconds'], 3)}
+        print(f"{file_name} stalled on I/O for {report['prefetch']['io_wait_seconds']} s, "
+              f"analysed blocks for {report['prefetch']['compute_seconds']} s")
+    return report
+
+# same as detect_corrupt_frames but only return the list of corrupt segments
+def find_corrupt_segments(file_path, **kwargs):
+    report = detect_corrupt_frames(file_path, **kwargs)
+    return None if report is None else report['segments']
+
+def report_path(file_path):
+    return os.path.splitext(file_path)[0] + REPORT_SUFFIX
+
+def write_report(file_path, report):
+    try:
+        with open(report_path(file_path), 'w') as f:
+            json.dump(report, f, indent=4)
+    except OSError as e:
+        print(f'Could not write corrupt frame report for {file_path}: {e}')
+
+# frame size of a movie opened with open_movie, as (height, width)
+def movie_shape(movie):
+    if isinstance(movie, IsxdMovie):
+        return movie.shape
+    return tuple(int(n) for n in movie.spacing.num_pixels)
+
+# roi defined on a sensor_shape sensor mapped onto frames of the given shape (spatially downsampled movies)
+def scaled_roi(shape, roi=DEFAULT_ROI, sensor_shape=SENSOR_SHAPE):
+    scale_y, scale_x = shape[0] / sensor_shape[0], shape[1] / sensor_shape[1]
+    top, bottom = int(np.floor(roi[0][0] * scale_y)), int(np.ceil(roi[0][1] * scale_y))
+    left, right = int(np.floor(roi[1][0] * scale_x)), int(np.ceil(roi[1][1] * scale_x))
+    return [[max(top, 0), min(max(bottom, top + 1), shape[0])], [max(left, 0), min(max(right, left + 1), shape[1])]]
+
+# narrowest [first, last) range of profile holding every entry of at least fraction of its maximum
+def narrowest_band(profile, fraction=CALIBRATION_PROFILE_FRACTION):
+    strong = np.flatnonzero(profile >= fraction * profile.max())
+    return int(strong[0]), int(strong[-1]) + 1
+
+# find the ROI of the corruption band of a movie from a sample of its frames (see CALIBRATION_FRAMES)
+# returns None when none of the sampled frames carries artefacts
+def calibrate_roi(movie, num_frames=CALIBRATION_FRAMES, pixel_stride=CALIBRATION_PIXEL_STRIDE,
+                  min_fraction=CALIBRATION_MIN_FRACTION, min_hits=CALIBRATION_MIN_HITS, fraction=CALIBRATION_PROFILE_FRACTION):
+    total_frames = movie.timing.num_samples
+    shape = movie_shape(movie)
+    frames = []
+    for index in np.unique(np.linspace(0, total_frames - 1, min(num_frames, total_frames)).astype(int)):
+        try:
+            frame = movie.get_frame_data(int(index))[::pixel_stride, ::pixel_stride]
+        except Exception:
+            continue
+        # dropped frames read as constant zeros and cannot be normalized
+        if frame.max() > frame.min():
+            frames.append(frame)
+    if len(frames) < 2:
+        return None
+    frames = normalize_block(np.stack(frames))
+    artefacts = (frames == 0) | (frames >= 241)
+    counts = np.count_nonzero(artefacts, axis=(1, 2))
+    corrupt = counts - np.median(counts) > min_fraction * artefacts[0].size
+    if not corrupt.any():
+        return None
+    baseline = artefacts[~corrupt].mean(axis=0) if (~corrupt).any() else 0
+    band = (artefacts[corrupt].mean(axis=0) - baseline) >= min_hits
+    if not band.any():
+        return None
+    top, bottom = narrowest_band(band.sum(axis=1), fraction)
+    left, right = narrowest_band(band.sum(axis=0), fraction)
+    return [[top * pixel_stride, min(bottom * pixel_stride, shape[0])],
+            [left * pixel_stride, min(right * pixel_stride, shape[1])]]
+
+def geometry_key(shape):
+    return f'{shape[0]}x{shape[1]}'
+
+def read_roi_cache(cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# the movies of a folder are processed in parallel, each process writes through its own temporary file
+def write_roi_cache(cache_file, cache):
+    tmp_path = f'{cache_file}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=4)
+    os.replace(tmp_path, cache_file)
+
+# detector configuration for run_process and process_isxd
+# roi None calibrates the corruption band once per sensor geometry (see calibrate_roi), the result is cached in
+# roi_cache_file (ROI_CACHE_NAME next to the movies when None), thresholds None estimates them for every movie
+class CorruptFrameConfig(object):
+    def __init__(self, roi=None, thresholds=None, num_processes=NUM_PROCESSES, scan_mode='block',
+                 block_size=BLOCK_SIZE, chunk_size=CHUNK_SIZE, prefetch_depth=PREFETCH_DEPTH, test_n=30,
+                 padding_fraction=0.001, use_sidecar=True, stride=COARSE_STRIDE, pixel_stride=PIXEL_STRIDE,
+                 roi_cache_file=None, calibration_frames=CALIBRATION_FRAMES):
+        self.roi = roi
+        self.thresholds = thresholds
+        self.num_processes = num_processes
+        self.scan_mode = scan_mode
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+        self.prefetch_depth = prefetch_depth
+        self.test_n = test_n
+        self.padding_fraction = padding_fraction
+        self.use_sidecar = use_sidecar
+        self.stride = stride
+        self.pixel_stride = pixel_stride
+        self.roi_cache_file = roi_cache_file
+        self.calibration_frames = calibration_frames
+
+    # keyword arguments of detect_corrupt_frames
+    def detector_kwargs(self):
+        return {'scan_mode': self.scan_mode, 'block_size': self.block_size, 'chunk_size': self.chunk_size,
+                'test_n': self.test_n, 'padding_fraction': self.padding_fraction, 'thresholds': self.thresholds,
+                'use_sidecar': self.use_sidecar, 'stride': self.stride, 'pixel_stride': self.pixel_stride,
+                'prefetch_depth': self.prefetch_depth}
+
+# ROI to scan in a movie: the configured one, the cached calibration for its frame size, or a new calibration
+# movies without artefacts to calibrate on get DEFAULT_ROI scaled to their frame size, the outcome is kept in their
+# sidecar (see read_sidecar) so they are only calibrated again once they change
+def get_roi(file_path, config):
+    if config.roi is not None:
+        return config.roi
+    movie = open_movie(file_path)
+    shape = movie_shape(movie)
+    key = geometry_key(shape)
+    cache_file = config.roi_cache_file or os.path.join(os.path.dirname(file_path), ROI_CACHE_NAME)
+    cache = read_roi_cache(cache_file)
+    if key in cache:
+        return cache[key]
+    entries = read_sidecar(file_path) if config.use_sidecar else {}
+    if NO_ARTEFACTS_KEY in entries and int(entries[NO_ARTEFACTS_KEY]) == config.calibration_frames:
+        return scaled_roi(shape)
+    roi = calibrate_roi(movie, num_frames=config.calibration_frames)
+    del movie
+    if roi is None:
+        roi = scaled_roi(shape)
+        print(f'No corruption artefacts found in {file_path} to calibrate the ROI, using {roi}')
+        if config.use_sidecar:
+            entries[NO_ARTEFACTS_KEY] = np.array(config.calibration_frames)
+            try:
+                write_sidecar(file_path, entries)
+            except OSError as e:
+                print(f'Could not write the calibration outcome for {file_path}: {e}')
+        return roi
+    print(f'Calibrated ROI for {key} frames: {roi}')
+    cache[key] = roi
+    try:
+        write_roi_cache(cache_file, cache)
+    except OSError as e:
+        print(f'Could not write the calibrated ROI to {cache_file}: {e}')
+    return roi
 
-def run_process(root_directory):
+# every file is measured (see StepTimer) into the run timings of its folder, run_id groups the files of one run
+def process_isxd(file_path, config=None, pool=None, run_id=None):
+    config = config or CorruptFrameConfig()
+    with StepTimer(os.path.dirname(os.path.abspath(file_path)), 'remove_corrupt_frames', os.path.basename(file_path),
+                   'day', [file_path], run_id) as timer:
+        try:
+            roi = get_roi(file_path, config)
+        except Exception as e:
+            print(f"Invalid inscopix file: {e}")
+            timer.finish(status='failed')
+            return
+        report = detect_corrupt_frames(file_path, pool=pool, roi=roi, **config.detector_kwargs())
+        if report is None:
+            timer.finish(status='failed')
+            return
+        write_report(file_path, report)
+        final_segments = report['segments']
+        if len(final_segments):
+            print('\n', final_segments)
+            print('Trim started...')
+            output_path = file_path.replace('.isxd', '_processed.isxd')
+            # copy only the kept frames natively, isx handles the files the native reader cannot parse
+            try:
+                trim_isxd(file_path, output_path, final_segments)
+            except (ValueError, KeyError):
+                isx.trim_movie(file_path, output_path, final_segments)
+            timer.finish([output_path, report_path(file_path)])
+        else:
+            print(f"No dropped frames in {file_path}")
+            timer.finish([report_path(file_path)])
+
+# files are processed one after the other, each one split across all processes of the pool
+# the run is measured as a whole and per file, root_directory/run_report.json and .csv are rewritten at the end
+def run_process(root_directory, config=None):
+    config = config or CorruptFrameConfig()
     file_paths = glob.glob(os.path.join(root_directory,'*.isxd'))
     file_paths = [fp for fp in file_paths if '_processed' not in fp]
     file_paths = [fp for fp in file_paths if not os.path.exists(fp.replace('.isxd', '_processed.isxd'))]
     print(f"{len(file_paths)} {'file' if len(file_paths)==1 else 'files'} found!!")
-    processes = []
-    # process_isxd(file_paths[0])
-    with multiprocessing.Pool(processes=NUM_PROCESSES) as p:
-        p.map(process_isxd,file_paths)
+    run_id = new_run_id()
+    try:
+        with StepTimer(root_directory, 'remove_corrupt_frames', inputs=file_paths, run_id=run_id) as timer:
+            with multiprocessing.get_context(START_METHOD).Pool(processes=config.num_processes) as p:
+                for file_path in file_paths:
+                    process_isxd(file_path, config=config, pool=p, run_id=run_id)
+            timer.finish([fp.replace('.isxd', '_processed.isxd') for fp in file_paths] +
+                         [report_path(fp) for fp in file_paths])
+    finally:
+        try:
+            write_run_report(root_directory)
+        except OSError as e:
+            print(f'Could not write the run report: {e}')
 
 # if __name__ == "__main__":
 #     run_process(r"F:\drop_frame_gui")
@@ -1,138 +1,212 @@
 import os
 import isx
+import numpy as np
 import pandas as pd
-from src.backend.process import Process
+from src.backend.process import Process, timed_step
+from src.backend.isxd import project_movies
+from src.backend.fused import FusedPipeline, FUSED_BLOCK_SIZE
+from src.backend.spiketable import vertical_alignment, spike_path, DEFAULT_SPIKE_FORMATS
 import textwrap  # to format multiline string message
 import shutil  # to move files
 #from functools import partial  # modify function default parameters
 
 class Timeseries(Process):
-    def __init__(self, data_dir, output_folder_name, mouse):
-        super().__init__(data_dir, output_folder_name, mouse)
+    # files read and written by every step, as names of the per-day file lists of Process (see StepScheduler)
+    step_io = {
+        'preprocess': {'inputs': ['rec_dir_series'], 'outputs': ['pp_files_series']},
+        'bandpass_filter': {'inputs': ['pp_files_series'], 'outputs': ['bp_files_series']},
+        'mean_projection_frame': {'inputs': ['bp_files_series'], 'outputs': ['mean_proj_files']},
+        'motion_correct': {'inputs': ['bp_files_series', 'mean_proj_files'],
+                           'outputs': ['mc_files_series', 'crop_rect_files']},
+        # replaces the four steps above without writing the -PP and -PP-BP movies
+        'fused_motion_correct': {'inputs': ['rec_dir_series'],
+                                 'outputs': ['mc_files_series', 'mean_proj_files', 'crop_rect_files']},
+        'cnmfe_apply': {'inputs': ['mc_files_series'], 'outputs': ['cnmfe_files_series']},
+        'export_cell_set_to_tiff': {'inputs': ['cnmfe_files_series'], 'outputs': ['cnmfe_csv']},
+        # the cell sets are rewritten by auto classification, readers in other schedulers have to wait for it too
+        'event_detection_auto_classification': {'inputs': ['cnmfe_files_series'],
+                                                'outputs': ['cnmfe_eventfiles_series', 'cnmfe_files_series']},
+        # auto classification rewrites the cell set that deconvolution reads
+        'deconvolve_cells': {'inputs': ['cnmfe_files_series'], 'outputs': ['cnmfe_spike_event_series'],
+                             'after': ['event_detection_auto_classification']},
+        'export_spike_events_to_csv': {'inputs': ['cnmfe_spike_event_series'], 'outputs': ['cnmfe_spike_event_csvs']},
+        'vertical_csv_alignment': {'inputs': ['cnmfe_spike_event_csvs'], 'outputs': ['timeseries_events']},
+    }
+
+    # day_workers > 1 runs the days of every stage in parallel processes (see Process.run_days)
+    # scratch_dir and retention place and clean up the intermediate movies, spike_formats are the files of the spike
+    # tables (see Process)
+    def __init__(self, data_dir, output_folder_name, mouse, day_workers=1, scratch_dir=None, retention='all',
+                 spike_formats=DEFAULT_SPIKE_FORMATS):
+        super().__init__(data_dir, output_folder_name, mouse, day_workers=day_workers, scratch_dir=scratch_dir,
+                         retention=retention, spike_formats=spike_formats)
 
     # perform preprocessing and output --PP.ixsd files
+    @timed_step
     def preprocess(self, tp_downsampling, sp_downsampling):
         print('Preprocessing, please wait...\n')
-        try:
-            for day_i, day_label in enumerate(self.day_labels):
-                if not self.check_all_recordings_processed(self.pp_files_series, day_i):
-                    isx.preprocess(
-                        input_movie_files= self.rec_dir_json[day_i],  # one series per loop
-                        output_movie_files= self.pp_files_json[day_i], 
-                        temporal_downsample_factor=tp_downsampling,
-                        spatial_downsample_factor=sp_downsampling,
-                        crop_rect=None,
-                        fix_defective_pixels=True,
-                        trim_early_frames=True)
-                    print('{} preprocessing completed'.format(day_label))
-        except Exception as e:
-            print(f'Error: {e}')
+        return self.run_days('preprocessing', self.preprocess_day, tp_downsampling, sp_downsampling)
 
+    # every day step runs through the step cache: it is skipped when its inputs and parameters did not change
+    def preprocess_day(self, day_i, day_label, tp_downsampling, sp_downsampling):
+        params = dict(temporal_downsample_factor=tp_downsampling,
+                      spatial_downsample_factor=sp_downsampling,
+                      crop_rect=None,
+                      fix_defective_pixels=True,
+                      trim_early_frames=True)
+        if self.cached_step('preprocess', day_label, self.rec_dir_json[day_i], self.pp_files_json[day_i], params,
+                            lambda staged: isx.preprocess(
+                                input_movie_files= self.rec_dir_json[day_i],  # one series per loop
+                                output_movie_files= staged(self.pp_files_json[day_i]),
+                                **params)) == 'ran':
+            print('{} preprocessing completed'.format(day_label))
 
     # Perform spatial bandpass filtering with default values.
+    @timed_step
     def bandpass_filter(self):
         print('Applying bandpass filter, please wait...\n')
-        try:
-            for day_i, day_label in enumerate(self.day_labels):
-                if not self.check_all_recordings_processed(self.bp_files_series, day_i):
-                    isx.spatial_filter(
-                    input_movie_files= self.pp_files_json[day_i],
-                    output_movie_files=self.bp_files_json[day_i],
-                    low_cutoff=0.005,
-                    high_cutoff=0.5,
-                    retain_mean=False,
-                    # leave subtract_global_minimum setting as true
-                    # for correct dff display
-                    subtract_global_minimum=True)
+        return self.run_days('bandpass filtering', self.bandpass_filter_day)
+
+    def bandpass_filter_day(self, day_i, day_label):
+        params = dict(low_cutoff=0.005,
+                      high_cutoff=0.5,
+                      retain_mean=False,
+                      # leave subtract_global_minimum setting as true
+                      # for correct dff display
+                      subtract_global_minimum=True)
+        if self.cached_step('bandpass_filter', day_label, self.pp_files_json[day_i], self.bp_files_json[day_i], params,
+                            lambda staged: isx.spatial_filter(
+                                input_movie_files= self.pp_files_json[day_i],
+                                output_movie_files=staged(self.bp_files_json[day_i]),
+                                **params)) == 'ran':
             print('{} bandpass filtering completed'.format(day_label))
-        except Exception as e:
-            print(f'Error: {e}')
-        
 
     # use the mean frame as a reference to apply motion correction.    
-    def mean_projection_frame(self):
-        try:
-            for day_i, (day_label, mean_proj_file) in enumerate(zip(self.day_labels, self.mean_proj_files)):
-                if not os.path.exists(os.path.join(str(self.output_dir), f'{day_label}-mean_image.isxd')):
-                    isx.project_movie(
-                        input_movie_files=self.bp_files_json[day_i],
-                        output_image_file=mean_proj_file,
-                        stat_type='mean')  # types: 'mean', 'min', or 'max'
-                    message = """
-                        {} temporal projection completed.
-                        A new file has been generated and will be used
-                        as a reference frame for motion correction
-                    """.format(day_label)
-                print(textwrap.dedent(message))
-        except Exception as e:
-            print(f'Error:{e}')
-
-    # use for loop to apply motion correction one series at a time
+    # with native_reader the projection is computed from memory-mapped frames instead of isx.project_movie
+    @timed_step
+    def mean_projection_frame(self, native_reader=False):
+        return self.run_days('mean projection', self.mean_projection_frame_day, native_reader)
+
+    def mean_projection_frame_day(self, day_i, day_label, native_reader=False):
+        mean_proj_file = self.mean_proj_files[day_i]
+
+        def project(staged):
+            if native_reader:
+                spacing = isx.Movie.read(self.bp_files_json[day_i][0]).spacing
+                isx.Image.write(staged(mean_proj_file), spacing, np.float32,
+                                project_movies(self.bp_files_json[day_i], stat_type='mean'))
+            else:
+                isx.project_movie(
+                    input_movie_files=self.bp_files_json[day_i],
+                    output_image_file=staged(mean_proj_file),
+                    stat_type='mean')  # types: 'mean', 'min', or 'max'
+
+        # both readers compute the same image, the reader is not part of the cache key
+        if self.cached_step('mean_projection_frame', day_label, self.bp_files_json[day_i], [mean_proj_file],
+                            {'stat_type': 'mean'}, project) == 'ran':
+            message = """
+                {} temporal projection completed.
+                A new file has been generated and will be used
+                as a reference frame for motion correction
+            """.format(day_label)
+            print(textwrap.dedent(message))
+
+    # apply motion correction to every series, one day per worker
+    @timed_step
     def motion_correct(self):
         print('Applying motion correction. Please wait...\n')
-        try:
-            for day_i, (day_label, mean_proj_file) in enumerate(zip(self.day_labels, self.mean_proj_files)):
-                #mc_files_json = self.write_read_json('mc_files_series.json', self.mc_files_series)
-                #bp_files_json = self.read_json('bp_files_series.json')
-                if not self.check_all_recordings_processed(self.mc_files_series, day_i):
-                    isx.motion_correct(
-                        input_movie_files=self.bp_files_json[day_i],
-                        output_movie_files=self.mc_files_json[day_i],
-                        max_translation=20,
-                        low_bandpass_cutoff=None,
-                        high_bandpass_cutoff=None,
-                        roi=None,
-                        # use movie and frame index to set a fixed frame as reference
-                        # turned off if set to 0
-                        reference_segment_index=0,
-                        reference_frame_index=0,
-                        # use the mean projection file generated in the previous step
-                        # as a reference frame for motion correction
-                        reference_file_name=mean_proj_file,
-                        global_registration_weight=1.0,
-                        output_translation_files= None,
-                        #output_translation_files= self.translation_files[day_i],
-                        output_crop_rect_file= self.crop_rect_files[day_i])
+        return self.run_days('motion correction', self.motion_correct_day)
+
+    def motion_correct_day(self, day_i, day_label):
+        params = dict(max_translation=20,
+                      low_bandpass_cutoff=None,
+                      high_bandpass_cutoff=None,
+                      roi=None,
+                      # use movie and frame index to set a fixed frame as reference
+                      # turned off if set to 0
+                      reference_segment_index=0,
+                      reference_frame_index=0,
+                      global_registration_weight=1.0,
+                      output_translation_files= None)
+                      #output_translation_files= self.translation_files[day_i],
+        # use the mean projection file generated in the previous step
+        # as a reference frame for motion correction
+        inputs = self.bp_files_json[day_i] + [self.mean_proj_files[day_i]]
+        outputs = self.mc_files_json[day_i] + [self.crop_rect_files[day_i]]
+        if self.cached_step('motion_correct', day_label, inputs, outputs, params,
+                            lambda staged: isx.motion_correct(
+                                input_movie_files=self.bp_files_json[day_i],
+                                output_movie_files=staged(self.mc_files_json[day_i]),
+                                reference_file_name=self.mean_proj_files[day_i],
+                                output_crop_rect_file= staged(self.crop_rect_files[day_i]),
+                                **params)) == 'ran':
             print('{} motion correction completed'.format(day_label))
-        except Exception as e:
-            print(f'Error:{e}')
+
+    # preprocess, bandpass filter and motion correct in one pass over the frames (see fused.py), with the settings of
+    # the separate steps. Only the -PP-BP-MC movies, the mean projection and the crop rectangle are written, block_size
+    # input frames are held in memory at a time
+    @timed_step
+    def fused_motion_correct(self, tp_downsampling, sp_downsampling, block_size=FUSED_BLOCK_SIZE):
+        print('Preprocessing, filtering and motion correcting, please wait...\n')
+        return self.run_days('fused motion correction', self.fused_motion_correct_day, tp_downsampling,
+                             sp_downsampling, block_size)
+
+    def fused_motion_correct_day(self, day_i, day_label, tp_downsampling, sp_downsampling,
+                                 block_size=FUSED_BLOCK_SIZE):
+        pipeline = FusedPipeline(temporal_downsample_factor=tp_downsampling,
+                                 spatial_downsample_factor=sp_downsampling,
+                                 max_translation=20,
+                                 block_size=block_size)
+        outputs = self.mc_files_json[day_i] + [self.mean_proj_files[day_i], self.crop_rect_files[day_i]]
+
+        def correct(staged):
+            mean_image, (top, left, bottom, right) = pipeline.run(self.rec_dir_json[day_i],
+                                                                 staged(self.mc_files_json[day_i]))
+            spacing = isx.Movie.read(staged(self.mc_files_json[day_i][0])).spacing
+            isx.Image.write(staged(self.mean_proj_files[day_i]), spacing, np.float32, mean_image)
+            pd.DataFrame([[top, left, bottom, right]], columns=['top', 'left', 'bottom', 'right']).to_csv(
+                staged(self.crop_rect_files[day_i]), index=False)
+
+        if self.cached_step('fused_motion_correct', day_label, self.rec_dir_json[day_i], outputs, pipeline.params(),
+                            correct) == 'ran':
+            print('{} preprocessing, bandpass filtering and motion correction completed'.format(day_label))
 
     # algorithm applies to concatenated movies, every recording has same cellmaps 
     # adjust cell_diameter, min_pnr, and min_corr values as needed 
+    @timed_step
     def cnmfe_apply(self, cell_diameter):
         print('Applying CNMFe algorihm to detect cells, please wait...\n')
-        try:
-            export_path = os.path.join(self.output_dir, 'cnmfe_tmp')
-            if not os.path.exists(export_path):
-            # make cnmfe subfolder to store temporal files including concatenated TIFFs
-                os.mkdir(export_path)
-                # use motion corrected movie series as input and do not use df/f0 movie
-                # since the background info will be used for noise estimation
-            for day_i, day_label in enumerate(self.day_labels):
-                if not self.check_all_recordings_processed(self.cnmfe_files_series, day_i):
-                    isx.run_cnmfe(
-                        input_movie_files=self.mc_files_json[day_i],
-                        output_cell_set_files=self.cnmfe_files_json[day_i],
-                        output_dir=str(export_path),
-                        cell_diameter= cell_diameter,
-                        min_corr=0.8,
-                        min_pnr=10,
-                        bg_spatial_subsampling=2,
-                        ring_size_factor=1.4,
-                        gaussian_kernel_size=1,
-                        closing_kernel_size=1,
-                        merge_threshold=0.7,
-                        processing_mode='parallel_patches',
-                        num_threads=4,
-                        patch_size=80,
-                        patch_overlap=20,
-                        output_unit_type='df_over_noise')
-                    message = """
-                        {} CNMFe cell detection completed. A few temporary files
-                        have been generated in the cnmfe_tmp subfolder\n""".format(day_label)
-                    print(textwrap.dedent(message))
-        except Exception as e:
-            print(f'Error:{e}')
+        return self.run_days('CNMFe', self.cnmfe_apply_day, cell_diameter)
+
+    def cnmfe_apply_day(self, day_i, day_label, cell_diameter):
+        export_path = os.path.join(self.output_dir, 'cnmfe_tmp')
+        # make cnmfe subfolder to store temporal files including concatenated TIFFs
+        os.makedirs(export_path, exist_ok=True)
+        # use motion corrected movie series as input and do not use df/f0 movie
+        # since the background info will be used for noise estimation
+        params = dict(cell_diameter= cell_diameter,
+                      min_corr=0.8,
+                      min_pnr=10,
+                      bg_spatial_subsampling=2,
+                      ring_size_factor=1.4,
+                      gaussian_kernel_size=1,
+                      closing_kernel_size=1,
+                      merge_threshold=0.7,
+                      processing_mode='parallel_patches',
+                      num_threads=4,
+                      patch_size=80,
+                      patch_overlap=20,
+                      output_unit_type='df_over_noise')
+        if self.cached_step('cnmfe_apply', day_label, self.mc_files_json[day_i], self.cnmfe_files_json[day_i], params,
+                            lambda staged: isx.run_cnmfe(
+                                input_movie_files=self.mc_files_json[day_i],
+                                output_cell_set_files=staged(self.cnmfe_files_json[day_i]),
+                                output_dir=str(export_path),
+                                **params)) == 'ran':
+            message = """
+                {} CNMFe cell detection completed. A few temporary files
+                have been generated in the cnmfe_tmp subfolder\n""".format(day_label)
+            print(textwrap.dedent(message))
 
     def move_files(self, source, destination, file_ending):
         """
@@ -155,100 +229,111 @@ class Timeseries(Process):
 
     # export csv file for all cell traces
     # export multiple cell maps, one tiff image for each cell
+    # the tiffs of every day are moved to the cnmfe_tiff subfolder once they are exported
+    @timed_step
     def export_cell_set_to_tiff(self):
-        try:
-            for day_i in len(range(self.day_labels)):   
-                if not os.path.exists(self.cnmfe_csv[day_i]):
-                    isx.export_cell_set_to_csv_tiff(
-                        input_cell_set_files=self.cnmfe_files_series[day_i],
-                        output_csv_file=self.cnmfe_csv[day_i],
-                        output_tiff_file=self.cnmfe_tiff[day_i],
-                        time_ref='start',
-                        output_props_file='')
-                    print("Export completed. Tiff files were stored in the tiff subfolder")
-            tiff_source = self.output_dir
-            tiff_destination = os.path.join(self.output_dir,"cnmfe_tiff")
-            self.move_files(tiff_source, tiff_destination, '.tiff')
-        except Exception as e:
-            print(f'Error:{e}')
-        
+        return self.run_days('cell set export', self.export_cell_set_to_tiff_day)
+
+    def export_cell_set_to_tiff_day(self, day_i, day_label):
+        def export(staged):
+            isx.export_cell_set_to_csv_tiff(
+                input_cell_set_files=self.cnmfe_files_series[day_i],
+                output_csv_file=staged(self.cnmfe_csv[day_i]),
+                output_tiff_file=staged(self.cnmfe_tiff[day_i]),
+                time_ref='start',
+                output_props_file='')
+            tiff_destination = os.path.join(self.output_dir, "cnmfe_tiff")
+            os.makedirs(tiff_destination, exist_ok=True)
+            tiff_prefix = os.path.splitext(os.path.basename(self.cnmfe_tiff[day_i]))[0]
+            staging_dir = os.path.dirname(staged(self.cnmfe_tiff[day_i]))
+            for file in os.listdir(staging_dir):
+                if file.startswith(tiff_prefix) and file.endswith('.tiff'):
+                    os.replace(os.path.join(staging_dir, file), os.path.join(tiff_destination, file))
+
+        if self.cached_step('export_cell_set_to_tiff', day_label, self.cnmfe_files_series[day_i], [self.cnmfe_csv[day_i]],
+                            {'time_ref': 'start'}, export) == 'ran':
+            print("Export completed. Tiff files were stored in the tiff subfolder")
 
     # output event files
+    @timed_step
     def event_detection_auto_classification(self):
-        try:
-            # Run event detection on the CNMFe cell sets.
-            print('Applying auto classification. Please wait...\n')
-            for day_i, day_label in enumerate(self.day_labels):
-                if not self.check_all_recordings_processed(self.cnmfe_eventfiles_series, day_i):
-                    isx.event_detection(
-                        input_cell_set_files=self.cnmfe_files_json[day_i],
-                        output_event_set_files=self.cnmfe_events_json[day_i],
-                        threshold=5,  # sigma threshold
-                        tau=0.2,  # default is 200ms for Gcamp6f
-                        event_time_ref='beginning',  # export other timing separately
-                        ignore_negative_transients=True,
-                        accepted_cells_only=False)
-                    print('Event detection completed for {}'.format(day_label))
-                    # make name for event filter
-                    events_filters = [('SNR', '>', 3), ('Event Rate', '>', 0), ('Cell Size', '>', 0)]
-                    isx.auto_accept_reject(input_cell_set_files=self.cnmfe_files_json[day_i],
-                                    input_event_set_files= self.cnmfe_events_json[day_i],
-                                    filters=events_filters)
-                    print('Auto classification completed. The cnmfe cellset has been updated.')
-        except Exception as e:
-            print(f'Error:{e}')
+        # Run event detection on the CNMFe cell sets.
+        print('Applying auto classification. Please wait...\n')
+        return self.run_days('event detection', self.event_detection_auto_classification_day)
+
+    def event_detection_auto_classification_day(self, day_i, day_label):
+        params = dict(threshold=5,  # sigma threshold
+                      tau=0.2,  # default is 200ms for Gcamp6f
+                      event_time_ref='beginning',  # export other timing separately
+                      ignore_negative_transients=True,
+                      accepted_cells_only=False)
+        # make name for event filter
+        events_filters = [('SNR', '>', 3), ('Event Rate', '>', 0), ('Cell Size', '>', 0)]
+
+        def detect(staged):
+            isx.event_detection(
+                input_cell_set_files=self.cnmfe_files_json[day_i],
+                output_event_set_files=staged(self.cnmfe_events_json[day_i]),
+                **params)
+            print('Event detection completed for {}'.format(day_label))
+            # classifies a staged copy of the cell sets, they are replaced once both calls succeeded
+            isx.auto_accept_reject(input_cell_set_files=staged(self.cnmfe_files_json[day_i]),
+                            input_event_set_files= staged(self.cnmfe_events_json[day_i]),
+                            filters=events_filters)
+            print('Auto classification completed. The cnmfe cellset has been updated.')
+
+        # auto classification updates the cell sets in place
+        self.cached_step('event_detection_auto_classification', day_label, self.cnmfe_files_json[day_i],
+                         self.cnmfe_events_json[day_i], dict(params, filters=events_filters), detect,
+                         modified=self.cnmfe_files_json[day_i])
 
     # output spikes 
+    @timed_step
     def deconvolve_cells(self, snr_threshold):
-        try:
-            print('Deconvolving...')
-            for day_i, day_label in enumerate(self.day_labels):
-                if not self.check_all_recordings_processed(self.cnmfe_spike_event_series, day_i):
-                    isx.deconvolve_cellset(
-                        input_raw_cellset_files= self.cnmfe_files_json[day_i], 
-                        output_spike_eventset_files= self.cnmfe_spikes_json[day_i], 
-                        accepted_only= False,
-                        spike_snr_threshold= snr_threshold
-                    )
-                    print(f'Deconvolution completeted for {day_label}')
-                else:
-                    print(f'{day_label} already processed!')
-        except Exception as e:
-            print(f'Error:{e}')
+        print('Deconvolving...')
+        return self.run_days('deconvolution', self.deconvolve_cells_day, snr_threshold)
+
+    def deconvolve_cells_day(self, day_i, day_label, snr_threshold):
+        params = dict(accepted_only= False,
+                      spike_snr_threshold= snr_threshold)
+        if self.cached_step('deconvolve_cells', day_label, self.cnmfe_files_json[day_i], self.cnmfe_spikes_json[day_i],
+                            params,
+                            lambda staged: isx.deconvolve_cellset(
+                                input_raw_cellset_files= self.cnmfe_files_json[day_i],
+                                output_spike_eventset_files= staged(self.cnmfe_spikes_json[day_i]),
+                                **params)) == 'ran':
+            print(f'Deconvolution completeted for {day_label}')
 
     # export spike to cellset csv
+    @timed_step
     def export_spike_events_to_csv(self): 
-        try:
-            print('Exporting spikes to CSV...')
-            for day_i, day_label in enumerate(self.day_labels):
-                if not os.path.exists(self.cnmfe_spike_event_csvs[day_i]):
-                    isx.export_event_set_to_csv(
-                        input_event_set_files = self.cnmfe_spikes_json[day_i],
-                        output_csv_file = self.cnmfe_spike_event_csvs[day_i],
-                        time_ref= 'unix'
-                    ) 
-                    print('Event detection completed for {}'.format(day_label))
-        except Exception as e:
-            print(f'Error:{e}')
+        print('Exporting spikes to CSV...')
+        return self.run_days('spike export', self.export_spike_events_to_csv_day)
+
+    def export_spike_events_to_csv_day(self, day_i, day_label):
+        if self.cached_step('export_spike_events_to_csv', day_label, self.cnmfe_spikes_json[day_i],
+                            [self.cnmfe_spike_event_csvs[day_i]], {'time_ref': 'unix'},
+                            lambda staged: isx.export_event_set_to_csv(
+                                input_event_set_files = self.cnmfe_spikes_json[day_i],
+                                output_csv_file = staged(self.cnmfe_spike_event_csvs[day_i]),
+                                time_ref= 'unix')) == 'ran':
+            print('Event detection completed for {}'.format(day_label))
 
 # input cellset with each cell as col and output new csv with time of spike, cell, and value as cols 
-    def vertical_csv_alignment(self):
-        try:
-            print('Realigning CSV...')
-            for day_i in range(len(self.day_labels)):
-                if not os.path.exists(self.timeseries_events[day_i]):
-                    data = []
-                    df = pd.read_csv(self.cnmfe_spike_event_csvs[day_i])
-                    for row in range(2, len(df)):
-                        at_time = df.loc[row]
-                        row_len = at_time.size
-                        for col in range(1, row_len):
-                            if at_time[col] > 0:
-                                if df.loc[row]['Time (s)'] != 0:
-                                    new_row = [df.loc[row]['Time (s)'], df.columns[col], df.loc[row][col]]
-                                    data.append(new_row)
-                    new_df = pd.DataFrame(data, columns = ['Time (s)', ' Cell Name', 'Value']).sort_values(by=[' Cell Name', 'Time (s)'])
-                    output_path= self.timeseries_events[day_i]
-                    new_df.to_csv(output_path, index=False)
-        except Exception as e:
-            print(f'Error:{e}')
\ No newline at end of file
+# the events are picked from the whole table at once (see spiketable.wide_to_long), or chunk_rows rows at a time
+# with bounded memory for long sessions (by default for large CSVs, see spiketable.vertical_alignment), and written
+# in the spike_formats of the run
+    @timed_step
+    def vertical_csv_alignment(self, chunk_rows=None):
+        print('Realigning CSV...')
+        return self.run_days('CSV realignment', self.vertical_csv_alignment_day, chunk_rows)
+
+    # chunk_rows only bounds the memory used, the table written is the same so it is not part of the cache key
+    def vertical_csv_alignment_day(self, day_i, day_label, chunk_rows=None):
+        outputs = [spike_path(self.timeseries_events[day_i], spike_format) for spike_format in self.spike_formats]
+        if self.cached_step('vertical_csv_alignment', day_label, [self.cnmfe_spike_event_csvs[day_i]], outputs,
+                            {'formats': list(self.spike_formats)},
+                            lambda staged: vertical_alignment(self.cnmfe_spike_event_csvs[day_i],
+                                                              staged(self.timeseries_events[day_i]),
+                                                              chunk_rows=chunk_rows, formats=self.spike_formats)) == 'ran':
+            print(f'CSV realignment completed for {day_label}')
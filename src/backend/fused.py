@@ -0,0 +1,212 @@
+import numpy as np
+from fractions import Fraction
+from scipy import ndimage
+from src.backend.isxd import IsxdMovie, write_isxd
+from src.workutils.Prefetcher import iterate_blocks, block_ranges
+
+# Fused preprocessing: the recordings of a day are streamed block by block through defective pixel correction,
+# spatial and temporal downsampling, spatial bandpass filtering and rigid motion correction without writing the
+# -PP and -PP-BP movies. Only the motion corrected movies, the mean projection used as their reference and the crop
+# rectangle are written. The movies are read twice, once for the reference and once for the correction, the memory
+# used is bounded by the block size.
+# The stages are NumPy / SciPy versions of isx.preprocess, isx.spatial_filter and isx.motion_correct with their
+# settings in Timeseries, they are close to but not bit-identical with the isx results (no early frame trimming).
+
+# input frames per block, rounded up to a multiple of the temporal downsampling factor
+FUSED_BLOCK_SIZE = 32
+# a pixel is defective when it differs from the median of its 3x3 neighbourhood by more than this many robust
+# standard deviations of the frame
+DEFECT_THRESHOLD = 5.0
+
+# replace the pixels of a (frames, height, width) block that stand out from their neighbours by the local median
+def fix_defective_pixels(block, threshold=DEFECT_THRESHOLD):
+    median = ndimage.median_filter(block, size=(1, 3, 3), mode='nearest')
+    deviation = block - median
+    # median absolute deviation of each frame, scaled to a standard deviation
+    scale = 1.4826 * np.median(np.abs(deviation), axis=(1, 2), keepdims=True)
+    defective = np.abs(deviation) > threshold * np.maximum(scale, np.finfo(np.float32).eps)
+    block[defective] = median[defective]
+    return block
+
+# mean over factor x factor pixels, the rows and columns that do not fill a whole bin are dropped
+def downsample_spatial(block, factor):
+    if factor <= 1:
+        return block
+    frames, height, width = block.shape
+    height, width = height // factor * factor, width // factor * factor
+    binned = block[:, :height, :width].reshape(frames, height // factor, factor, width // factor, factor)
+    return binned.mean(axis=(2, 4), dtype=np.float32)
+
+# mean over groups of factor consecutive frames that only counts the stored ones (stored: bool per frame)
+# returns the downsampled frames of the groups with a stored frame and a bool per group telling which ones they are
+def downsample_temporal(block, stored, factor):
+    groups = -(-len(block) // factor)
+    padding = groups * factor - len(block)
+    if padding:
+        block = np.concatenate([block, np.zeros((padding,) + block.shape[1:], dtype=block.dtype)])
+        stored = np.concatenate([stored, np.zeros(padding, dtype=bool)])
+    weights = stored.reshape(groups, factor).astype(np.float32)
+    counts = weights.sum(axis=1)
+    kept = counts > 0
+    sums = np.einsum('gf,gfhw->ghw', weights[kept], block.reshape((groups, factor) + block.shape[1:])[kept])
+    return sums / counts[kept][:, None, None], kept
+
+# groups of factor frames of a movie that hold no stored frame, they are dropped frames of the downsampled movie
+def dropped_groups(stored, factor):
+    groups = -(-len(stored) // factor)
+    padded = np.zeros(groups * factor, dtype=bool)
+    padded[:len(stored)] = stored
+    return np.flatnonzero(~padded.reshape(groups, factor).any(axis=1)).tolist()
+
+# frequency response of the spatial bandpass for rfft2 frames of shape, cutoffs in cycles per pixel
+# a gaussian high pass at low_cutoff times a gaussian low pass at high_cutoff, the mean is removed unless retain_mean
+def bandpass_mask(shape, low_cutoff=0.005, high_cutoff=0.5, retain_mean=False):
+    fy = np.fft.fftfreq(shape[0])[:, None]
+    fx = np.fft.rfftfreq(shape[1])[None, :]
+    frequency = np.sqrt(fy ** 2 + fx ** 2)
+    mask = (1 - np.exp(-(frequency / low_cutoff) ** 2 / 2)) * np.exp(-(frequency / high_cutoff) ** 2 / 2)
+    if retain_mean:
+        mask[0, 0] = 1
+    return mask.astype(np.float32)
+
+def bandpass_filter(block, mask):
+    return np.fft.irfft2(np.fft.rfft2(block) * mask, s=block.shape[1:]).astype(np.float32)
+
+# rigid (dy, dx) translation of every frame of a block relative to reference by cross-correlation, limited to
+# max_translation pixels and refined to a fraction of pixel with a parabola through the correlation peak
+# the frames are already bandpass filtered so the correlation is not whitened, which keeps its peak smooth enough
+# for the parabola
+def estimate_shifts(block, reference, max_translation=20):
+    cross = np.fft.rfft2(block) * np.conj(np.fft.rfft2(reference))
+    correlation = np.fft.irfft2(cross, s=block.shape[1:])
+    height, width = block.shape[1:]
+    reach_y, reach_x = min(max_translation, height // 2 - 1), min(max_translation, width // 2 - 1)
+    # correlation around zero translation, with negative translations wrapped to the end of the axes
+    window = np.roll(correlation, (reach_y, reach_x), axis=(1, 2))[:, :2 * reach_y + 1, :2 * reach_x + 1]
+    peaks = window.reshape(len(block), -1).argmax(axis=1)
+    peak_y, peak_x = np.unravel_index(peaks, window.shape[1:])
+    shifts = np.empty((len(block), 2), dtype=np.float32)
+    for i, (y, x) in enumerate(zip(peak_y, peak_x)):
+        shifts[i] = (y - reach_y + subpixel_offset(window[i, y - 1:y + 2, x], y, window.shape[1]),
+                     x - reach_x + subpixel_offset(window[i, y, x - 1:x + 2], x, window.shape[2]))
+    return shifts
+
+def subpixel_offset(values, peak, size):
+    if peak == 0 or peak == size - 1:
+        return 0.0
+    curvature = values[0] - 2 * values[1] + values[2]
+    return 0.0 if curvature == 0 else float(np.clip(0.5 * (values[0] - values[2]) / curvature, -0.5, 0.5))
+
+# move every frame of a block by minus its shift so it lines up with the reference, uncovered pixels are zero
+def apply_shifts(block, shifts):
+    return np.stack([ndimage.shift(frame, -shift, order=1, mode='constant', cval=0.0)
+                     for frame, shift in zip(block, shifts)]).astype(np.float32)
+
+# region of the frames covered by every corrected frame, as (top, left, bottom, right) pixel indices
+def crop_rect(shifts, shape):
+    if not len(shifts):
+        return 0, 0, shape[0] - 1, shape[1] - 1
+    # frames moved down / right are corrected up / left and leave the bottom / right edge uncovered
+    # a twentieth of a pixel is within the estimation noise, it does not cost a row or a column
+    bottom, right = np.ceil(np.maximum(shifts.max(axis=0) - 0.05, 0)).astype(int)
+    top, left = np.ceil(np.maximum(-shifts.min(axis=0) - 0.05, 0)).astype(int)
+    return int(top), int(left), int(shape[0] - 1 - bottom), int(shape[1] - 1 - right)
+
+# the fused stages for one set of settings, named after the isx arguments they replace
+class FusedPipeline(object):
+    def __init__(self, temporal_downsample_factor=1, spatial_downsample_factor=1, fix_defective_pixels=True,
+                 low_cutoff=0.005, high_cutoff=0.5, retain_mean=False, subtract_global_minimum=True,
+                 max_translation=20, block_size=FUSED_BLOCK_SIZE, prefetch_depth=2):
+        self.temporal_factor = int(temporal_downsample_factor)
+        self.spatial_factor = int(spatial_downsample_factor)
+        self.fix_defects = fix_defective_pixels
+        self.low_cutoff = low_cutoff
+        self.high_cutoff = high_cutoff
+        self.retain_mean = retain_mean
+        self.subtract_global_minimum = subtract_global_minimum
+        self.max_translation = max_translation
+        self.block_size = -(-int(block_size) // self.temporal_factor) * self.temporal_factor
+        self.prefetch_depth = prefetch_depth
+        self.stats = {}
+
+    # settings that change the outputs, for the step cache
+    def params(self):
+        return {key: value for key, value in vars(self).items() if key not in ('block_size', 'prefetch_depth', 'stats')}
+
+    # preprocessed and bandpass filtered frames of a movie, one block at a time
+    def filtered_blocks(self, movie):
+        read_block = lambda start, stop: (np.array(movie.get_frames(start, stop), dtype=np.float32),
+                                          movie.stored[start:stop].copy())
+        mask = None
+        for _, _, (block, stored) in iterate_blocks(read_block, block_ranges(0, len(movie), self.block_size),
+                                                    depth=self.prefetch_depth, stats=self.stats):
+            if self.fix_defects:
+                block = fix_defective_pixels(block)
+            block, _ = downsample_temporal(downsample_spatial(block, self.spatial_factor), stored, self.temporal_factor)
+            if not len(block):
+                continue
+            if mask is None:
+                mask = bandpass_mask(block.shape[1:], self.low_cutoff, self.high_cutoff, self.retain_mean)
+            yield bandpass_filter(block, mask)
+
+    # first pass: global minimum of every filtered movie and their mean frame after subtracting it
+    def reference(self, file_paths):
+        minimums = []
+        total = None
+        count = 0
+        for file_path in file_paths:
+            with IsxdMovie(file_path) as movie:
+                movie_total = None
+                movie_min = np.inf
+                movie_count = 0
+                for block in self.filtered_blocks(movie):
+                    block_sum = block.sum(axis=0, dtype=np.float64)
+                    movie_total = block_sum if movie_total is None else movie_total + block_sum
+                    movie_min = min(movie_min, float(block.min()))
+                    movie_count += len(block)
+            if not movie_count:
+                raise ValueError(f'{file_path} has no stored frames')
+            minimum = movie_min if self.subtract_global_minimum else 0.0
+            minimums.append(minimum)
+            total = movie_total - minimum * movie_count if total is None else total + movie_total - minimum * movie_count
+            count += movie_count
+        return (total / count).astype(np.float32), minimums
+
+    # motion corrected movie of one recording, written to output_file, returns the shifts of its frames
+    def correct_movie(self, file_path, output_file, reference, minimum):
+        with IsxdMovie(file_path) as movie:
+            period = Fraction(movie.header['timingInfo']['period']['num'], movie.header['timingInfo']['period']['den'])
+            pixel_size = {axis: {'num': size['num'] * self.spatial_factor, 'den': size['den']}
+                          for axis, size in movie.header['spacingInfo']['pixelSize'].items()}
+            corrected = CorrectedFrames(self, movie, reference, minimum)
+            write_isxd(output_file, corrected, dropped=dropped_groups(movie.stored, self.temporal_factor),
+                       period=period * self.temporal_factor, start=movie.header['timingInfo']['start'],
+                       pixel_size=pixel_size)
+        return np.concatenate(corrected.shifts) if corrected.shifts else np.empty((0, 2), dtype=np.float32)
+
+    # both passes for the recordings of a day, returns the mean projection and the crop rectangle
+    def run(self, input_files, output_files):
+        reference, minimums = self.reference(input_files)
+        shifts = [self.correct_movie(input_file, output_file, reference, minimum)
+                  for input_file, output_file, minimum in zip(input_files, output_files, minimums)]
+        return reference, crop_rect(np.concatenate(shifts), reference.shape)
+
+# lazy (frames, height, width) float32 movie of the corrected frames of a recording for write_isxd
+class CorrectedFrames(object):
+    def __init__(self, pipeline, movie, reference, minimum):
+        self.pipeline = pipeline
+        self.movie = movie
+        self.reference = reference
+        self.minimum = minimum
+        num_frames = -(-len(movie) // pipeline.temporal_factor) - \
+            len(dropped_groups(movie.stored, pipeline.temporal_factor))
+        self.shape = (num_frames,) + reference.shape
+        self.dtype = np.dtype(np.float32)
+        self.shifts = []
+
+    def __iter__(self):
+        for block in self.pipeline.filtered_blocks(self.movie):
+            block -= self.minimum
+            shifts = estimate_shifts(block, self.reference, self.pipeline.max_translation)
+            self.shifts.append(shifts)
+            yield from apply_shifts(block, shifts)
@@ -0,0 +1,314 @@
+import os
+import json
+import struct
+from fractions import Fraction
+import numpy as np
+from src.workutils.Prefetcher import iterate_blocks, block_ranges
+
+# Native access to .isxd movies without going through the isx API
+# An .isxd movie is laid out as
+#   [frame 0][frame 1]...[frame n-1][JSON header]['\0'][uint64 little endian length of the JSON header]
+# Only frames that are not dropped, cropped or blank are stored. With hasFrameHeaderFooter every stored frame
+# is preceded and followed by FRAME_HEADER_SIZE / FRAME_FOOTER_SIZE bytes of metadata (two 1280 pixel sensor rows
+# of 16 bits, whatever the size and type of the frame).
+
+DATA_TYPES = {0: np.dtype('<u2'), 1: np.dtype('<f4'), 2: np.dtype('u1')}
+FRAME_HEADER_SIZE = 5120
+FRAME_FOOTER_SIZE = 5120
+TRAILER_SIZE = 8
+# Largest number of bytes handed to one copy_file_range / sendfile call
+COPY_CHUNK_SIZE = 1 << 30
+
+# timing index lists are stored either as single indices or as 'first-last' ranges
+def parse_indices(values):
+    indices = set()
+    for value in values:
+        if isinstance(value, str) and '-' in value:
+            first, last = value.split('-')
+            indices.update(range(int(first), int(last) + 1))
+        elif isinstance(value, (list, tuple)):
+            indices.update(range(int(value[0]), int(value[1]) + 1))
+        else:
+            indices.add(int(value))
+    return indices
+
+# return the JSON header of an .isxd file and the number of bytes of frame data in front of it
+def read_header(file_path):
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        if file_size < TRAILER_SIZE:
+            raise ValueError(f'{file_path} is too small to be an .isxd file')
+        f.seek(file_size - TRAILER_SIZE)
+        header_size = struct.unpack('<Q', f.read(TRAILER_SIZE))[0]
+        data_size = file_size - TRAILER_SIZE - 1 - header_size
+        if data_size < 0:
+            raise ValueError(f'{file_path} has an invalid .isxd trailer')
+        f.seek(data_size)
+        try:
+            header = json.loads(f.read(header_size).decode('utf-8'))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise ValueError(f'{file_path} has an invalid .isxd header: {e}')
+    return header, data_size
+
+# inverse of parse_indices, writes consecutive indices as 'first - last' ranges like isx does
+def format_indices(indices):
+    ranges = []
+    for index in sorted(set(indices)):
+        if ranges and index == ranges[-1][1] + 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return [str(first) if first == last else f'{first} - {last}' for first, last in ranges]
+
+# write the JSON header, its null terminator and the trailer at the current position of an open binary file
+def write_footer(f, header):
+    encoded = json.dumps(header, indent=4, sort_keys=True).encode('utf-8')
+    f.write(encoded)
+    f.write(b'\0')
+    f.write(struct.pack('<Q', len(encoded)))
+
+class IsxdTiming(object):
+    def __init__(self, timing_info):
+        self.num_samples = int(timing_info['numTimes'])
+        self.period = timing_info['period']['num'] / timing_info['period']['den']
+        self.dropped = sorted(parse_indices(timing_info.get('dropped', [])))
+        self.cropped = sorted(parse_indices(timing_info.get('cropped', [])))
+        self.blank = sorted(parse_indices(timing_info.get('blank', [])))
+
+# read-only memory-mapped view of the frames of an .isxd movie
+# exposes the same timing.num_samples / get_frame_data interface as isx.Movie, plus zero-copy frame ranges
+class IsxdMovie(object):
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.header, data_size = read_header(file_path)
+        if self.header.get('type', 0) != 0:
+            raise ValueError(f'{file_path} is not a movie')
+        if self.header['dataType'] not in DATA_TYPES:
+            raise ValueError(f'{file_path} has an unsupported data type {self.header["dataType"]}')
+        self.data_type = DATA_TYPES[self.header['dataType']]
+        self.timing = IsxdTiming(self.header['timingInfo'])
+        num_pixels = self.header['spacingInfo']['numPixels']
+        self.shape = (int(num_pixels['y']), int(num_pixels['x']))
+        self.has_header_footer = bool(self.header.get('hasFrameHeaderFooter', False))
+        header_size = FRAME_HEADER_SIZE if self.has_header_footer else 0
+        footer_size = FRAME_FOOTER_SIZE if self.has_header_footer else 0
+        pixels_size = self.shape[0] * self.shape[1] * self.data_type.itemsize
+        self.frame_size = header_size + pixels_size + footer_size
+        # map every frame index to its position in the file, -1 for frames that are not stored
+        missing = set(self.timing.dropped) | set(self.timing.cropped) | set(self.timing.blank)
+        self.stored = np.array([i not in missing for i in range(self.timing.num_samples)], dtype=bool)
+        self.stored_index = np.full(self.timing.num_samples, -1, dtype=np.int64)
+        self.stored_index[self.stored] = np.arange(np.count_nonzero(self.stored))
+        num_stored = int(np.count_nonzero(self.stored))
+        if data_size != num_stored * self.frame_size:
+            raise ValueError(f'{file_path} holds {data_size} bytes of frames, expected {num_stored * self.frame_size}')
+        if num_stored:
+            raw = np.memmap(file_path, dtype=np.uint8, mode='r', shape=(num_stored, self.frame_size))
+        else:
+            raw = np.empty((0, self.frame_size), dtype=np.uint8)
+        # view of the stored frames without their header and footer bytes
+        pixels = raw[:, header_size:header_size + pixels_size].view(self.data_type)
+        self.frames = pixels.reshape((num_stored,) + self.shape)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # drop the memory map so the file can be moved or deleted (views returned earlier keep it alive)
+    def close(self):
+        self.frames = None
+
+    def __len__(self):
+        return self.timing.num_samples
+
+    # same behaviour as isx.Movie.get_frame_data: frames that are not stored are returned as zeros
+    def get_frame_data(self, index):
+        if index < 0 or index >= self.timing.num_samples:
+            raise IndexError(f'Frame {index} out of range for a movie of {self.timing.num_samples} frames')
+        stored_index = self.stored_index[index]
+        if stored_index < 0:
+            return np.zeros(self.shape, dtype=self.data_type)
+        return self.frames[stored_index]
+
+    # return frames [start, stop) cropped to roi ([[top, bottom], [left, right]]) as a (frames, height, width) array
+    # this is a zero-copy view of the file unless the range contains frames that are not stored
+    def get_frames(self, start, stop, roi=None):
+        start, stop = max(start, 0), min(stop, self.timing.num_samples)
+        rows = slice(roi[0][0], roi[0][1]) if roi is not None else slice(None)
+        cols = slice(roi[1][0], roi[1][1]) if roi is not None else slice(None)
+        if stop <= start:
+            return self.frames[0:0, rows, cols]
+        if self.stored[start:stop].all():
+            first = self.stored_index[start]
+            return self.frames[first:first + stop - start, rows, cols]
+        block = np.zeros((stop - start,) + self.frames[0:0, rows, cols].shape[1:], dtype=self.data_type)
+        in_range = self.stored[start:stop]
+        block[in_range] = self.frames[self.stored_index[start:stop][in_range], rows, cols]
+        return block
+
+# temporal projection ('mean', 'min' or 'max') of the stored frames of one or more movies, read block_size frames at a time
+# with prefetch_depth blocks read ahead on a background thread, stats is an optional dict accumulating the I/O stall
+# and compute times
+def project_movies(file_paths, stat_type='mean', block_size=256, prefetch_depth=2, stats=None):
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    result = None
+    num_frames = 0
+    for file_path in file_paths:
+        with IsxdMovie(file_path) as movie:
+            frames = movie.frames
+            read_block = (lambda start, stop: np.array(frames[start:stop])) if prefetch_depth > 0 else \
+                (lambda start, stop: frames[start:stop])
+            for _, _, block in iterate_blocks(read_block, block_ranges(0, len(frames), block_size),
+                                              depth=prefetch_depth, stats=stats):
+                if stat_type == 'mean':
+                    block_stat = block.sum(axis=0, dtype=np.float64)
+                elif stat_type == 'min':
+                    block_stat = block.min(axis=0)
+                elif stat_type == 'max':
+                    block_stat = block.max(axis=0)
+                else:
+                    raise ValueError(f'Unknown projection type: {stat_type}')
+                if result is None:
+                    result = block_stat.astype(np.float64)
+                elif stat_type == 'mean':
+                    result += block_stat
+                elif stat_type == 'min':
+                    result = np.minimum(result, block_stat)
+                else:
+                    result = np.maximum(result, block_stat)
+                num_frames += len(block)
+    if result is None:
+        raise ValueError('No stored frames to project')
+    if stat_type == 'mean':
+        result /= num_frames
+    return result.astype(np.float32)
+
+# minimal .isxd writer, used to build synthetic movies for tests and benchmarks
+# frames is a (num_stored, height, width) array of uint16, float32 or uint8 holding only the stored frames,
+# dropped lists the frame indices that are not stored
+# frames can also be any object with shape and dtype attributes that yields its frames one at a time when iterated,
+# so long movies can be generated without holding them in memory
+# period (a Fraction of seconds), start (a timingInfo start entry) and pixel_size (a spacingInfo pixelSize entry)
+# carry the timing and spacing of a source movie over, they replace period_msecs, start_secs and the 3 micron pixels
+def write_isxd(file_path, frames, period_msecs=50, dropped=(), start_secs=0, frame_header_footer=False,
+               period=None, start=None, pixel_size=None):
+    if not (hasattr(frames, 'shape') and hasattr(frames, 'dtype')):
+        frames = np.asarray(frames)
+    data_type = [key for key, value in DATA_TYPES.items() if value == frames.dtype.newbyteorder('<')]
+    if not data_type:
+        raise ValueError(f'Unsupported data type {frames.dtype}')
+    dropped = sorted(int(i) for i in dropped)
+    period = Fraction(int(period_msecs), 1000) if period is None else Fraction(period)
+    header = {
+        'dataType': data_type[0],
+        'extraProperties': None,
+        'fileVersion': 1,
+        'hasFrameHeaderFooter': frame_header_footer,
+        'producer': {'name': 'isxd.py', 'version': [1, 0, 0]},
+        'spacingInfo': {
+            'numPixels': {'x': int(frames.shape[2]), 'y': int(frames.shape[1])},
+            'pixelSize': pixel_size or {'x': {'den': 1, 'num': 3}, 'y': {'den': 1, 'num': 3}},
+            'topLeft': {'x': {'den': 1, 'num': 0}, 'y': {'den': 1, 'num': 0}}},
+        'timingInfo': {
+            'blank': [],
+            'cropped': [],
+            'dropped': dropped,
+            'numTimes': int(frames.shape[0] + len(dropped)),
+            'period': {'den': period.denominator, 'num': period.numerator},
+            'start': start or {'secsSinceEpoch': {'den': 1, 'num': int(start_secs)}, 'utcOffset': 0}},
+        'type': 0}
+    with open(file_path, 'wb') as f:
+        for frame in frames:
+            if frame_header_footer:
+                f.write(bytes(FRAME_HEADER_SIZE))
+            f.write(np.asarray(frame, dtype=frames.dtype.newbyteorder('<')).tobytes())
+            if frame_header_footer:
+                f.write(bytes(FRAME_FOOTER_SIZE))
+        write_footer(f, header)
+
+# copy count bytes from in_fd at in_offset to out_fd at out_offset inside the kernel when it supports it
+# (copy_file_range, then sendfile), otherwise through a user space buffer
+def copy_range(in_fd, out_fd, in_offset, out_offset, count):
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while count > 0:
+                copied = os.copy_file_range(in_fd, out_fd, min(count, COPY_CHUNK_SIZE), in_offset, out_offset)
+                if copied == 0:
+                    break
+                in_offset, out_offset, count = in_offset + copied, out_offset + copied, count - copied
+        except OSError:
+            pass
+    if count > 0 and hasattr(os, 'sendfile'):
+        try:
+            os.lseek(out_fd, out_offset, os.SEEK_SET)
+            while count > 0:
+                copied = os.sendfile(out_fd, in_fd, in_offset, min(count, COPY_CHUNK_SIZE))
+                if copied == 0:
+                    break
+                in_offset, out_offset, count = in_offset + copied, out_offset + copied, count - copied
+        except OSError:
+            pass
+    if count > 0:
+        with os.fdopen(os.dup(in_fd), 'rb') as src, os.fdopen(os.dup(out_fd), 'wb') as dst:
+            src.seek(in_offset)
+            dst.seek(out_offset)
+            while count > 0:
+                data = src.read(min(count, 16 << 20))
+                if not data:
+                    raise OSError('Unexpected end of file while copying frames')
+                dst.write(data)
+                count -= len(data)
+
+# write a copy of an .isxd movie without the frames of segments (list of [first, last] frame indices, inclusive)
+# only the byte ranges of the frames that are kept are copied. Trimmed frames at the start and end of the movie are
+# removed from its timing (the start time moves to the first kept frame unless keep_start_time), trimmed frames in
+# the middle are recorded as cropped so the timestamps of all kept frames are unchanged, like isx.trim_movie
+def trim_isxd(input_file, output_file, segments, keep_start_time=False):
+    movie = IsxdMovie(input_file)
+    num_samples = movie.timing.num_samples
+    trimmed = np.zeros(num_samples, dtype=bool)
+    for first, last in segments:
+        trimmed[max(int(first), 0):min(int(last), num_samples - 1) + 1] = True
+    if trimmed.all():
+        raise ValueError(f'Trimming {segments} would remove every frame of {input_file}')
+    kept = np.flatnonzero(~trimmed)
+    lead = 0 if keep_start_time else int(kept[0])
+    new_num_samples = int(kept[-1]) + 1 - lead
+    # stored frames that are kept, as runs of consecutive positions in the input file
+    keep_stored = movie.stored_index[movie.stored & ~trimmed]
+    runs = np.split(keep_stored, np.flatnonzero(np.diff(keep_stored) != 1) + 1) if len(keep_stored) else []
+    shift = lambda indices: [i - lead for i in indices if lead <= i < lead + new_num_samples]
+    # trimmed frames that were already dropped or blank keep their original status
+    cropped = (set(movie.timing.cropped) | set(np.flatnonzero(trimmed).tolist())) - set(movie.timing.dropped) - set(movie.timing.blank)
+    header = dict(movie.header)
+    timing_info = dict(header['timingInfo'])
+    timing_info['numTimes'] = new_num_samples
+    timing_info['dropped'] = shift(movie.timing.dropped)
+    timing_info['cropped'] = format_indices(shift(sorted(cropped)))
+    timing_info['blank'] = shift(movie.timing.blank)
+    if lead:
+        period = Fraction(timing_info['period']['num'], timing_info['period']['den'])
+        start = dict(timing_info['start'])
+        secs = Fraction(start['secsSinceEpoch']['num'], start['secsSinceEpoch']['den']) + lead * period
+        start['secsSinceEpoch'] = {'den': secs.denominator, 'num': secs.numerator}
+        timing_info['start'] = start
+    header['timingInfo'] = timing_info
+    frame_size = movie.frame_size
+    movie.close()
+    # written next to the output and renamed at the end so an interrupted trim never leaves a valid looking file
+    tmp_file = output_file + '.tmp'
+    with open(input_file, 'rb') as src, open(tmp_file, 'wb') as dst:
+        out_offset = 0
+        for run in runs:
+            if len(run) == 0:
+                continue
+            count = len(run) * frame_size
+            copy_range(src.fileno(), dst.fileno(), int(run[0]) * frame_size, out_offset, count)
+            out_offset += count
+        dst.seek(out_offset)
+        dst.truncate()
+        write_footer(dst, header)
+    os.replace(tmp_file, output_file)
@@ -0,0 +1,117 @@
+import os
+import threading
+
+# Seconds between two checks of an indexed folder for changes made outside of the pipeline
+INDEX_REFRESH_SECONDS = 30
+# one index per folder, shared by every process object of the session (see get_directory_index)
+DIRECTORY_INDEXES = {}
+
+# names and (size, modification time) of the files of a folder, scanned once and then kept up to date by the steps
+# that write to it (update) and by a background thread that scans the folder again when its modification time
+# changed (a file added, removed or renamed by something else), so completion checks are set lookups instead of
+# listings of a folder holding hundreds of TIFFs and CSVs on a network share
+class DirectoryIndex(object):
+    def __init__(self, directory, refresh_seconds=INDEX_REFRESH_SECONDS):
+        self.directory = os.path.abspath(str(directory))
+        self.refresh_seconds = refresh_seconds
+        self.entries = {}
+        self.directory_mtime = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.scan()
+
+    # the lock and the refresh thread stay in this process (process objects are sent to spawned workers)
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in ('_lock', '_stop', '_thread'):
+            state.pop(name)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def scan(self):
+        entries = {}
+        mtime = os.stat(self.directory).st_mtime_ns
+        with os.scandir(self.directory) as scanned:
+            for entry in scanned:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            self.entries = entries
+            self.directory_mtime = mtime
+
+    # scan again if the folder changed since the last scan, returns whether it did
+    def refresh(self):
+        try:
+            changed = os.stat(self.directory).st_mtime_ns != self.directory_mtime
+        except OSError:
+            return False
+        if changed:
+            self.scan()
+        return changed
+
+    def start(self):
+        if self._thread is None and self.refresh_seconds:
+            self._thread = threading.Thread(target=self._refresh_loop, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_seconds):
+            self.refresh()
+
+    def __contains__(self, name):
+        with self._lock:
+            return os.path.basename(name) in self.entries
+
+    def names(self):
+        with self._lock:
+            return set(self.entries)
+
+    def stat(self, name):
+        with self._lock:
+            return self.entries.get(os.path.basename(name))
+
+    # record files written, moved or deleted by a step, paths outside the folder are ignored
+    def update(self, paths):
+        for path in paths:
+            path = os.path.abspath(str(path))
+            if os.path.dirname(path) != self.directory:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            with self._lock:
+                if stat is None:
+                    self.entries.pop(os.path.basename(path), None)
+                else:
+                    self.entries[os.path.basename(path)] = (stat.st_size, stat.st_mtime_ns)
+
+# shared, refreshing index of a folder, created on first use
+def get_directory_index(directory):
+    directory = os.path.abspath(str(directory))
+    index = DIRECTORY_INDEXES.get(directory)
+    if index is None:
+        index = DirectoryIndex(directory).start()
+        DIRECTORY_INDEXES[directory] = index
+    return index
+
+# record files written or deleted by a step in the indexes of their folders that exist in this process
+def update_directory_indexes(paths):
+    for index in list(DIRECTORY_INDEXES.values()):
+        index.update(paths)
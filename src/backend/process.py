@@ -3,13 +3,101 @@ import json
 import re # regex
 from pathlib import Path  
 from itertools import islice  # list manipulation
-from functools import partial  # modify function default parameters
+from functools import cached_property, wraps  # file names derived on first use
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed  # run the days of a stage in parallel
 import numpy as np
+from src.backend.stepcache import StepCache, CACHE_DIR_NAME
+from src.backend.outputindex import get_directory_index, update_directory_indexes
+from src.backend.runreport import StepTimer, new_run_id, write_run_report
+from src.backend.spiketable import resolve_formats, stored_spike_paths, DEFAULT_SPIKE_FORMATS
+from src.workutils.StartMethod import START_METHOD
+
+# intermediate movies kept by every retention policy, the others are deleted once the steps that read them succeeded
+# (see release_intermediates)
+RETENTION_POLICIES = {
+    'all': ('pp_files_series', 'bp_files_series', 'mc_files_series', 'dff_files_series'),
+    'mc': ('mc_files_series',),
+    'finals': (),
+}
+INTERMEDIATE_SERIES = RETENTION_POLICIES['all']
+# single file recording the series of an experiment, replaces the separate *_series.json files
+MANIFEST_NAME = 'process_manifest.json'
+# bump when the layout of the manifest changes
+MANIFEST_VERSION = 1
+MANIFEST_SERIES = ('series_rec_names', 'rec_dir_series', 'pp_files_series', 'bp_files_series', 'mc_files_series',
+                   'cnmfe_files_series', 'cnmfe_eventfiles_series', 'cnmfe_spike_event_series')
+# listings of the recording folders with their modification time (see list_directory)
+DIRECTORY_CACHE = {}
+
+# os.listdir of a directory, cached until its modification time changes (a file added, removed or renamed), so
+# creating process objects for the same experiment again does not scan it again
+def list_directory(path):
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    cached = DIRECTORY_CACHE.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, os.listdir(path))
+        DIRECTORY_CACHE[path] = cached
+    return list(cached[1])
+
+# manifest written at manifest_path, None when it is missing or unreadable
+def read_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r') as read:
+            return json.load(read)
+    except (OSError, ValueError):
+        return None
+
+# write the manifest through a temporary file of this process, a process object created elsewhere for the same
+# experiment (GUI and command line) may write the same manifest at the same time
+def write_manifest(manifest_path, manifest):
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as write:
+            json.dump(manifest, write, indent=4)
+        os.replace(tmp_path, manifest_path)
+    except OSError:
+        # Windows refuses to replace a file another process is replacing or reading, fine when it wrote the same one
+        if read_manifest(manifest_path) != manifest:
+            raise
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# measures a step method of a process object (wall and CPU time, peak memory, bytes read and written, sizes of the
+# step_io files, see StepTimer) and rewrites the run report, its days are measured by cached_step
+# a step returning a non-empty dictionary (the failed days of run_days) is recorded as failed
+def timed_step(method):
+    @wraps(method)
+    def timed(self, *args, **kwargs):
+        try:
+            with StepTimer(self.output_dir, method.__name__, inputs=self.step_files(method.__name__, 'inputs'),
+                           run_id=self.run_id) as timer:
+                result = method(self, *args, **kwargs)
+                timer.finish(self.step_files(method.__name__, 'outputs'),
+                             'failed' if isinstance(result, dict) and result else None)
+        finally:
+            self.write_run_report()
+        return result
+    return timed
 
 # Interface to abstract Timeseries and Longitudinal Registration processing
 class Process(object):
-    def __init__(self, data_dir, output_folder_name, mouse):
+    # day_workers is the number of days of a stage processed at the same time in separate processes (1 runs them in order)
+    # step outputs are cached by input identity and parameters in output_dir/step_cache, with use_content_hash the
+    # inputs are identified by the hash of their content rather than by their size and modification time
+    # scratch_dir is a fast local folder (NVMe, tmpfs) for the intermediate movies, by default the output folder,
+    # retention is the RETENTION_POLICIES entry telling which of them are kept in the output folder
+    # spike_formats are the files the spike tables are written to, CSV and/or columnar (see spiketable.write_spikes)
+    def __init__(self, data_dir, output_folder_name, mouse, day_workers=1, use_content_hash=False, scratch_dir=None,
+                 retention='all', spike_formats=DEFAULT_SPIKE_FORMATS):
+        if retention not in RETENTION_POLICIES:
+            raise ValueError(f'Unknown retention policy {retention}, expected one of {list(RETENTION_POLICIES)}')
         self.data_dir = Path(data_dir)
+        self.day_workers = day_workers
+        self.retention = retention
+        self.spike_formats = resolve_formats(spike_formats)
         self.output_folder_name = output_folder_name
         #if self.output_folder_name is None:
         #    self.output_dir = self.data_dir / 'processed'
@@ -17,57 +105,150 @@ class Process(object):
         self.output_dir = self.data_dir / output_folder_name
         # create the output folder if it does not exist
         self.output_dir.mkdir(exist_ok=True)
+        self.scratch_dir = Path(scratch_dir) if scratch_dir else self.output_dir
+        self.scratch_dir.mkdir(parents=True, exist_ok=True)
+        self.step_cache = StepCache(self.output_dir / CACHE_DIR_NAME, use_content=use_content_hash)
         self.mouse_name = mouse
+        # groups the timings of the steps run through this object in output_dir/run_timings.jsonl (see runreport)
+        self.run_id = new_run_id()
         # store series label, list of recordings, and # of recordings in each series
-        if self.get_series_recs() is None:
+        self.series_rec_names = self.get_series_recs()
+        if self.series_rec_names is None:
             raise ValueError(
                 'Could not find recording files in the selected input directory. Please check that .isxd files are in year-month-day-hour-minute-second format')
-        else:
-            self.series_rec_names = self.get_series_recs()
         self.day_labels = list(self.series_rec_names.keys())
         self.recordings_series = list(self.series_rec_names.values())
         self.num_rec_per_series = [len(child_list) for child_list in self.recordings_series]
-        self.rec_dir_series = self.series_suffix('.isxd', self.recordings_series, output_dir=self.data_dir)
         self.total_num_recordings = np.sum(self.num_rec_per_series)
-        self.series_suffix = partial(self.series_suffix, dir_series= self.rec_dir_series)
-        #self.lr_cells_from_day = self.series_label_prefix("-longitudinal_spikes.csv")
-        self.timeseries_events, self.lr_cells_from_day = self.set_mouse_name_for_timeseries()
-        print(self.lr_cells_from_day)
-        #create file names for each series
-        self.pp_files_series = self.series_suffix('-PP.isxd')
-        self.bp_files_series = self.series_suffix('-PP-BP.isxd')
-        self.mc_files_series = self.series_suffix('-PP-BP-MC.isxd')
-        self.cnmfe_files_series = self.series_suffix('-PP-BP-MC-cnmfe-cellset.isxd')
-        self.cnmfe_eventfiles_series = self.series_suffix('-PP-BP-MC-cnmfe_event.isxd')
-        self.cnmfe_spike_event_series = self.series_suffix('-PP-BP-MC-cnmfe-spikes_event.isxd')
-        self.dff_files_series = self.series_suffix('-PP-BP-MC-dff.isxd')
-        #create files for event detection
-        self.mean_proj_files = self.series_label_prefix('-mean_image.isxd')
-        self.crop_rect_files = self.series_label_prefix('-crop_rect.csv')
-        self.translation_files = self.series_label_prefix('-trans.csv')
-        self.maxdff_files = self.series_label_prefix('-maxdff.isxd')
-        self.cnmfe_csv = self.series_label_prefix('-cnmfe-cellset.csv')
-        self.cnmfe_tiff = self.series_label_prefix('-cnmfe-cellset.tiff')
-        self.cnmfe_spike_event_csvs = self.series_label_prefix('-cnmfe-spike-events.csv')
-       
-        #self.timeseries_events = self.series_label_prefix('-timeseries_spikes.csv')
-        #write and read json files that contain series
-        self.series_rec_json = self.write_read_json('series_rec_names.json', self.series_rec_names)
-        self.rec_dir_json = self.write_read_json('rec_dir_series.json', self.rec_dir_series)
-        self.pp_files_json = self.write_read_json('pp_files_series.json', self.pp_files_series)
-        self.bp_files_json = self.write_read_json('bp_files_series.json', self.bp_files_series)
-        self.mc_files_json = self.write_read_json('mc_files_series.json', self.mc_files_series)
-        self.cnmfe_files_json = self.write_read_json('cnmfe_files_series.json', self.cnmfe_files_series)
-        self.cnmfe_events_json = self.write_read_json('cnmfe_eventfiles_series.json', self.cnmfe_eventfiles_series)
-        self.cnmfe_spikes_json = self.write_read_json('cnmfe_spike_event_series.json', self.cnmfe_spike_event_series)
+        # the file names of every step are derived from the recordings when they are first used (see below)
         print(f'{self.total_num_recordings} recordings found !')
 
+    @cached_property
+    def rec_dir_series(self):
+        return self.series_suffix('.isxd', self.recordings_series, output_dir=self.data_dir)
+
+    # names of timeseries and LR spike files by mouse name and date
+    @cached_property
+    def spike_csv_series(self):
+        return self.set_mouse_name_for_timeseries()
+
+    @cached_property
+    def timeseries_events(self):
+        return self.spike_csv_series[0]
+
+    @cached_property
+    def lr_cells_from_day(self):
+        return self.spike_csv_series[1]
+
+    #create file names for each series
+    @cached_property
+    def pp_files_series(self):
+        return self.series_suffix('-PP.isxd', output_dir=self.scratch_dir)
+
+    @cached_property
+    def bp_files_series(self):
+        return self.series_suffix('-PP-BP.isxd', output_dir=self.scratch_dir)
+
+    @cached_property
+    def mc_files_series(self):
+        return self.series_suffix('-PP-BP-MC.isxd', output_dir=self.scratch_dir)
+
+    @cached_property
+    def cnmfe_files_series(self):
+        return self.series_suffix('-PP-BP-MC-cnmfe-cellset.isxd')
+
+    @cached_property
+    def cnmfe_eventfiles_series(self):
+        return self.series_suffix('-PP-BP-MC-cnmfe_event.isxd')
+
+    @cached_property
+    def cnmfe_spike_event_series(self):
+        return self.series_suffix('-PP-BP-MC-cnmfe-spikes_event.isxd')
+
+    @cached_property
+    def dff_files_series(self):
+        return self.series_suffix('-PP-BP-MC-dff.isxd', output_dir=self.scratch_dir)
+
+    #create files for event detection
+    @cached_property
+    def mean_proj_files(self):
+        return self.series_label_prefix('-mean_image.isxd')
+
+    @cached_property
+    def crop_rect_files(self):
+        return self.series_label_prefix('-crop_rect.csv')
+
+    @cached_property
+    def translation_files(self):
+        return self.series_label_prefix('-trans.csv')
+
+    @cached_property
+    def maxdff_files(self):
+        return self.series_label_prefix('-maxdff.isxd')
+
+    @cached_property
+    def cnmfe_csv(self):
+        return self.series_label_prefix('-cnmfe-cellset.csv')
+
+    @cached_property
+    def cnmfe_tiff(self):
+        return self.series_label_prefix('-cnmfe-cellset.tiff')
+
+    @cached_property
+    def cnmfe_spike_event_csvs(self):
+        return self.series_label_prefix('-cnmfe-spike-events.csv')
+
+    # series of the experiment as recorded in output_dir/MANIFEST_NAME, a single file written again only when the
+    # recordings or the folders change, in place of one JSON file per series
+    # it is read before the days or steps are dispatched (see run_days, StepScheduler.run_schedulers), the spawned
+    # workers receive it with the process object and never write the file themselves
+    @cached_property
+    def manifest(self):
+        manifest = {'version': MANIFEST_VERSION,
+                    'series': {name: getattr(self, name) for name in MANIFEST_SERIES}}
+        manifest_path = os.path.join(self.output_dir, MANIFEST_NAME)
+        if read_manifest(manifest_path) != manifest:
+            write_manifest(manifest_path, manifest)
+        return manifest
+
+    @property
+    def series_rec_json(self):
+        return self.manifest['series']['series_rec_names']
+
+    @property
+    def rec_dir_json(self):
+        return self.manifest['series']['rec_dir_series']
+
+    @property
+    def pp_files_json(self):
+        return self.manifest['series']['pp_files_series']
+
+    @property
+    def bp_files_json(self):
+        return self.manifest['series']['bp_files_series']
+
+    @property
+    def mc_files_json(self):
+        return self.manifest['series']['mc_files_series']
+
+    @property
+    def cnmfe_files_json(self):
+        return self.manifest['series']['cnmfe_files_series']
+
+    @property
+    def cnmfe_events_json(self):
+        return self.manifest['series']['cnmfe_eventfiles_series']
+
+    @property
+    def cnmfe_spikes_json(self):
+        return self.manifest['series']['cnmfe_spike_event_series']
+
     # store recordings for each day in a dictionary with day labels as keys and an array of recording files for that day as values
     # using the file directory, find the files that match the raw recording naming scheme using regex year-month-day-hour-minute-second format and '.isxd' ending
     # recording files should be named in the usual raw-recording output scheme or this function will break
     # to account for files with dropped frames-> if the dates match replace the unprocessed file found with the processed one
     def get_series_recs(self):
-        directory = os.listdir(self.data_dir)
+        directory = list_directory(self.data_dir)
         # create dictionary with dates as the keys (ex. 2023-08-04) and array of recordings for that day as values
         series_recs_dates = {}
         # create dictionary to be used for processing with the days as day labels (ex. day_1, day_2...)
@@ -159,7 +340,7 @@ class Process(object):
             Output = Input  # skip the conversion if input list is not nested
         return Output
 
-    def series_suffix(self, suffix, dir_series, output_dir=None):
+    def series_suffix(self, suffix, dir_series=None, output_dir=None):
         """
         add suffix to series filename
         1. The input dir series are merged first
@@ -175,6 +356,8 @@ class Process(object):
         Return:
             Output: new dir series with suffixed filenames
         """
+        if dir_series is None:
+            dir_series = self.rec_dir_series
         if not output_dir:
             output_dir = self.output_dir
         old_names = self.merge_series(dir_series)  # step 1
@@ -204,6 +387,88 @@ class Process(object):
            output_dir = self.output_dir
         return [str(Path(output_dir, name + suffix)) for name in prefix]
     
+    # run day_step(day_i, day_label, *args) for every day of a stage, up to day_workers days at the same time
+    # the days are independent: a failing day is reported and the others still run
+    # returns a dictionary of the days that failed with their error
+    def run_days(self, stage_name, day_step, *args):
+        errors = {}
+        workers = min(self.day_workers, len(self.day_labels))
+        if workers > 1:
+            # derived once here, the workers get the paths with the process object
+            self.manifest
+            with ProcessPoolExecutor(max_workers=workers,
+                                     mp_context=multiprocessing.get_context(START_METHOD)) as executor:
+                futures = {executor.submit(day_step, day_i, day_label, *args): day_label
+                           for day_i, day_label in enumerate(self.day_labels)}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        errors[futures[future]] = e
+        else:
+            for day_i, day_label in enumerate(self.day_labels):
+                try:
+                    day_step(day_i, day_label, *args)
+                except Exception as e:
+                    errors[day_label] = e
+        errors = {day_label: errors[day_label] for day_label in self.day_labels if day_label in errors}
+        for day_label, error in errors.items():
+            print(f'Error: {stage_name} failed for {day_label}: {error}')
+        return errors
+
+    # run call(staged) for one day (label) of a step unless the step cache holds its outputs for the same inputs and
+    # params, inputs and outputs are lists of file paths, params everything else the outputs depend on
+    # call writes to staged(path) instead of path, the outputs are moved in place once it succeeded (see StepCache.run)
+    # every call is measured with the cache result as status ('ran', 'cached', 'restored', see StepTimer)
+    def cached_step(self, step_name, label, inputs, outputs, params, call, modified=()):
+        outputs, modified = self.merge_series(outputs), self.merge_series(list(modified))
+        inputs = self.merge_series(inputs)
+        with StepTimer(self.output_dir, step_name, label, 'day', inputs, self.run_id) as timer:
+            result = self.step_cache.run(step_name, label, inputs, outputs, params, call, modified=modified)
+            timer.finish(outputs + modified, result)
+        update_directory_indexes(outputs + modified)
+        return result
+
+    # files of the step_io entry of a step, kind is 'inputs' or 'outputs'
+    def step_files(self, step_name, kind):
+        io = getattr(self, 'step_io', {}).get(step_name) or {}
+        files = []
+        for attribute in io.get(kind, []):
+            value = getattr(self, attribute)
+            files.extend([value] if isinstance(value, str) else self.merge_series(value))
+        return files
+
+    # output_dir/run_report.json and run_report.csv from the timings of every run (see runreport.write_run_report)
+    def write_run_report(self):
+        try:
+            return write_run_report(self.output_dir)
+        except OSError as e:
+            print(f'Could not write the run report: {e}')
+
+    # whether a step can read path: on disk, released by the retention policy (see StepCache.bring_back), or a spike
+    # table written only in columnar formats
+    def is_available(self, path):
+        return os.path.exists(path) or bool(self.step_cache.released(path)) or \
+            (path.endswith('.csv') and bool(stored_spike_paths(path)))
+
+    # called with input files whose consumers all succeeded: the intermediates the retention policy does not keep are
+    # deleted, the kept ones written to the scratch folder are moved to the output folder
+    def release_intermediates(self, paths):
+        intermediates = {path for attribute in INTERMEDIATE_SERIES for path in self.merge_series(getattr(self, attribute))}
+        kept = {path for attribute in RETENTION_POLICIES[self.retention]
+                for path in self.merge_series(getattr(self, attribute))}
+        for path in paths:
+            if path not in intermediates or not os.path.exists(path):
+                continue
+            if path not in kept:
+                self.step_cache.release(path)
+                print(f'Intermediate file deleted: {path}')
+            elif self.scratch_dir != self.output_dir:
+                keep_path = str(self.output_dir / os.path.basename(path))
+                self.step_cache.release(path, keep_path=keep_path)
+                update_directory_indexes([keep_path])
+            update_directory_indexes([path])
+
      #define functions to read and write JSON files
     def write_json(self, file_string, file):
         with open(self.output_dir / file_string, 'w') as write:
@@ -214,50 +479,19 @@ class Process(object):
         with open(self.output_dir / file_string, 'r') as read:
             return json.load(read)
         
-    #provide the file and its name (file_string) to be written and read  
-    def write_read_json(self, file_string, file):
-        file_to_write_read = os.path.join(self.output_dir, file_string)
-        if not os.path.exists(file_to_write_read):
-            with open(file_to_write_read, 'w') as write:
-                json.dump(file, write)
-        with open(file_to_write_read, 'r') as read:
-            return json.load(read)
-
-    # isx api will not process files for a day if one of them exists already, this function is a work-around to skip processing tasks if the
-    # file outputs already exist, if not all of the recordings from that day have gone through processing delete the files that exist and reprocess them all
-    
     # check whether all the files from a single day have output a file from a task
-    # if one of the processed file exists in the dir but the other ones dont then delete those files and reprocess the entire day
-    # compare list of files for a day from the file series JSON for that task with the main directory     
+    # the files are looked up in the index of their folder (see DirectoryIndex) instead of listing it, a missing
+    # file makes the index check the folder for changes first (a step that ran in another process)
+    # the steps only move complete outputs into the output folder (see Staging), a day with some of its files is one
+    # whose outputs were being moved when the run stopped: it is reported as unprocessed and nothing is deleted, the
+    # step replaces the files when it runs again. Intermediates deleted by the retention policy count as processed.
     def check_all_recordings_processed(self, series, day_i):
         if not series:
             raise ValueError('Provided series does not exist')
         if not series[day_i]:
             raise IndexError('Day index provided is not in the series')
-        # get signle file name for every file
-        list_of_output_files = [os.path.basename(file) for file in series[day_i]]
-        directory = os.listdir(self.output_dir)
-        # get entire path for every file
-        in_dir = [file in directory for file in list_of_output_files]
-        # case -> all files for that day and series have already been processed
-        if all(in_dir):
-            return True
-        # case -> only one of the recordings from that day has been processed -> delete from day and reprocess 
-        elif any(in_dir):
-            try:
-                files_to_delete_in_dir = list_of_output_files
-                file_num = 0
-                for file in files_to_delete_in_dir:
-                    file_exists = in_dir[file_num]
-                    if file_exists:
-                        path = os.path.join(str(self.output_dir), file)
-                        os.remove(path)
-                        print(f'File deleted: {path}')
-                    file_num += 1
+        for file in series[day_i]:
+            index = get_directory_index(os.path.dirname(os.path.abspath(file)))
+            if file not in index and not (index.refresh() and file in index) and not self.step_cache.released(file):
                 return False
-            except OSError as e:
-                print(f'Could not delete {path}: {e}')     
-        # case -> there are no recordings for that day that have been processed and processing can continue    
-        else:
-            return False
-        
\ No newline at end of file
+        return True
@@ -0,0 +1,223 @@
+import os
+import csv
+import json
+import time
+try:
+    import resource  # CPU time of child processes and peak memory, not available on Windows
+except ImportError:
+    resource = None
+try:
+    import psutil  # optional, I/O counters and peak memory on Windows
+except ImportError:
+    psutil = None
+
+# one JSON line per measured call (a step, or a day of a step), appended by every process running steps
+TIMINGS_NAME = 'run_timings.jsonl'
+# rebuilt from the timings: totals per run and step (JSON) and every measured call of every run (CSV)
+REPORT_JSON_NAME = 'run_report.json'
+REPORT_CSV_NAME = 'run_report.csv'
+RECORD_FIELDS = ['run_id', 'step', 'label', 'level', 'status', 'started', 'wall_s', 'cpu_s', 'peak_rss_bytes',
+                 'read_bytes', 'written_bytes', 'input_bytes', 'output_bytes', 'pid']
+# summed over the days of a step when the step itself was not measured (days run as separate scheduler nodes)
+SUMMED_FIELDS = ['wall_s', 'cpu_s', 'read_bytes', 'written_bytes', 'input_bytes', 'output_bytes']
+
+# identifies the calls of one run in the timings, runs of the same experiment are compared by it
+def new_run_id():
+    return time.strftime('%Y%m%d-%H%M%S') + f'-{os.getpid()}'
+
+# CPU seconds of this process and of its child processes (day workers, corrupt frame pools): the children that
+# finished and were waited for, and with psutil the ones still running (a pool passed in and kept open across steps),
+# without psutil the CPU time of a child still running when the block is left is not counted
+def cpu_seconds():
+    seconds = time.process_time()
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        seconds += children.ru_utime + children.ru_stime
+    if psutil is not None:
+        for child in psutil.Process().children(recursive=True):
+            try:
+                times = child.cpu_times()
+                seconds += times.user + times.system
+            except psutil.Error:
+                # finished in between, counted by RUSAGE_CHILDREN once waited for
+                continue
+    return seconds
+
+# bytes this process made the storage read and write, page faults of memory-mapped movies included and page cache
+# hits excluded (0 on memory filesystems), None when the platform has no counter
+def io_bytes():
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':') for line in f if ':' in line)
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        pass
+    if psutil is not None:
+        try:
+            counters = psutil.Process().io_counters()
+            return counters.read_bytes, counters.write_bytes
+        except (AttributeError, psutil.Error):
+            pass
+    return None, None
+
+# start a new peak memory measurement, returns False when only the peak of the whole process can be read
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+# highest resident memory in bytes since reset_peak_rss, or since the process started
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    if psutil is not None:
+        peak = getattr(psutil.Process().memory_info(), 'peak_wset', None)
+        if peak is not None:
+            return peak
+    if resource is not None:
+        # kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024
+    return None
+
+def total_size(paths):
+    size = 0
+    for path in paths:
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            continue
+    return size
+
+# timers open in this process, innermost last: a timer started inside another one (the days of a step) resets the
+# peak memory, the peak the outer timer reached until then and the peaks of its inner timers are kept in child_peak
+open_timers = []
+
+# measures the calls of a step and appends a record to report_dir/TIMINGS_NAME when the block is left
+# level is 'step' for a whole step and 'day' for one day, the status is 'ok' unless the block sets it (the step cache
+# result) or raises ('failed'), outputs are the files whose size is reported once the block is done
+class StepTimer(object):
+    def __init__(self, report_dir, step, label='all', level='step', inputs=(), run_id=None):
+        self.report_dir = str(report_dir)
+        self.step = step
+        self.label = label
+        self.level = level
+        self.inputs = list(inputs)
+        self.run_id = run_id or new_run_id()
+        self.outputs = []
+        self.status = 'ok'
+        self.record = None
+        self.child_peak = None
+
+    def __enter__(self):
+        self.input_bytes = total_size(self.inputs)
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+        if open_timers:
+            open_timers[-1].keep_peak(peak_rss())
+        open_timers.append(self)
+        reset_peak_rss()
+        self.io_start = io_bytes()
+        self.cpu_start = cpu_seconds()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def keep_peak(self, peak):
+        if peak is not None:
+            self.child_peak = peak if self.child_peak is None else max(self.child_peak, peak)
+
+    def finish(self, outputs=(), status=None):
+        self.outputs = list(outputs)
+        if status is not None:
+            self.status = status
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.wall_start
+        cpu = cpu_seconds() - self.cpu_start
+        io_end = io_bytes()
+        read, written = [None if start is None or end is None else end - start
+                         for start, end in zip(self.io_start, io_end)]
+        peak = peak_rss()
+        if self.child_peak is not None:
+            peak = self.child_peak if peak is None else max(peak, self.child_peak)
+        if self in open_timers:
+            open_timers.remove(self)
+        if open_timers:
+            open_timers[-1].keep_peak(peak)
+        self.record = {
+            'run_id': self.run_id, 'step': self.step, 'label': self.label, 'level': self.level,
+            'status': 'failed' if exc_type is not None else self.status, 'started': self.started,
+            'wall_s': round(wall, 3), 'cpu_s': round(cpu, 3), 'peak_rss_bytes': peak,
+            'read_bytes': read, 'written_bytes': written, 'input_bytes': self.input_bytes,
+            'output_bytes': total_size(self.outputs), 'pid': os.getpid(),
+        }
+        try:
+            append_record(self.report_dir, self.record)
+        except OSError as e:
+            print(f'Could not record the timing of {self.step}: {e}')
+
+# single write per record so the lines of processes appending at the same time do not interleave
+def append_record(report_dir, record):
+    with open(os.path.join(report_dir, TIMINGS_NAME), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+def read_records(report_dir):
+    path = os.path.join(str(report_dir), TIMINGS_NAME)
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # line of a process killed while writing it
+                continue
+    return records
+
+# totals of a step in one run: its own record when the whole step was measured, otherwise the sum of its days
+def step_summary(records):
+    days = {record['label']: {field: record[field] for field in RECORD_FIELDS if field not in ('run_id', 'step', 'label', 'level')}
+            for record in records if record['level'] == 'day'}
+    step_records = [record for record in records if record['level'] == 'step']
+    if step_records:
+        summary = {field: step_records[-1][field] for field in SUMMED_FIELDS + ['peak_rss_bytes', 'status']}
+    else:
+        summary = {field: sum(day[field] or 0 for day in days.values()) for field in SUMMED_FIELDS}
+        summary['wall_s'] = round(summary['wall_s'], 3)
+        summary['cpu_s'] = round(summary['cpu_s'], 3)
+        summary['peak_rss_bytes'] = max((day['peak_rss_bytes'] or 0 for day in days.values()), default=None)
+        summary['status'] = 'failed' if any(day['status'] == 'failed' for day in days.values()) else 'ok'
+    summary['days'] = days
+    return summary
+
+# rewrite REPORT_JSON_NAME ({run id: {step: totals and days}}) and REPORT_CSV_NAME (one row per record) from the
+# timings, each file is replaced in one rename so a reader never sees half a report
+def write_run_report(report_dir):
+    report_dir = str(report_dir)
+    records = read_records(report_dir)
+    runs = {}
+    for record in records:
+        runs.setdefault(record['run_id'], {}).setdefault(record['step'], []).append(record)
+    report = {run_id: {step: step_summary(step_records) for step, step_records in steps.items()}
+              for run_id, steps in runs.items()}
+    json_path = os.path.join(report_dir, REPORT_JSON_NAME)
+    temp_path = f'{json_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(temp_path, json_path)
+    csv_path = os.path.join(report_dir, REPORT_CSV_NAME)
+    temp_path = f'{csv_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(records)
+    os.replace(temp_path, csv_path)
+    return report
@@ -0,0 +1,471 @@
+import os
+import heapq
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow  # optional, Parquet and Feather spike tables
+    import pyarrow.parquet
+    import pyarrow.feather
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+# Columns of the spike event tables: isx writes one column per cell next to the time column (wide), the pipeline
+# keeps one row per event (long, written by Timeseries.vertical_csv_alignment and renamed by the LR)
+TIME_COLUMN = 'Time (s)'
+CELL_COLUMN = ' Cell Name'
+VALUE_COLUMN = 'Value'
+LONG_COLUMNS = [TIME_COLUMN, CELL_COLUMN, VALUE_COLUMN]
+# rows at the top of the wide table that are not converted
+SKIPPED_ROWS = 2
+# rows of the wide table converted at a time by the streaming conversion, memory grows with rows x cells
+STREAM_CHUNK_ROWS = 10000
+# wide tables larger than this are converted by streaming unless the caller chooses
+STREAM_MIN_BYTES = 512 * 2**20
+# sorted spill runs merged at once by the streaming conversion, more runs are first merged in groups into longer runs
+MERGE_FAN_IN = 64
+# events read from every run at a time by the merge, and written at a time to the Parquet and Feather files
+MERGE_BLOCK_EVENTS = 65536
+# dtypes of the compact tables (see SpikeTable), times and values keep the full precision of the CSVs
+CELL_ID_DTYPE = np.uint32
+TIME_DTYPE = np.float64
+VALUE_DTYPE = np.float64
+# files a spike table can be written to (see write_spikes), ARROW_FORMATS need pyarrow and fall back to npz
+SPIKE_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather', 'npz': '.npz'}
+SPIKE_FORMATS = tuple(SPIKE_EXTENSIONS)
+FORMAT_OF_EXTENSION = {extension: spike_format for spike_format, extension in SPIKE_EXTENSIONS.items()}
+ARROW_FORMATS = ('parquet', 'feather')
+DEFAULT_SPIKE_FORMATS = ('csv',)
+# formats tried by the loader when a table is named by its CSV, fastest first
+LOAD_ORDER = ('npz', 'feather', 'parquet', 'csv')
+# bump when the arrays stored in the .npz spike tables change
+NPZ_VERSION = 1
+
+# long spike table kept as three arrays, one entry per event: cell id (index in names), time and value
+# the cell names are stored once, sorted, so ordering by cell id is ordering by name. The tables are converted from
+# and to CSVs and DataFrames only when they are read and written, 20 bytes per event instead of a padded string
+# object per event, and sorting is a lexsort of two numeric arrays
+class SpikeTable(object):
+    def __init__(self, cell_ids, times, values, names):
+        # names may repeat (cells renamed to the same global cell) or be unsorted, their ids are merged and renumbered
+        names, renumbered = np.unique(np.asarray(names, dtype=object), return_inverse=True)
+        self.names = names
+        self.cell_ids = renumbered.astype(CELL_ID_DTYPE)[np.asarray(cell_ids, dtype=np.int64)]
+        self.times = np.asarray(times, dtype=TIME_DTYPE)
+        self.values = np.asarray(values, dtype=VALUE_DTYPE)
+
+    def __len__(self):
+        return len(self.cell_ids)
+
+    @property
+    def nbytes(self):
+        return self.cell_ids.nbytes + self.times.nbytes + self.values.nbytes
+
+    # positive values of a wide spike table, the first skip_rows rows and the rows with a zero timestamp are left
+    # out and every column after the first is a cell
+    @classmethod
+    def from_wide(cls, df, skip_rows=SKIPPED_ROWS):
+        times = df[TIME_COLUMN].to_numpy(dtype=TIME_DTYPE)[skip_rows:]
+        values = df.iloc[skip_rows:, 1:].to_numpy(dtype=VALUE_DTYPE)
+        rows, cells = np.nonzero((values > 0) & (times != 0)[:, None])
+        return cls(cells, times[rows], values[rows, cells], df.columns[1:])
+
+    # long DataFrame with the LONG_COLUMNS, its cell column plain strings or categorical
+    @classmethod
+    def from_frame(cls, df):
+        cells = pd.Categorical(df[CELL_COLUMN])
+        return cls(cells.codes, df[TIME_COLUMN].to_numpy(), df[VALUE_COLUMN].to_numpy(), cells.categories)
+
+    @classmethod
+    def read_csv(cls, path):
+        return cls.from_frame(pd.read_csv(path, dtype={TIME_COLUMN: TIME_DTYPE, CELL_COLUMN: 'category',
+                                                       VALUE_COLUMN: VALUE_DTYPE}))
+
+    # events in the given order (indices or mask), names unchanged
+    def take(self, order):
+        table = SpikeTable.__new__(SpikeTable)
+        table.names = self.names
+        table.cell_ids = self.cell_ids[order]
+        table.times = self.times[order]
+        table.values = self.values[order]
+        return table
+
+    # sorted by cell name then time, events with the same name and time keep their order
+    def sorted(self):
+        return self.take(np.lexsort((self.times, self.cell_ids)))
+
+    # cells renamed at once through mapping ({name: new name}, missing names kept), sorted again
+    def renamed(self, mapping):
+        names = [mapping.get(name, name) for name in self.names]
+        return SpikeTable(self.cell_ids, self.times, self.values, names).sorted()
+
+    def to_frame(self):
+        return pd.DataFrame({TIME_COLUMN: self.times,
+                             CELL_COLUMN: pd.Categorical.from_codes(self.cell_ids.astype(np.int64), self.names),
+                             VALUE_COLUMN: self.values})
+
+    def to_csv(self, path_or_file, header=True):
+        self.to_frame().to_csv(path_or_file, index=False, header=header)
+
+# wide spike CSV read with the dtypes of the compact tables
+def read_wide_csv(input_csv, **kwargs):
+    columns = pd.read_csv(input_csv, nrows=0).columns
+    dtypes = {column: (TIME_DTYPE if column == TIME_COLUMN else VALUE_DTYPE) for column in columns}
+    return pd.read_csv(input_csv, dtype=dtypes, **kwargs)
+
+# long table of the positive values of a wide spike table, sorted by cell then time (see SpikeTable.from_wide)
+def wide_to_long(df, skip_rows=SKIPPED_ROWS):
+    return SpikeTable.from_wide(df, skip_rows).sorted().to_frame()
+
+# cell names isx gives to cell indices in the spike tables (' C007', ' C1024')
+def cell_names(indices):
+    return ' C' + pd.Series(indices).astype(np.int64).astype(str).str.zfill(3)
+
+# {local cell name: global cell name} of every day from an LR index table (one row per cell of every cellset), built
+# from the rows of the first cellset of each day (day_indices, the sessions of a day share their cells)
+# a local cell listed twice in a cellset keeps its first global index
+def global_cell_maps(lr_df, day_indices):
+    rows = lr_df[lr_df['local_cellset_index'].isin(day_indices)]
+    rows = rows.drop_duplicates(['local_cellset_index', 'local_cell_index'])
+    maps = {cellset: dict(zip(cell_names(group['local_cell_index'].to_numpy()),
+                              cell_names(group['global_cell_index'].to_numpy())))
+            for cellset, group in rows.groupby('local_cellset_index')}
+    return [maps.get(cellset, {}) for cellset in day_indices]
+
+# formats of the spike tables: the CSV and columnar files next to it (same name, their own extension) that are
+# loaded in milliseconds (see load_spike_table), 'columnar' is Parquet when pyarrow is installed and npz otherwise
+def resolve_formats(formats):
+    resolved = []
+    for spike_format in formats:
+        if spike_format == 'columnar':
+            spike_format = 'parquet' if pyarrow is not None else 'npz'
+        if spike_format not in SPIKE_FORMATS:
+            raise ValueError(f'Unknown spike table format {spike_format}, expected some of {list(SPIKE_FORMATS)}')
+        if spike_format in ARROW_FORMATS and pyarrow is None:
+            print(f'pyarrow is not installed, spike tables are written as .npz instead of .{spike_format}')
+            spike_format = 'npz'
+        if spike_format not in resolved:
+            resolved.append(spike_format)
+    if not resolved:
+        raise ValueError('At least one spike table format is needed')
+    return tuple(resolved)
+
+# file of a spike table in a format, csv_path is the name the pipeline knows the table by
+def spike_path(csv_path, spike_format):
+    return os.path.splitext(str(csv_path))[0] + SPIKE_EXTENSIONS[spike_format]
+
+# files of the spike table csv_path that exist, in the order they are fastest to load
+def stored_spike_paths(csv_path):
+    paths = [spike_path(csv_path, spike_format) for spike_format in LOAD_ORDER]
+    return [path for path in paths if os.path.exists(path)]
+
+def spikes_written(csv_path, formats):
+    return all(os.path.exists(spike_path(csv_path, spike_format)) for spike_format in formats)
+
+# write(temp path) then rename to path, an interrupted write never leaves a partial file
+def write_atomic(path, write):
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def write_npz(table, path):
+    with open(path, 'wb') as f:
+        np.savez(f, version=NPZ_VERSION, cell_ids=table.cell_ids, times=table.times, values=table.values,
+                 names=np.asarray(table.names, dtype=str))
+
+def read_npz(path):
+    with np.load(path) as npz:
+        table = SpikeTable.__new__(SpikeTable)
+        table.names = npz['names'].astype(object)
+        table.cell_ids, table.times, table.values = npz['cell_ids'], npz['times'], npz['values']
+    return table
+
+# Arrow table with the LONG_COLUMNS, the cell names dictionary encoded over the cell ids
+def to_arrow(table):
+    cells = pyarrow.DictionaryArray.from_arrays(pyarrow.array(table.cell_ids),
+                                                 pyarrow.array(np.asarray(table.names, dtype=str)))
+    return pyarrow.table({TIME_COLUMN: pyarrow.array(table.times), CELL_COLUMN: cells,
+                          VALUE_COLUMN: pyarrow.array(table.values)})
+
+def from_arrow(arrow_table):
+    cells = arrow_table.column(CELL_COLUMN).combine_chunks()
+    if not pyarrow.types.is_dictionary(cells.type):
+        cells = cells.dictionary_encode()
+    table = SpikeTable.__new__(SpikeTable)
+    table.names = np.asarray(cells.dictionary.to_pylist(), dtype=object)
+    table.cell_ids = cells.indices.to_numpy(zero_copy_only=False).astype(CELL_ID_DTYPE)
+    table.times = arrow_table.column(TIME_COLUMN).to_numpy().astype(TIME_DTYPE)
+    table.values = arrow_table.column(VALUE_COLUMN).to_numpy().astype(VALUE_DTYPE)
+    # the dictionary of a file written elsewhere may be unsorted
+    if list(table.names) != sorted(table.names):
+        table = SpikeTable(table.cell_ids, table.times, table.values, table.names)
+    return table
+
+SPIKE_WRITERS = {
+    'csv': lambda table, path: table.to_csv(path),
+    'npz': write_npz,
+    'parquet': lambda table, path: pyarrow.parquet.write_table(to_arrow(table), path),
+    'feather': lambda table, path: pyarrow.feather.write_feather(to_arrow(table), path),
+}
+SPIKE_READERS = {
+    'csv': SpikeTable.read_csv,
+    'npz': read_npz,
+    'parquet': lambda path: from_arrow(pyarrow.parquet.read_table(path)),
+    'feather': lambda path: from_arrow(pyarrow.feather.read_table(path)),
+}
+
+# write a spike table in every format (see resolve_formats) under the name csv_path
+def write_spikes(table, csv_path, formats=DEFAULT_SPIKE_FORMATS):
+    for spike_format in resolve_formats(formats):
+        write_atomic(spike_path(csv_path, spike_format),
+                     lambda path, spike_format=spike_format: SPIKE_WRITERS[spike_format](table, path))
+
+# loader of the spike tables written by the pipeline: a path of any format, or the CSV name of a table whose
+# columnar files are read instead when they are not older than the CSV
+def load_spike_table(path):
+    path = str(path)
+    spike_format = FORMAT_OF_EXTENSION.get(os.path.splitext(path)[1], 'csv')
+    if spike_format == 'csv':
+        csv_mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        for candidate in LOAD_ORDER:
+            stored = spike_path(path, candidate)
+            if (candidate in ARROW_FORMATS and pyarrow is None) or not os.path.exists(stored):
+                continue
+            if candidate == 'csv' or csv_mtime is None or os.path.getmtime(stored) >= csv_mtime:
+                path, spike_format = stored, candidate
+                break
+    return SPIKE_READERS[spike_format](path)
+
+# DataFrame with the LONG_COLUMNS of a spike table, the cell names categorical (see load_spike_table)
+def load_spikes(path):
+    return load_spike_table(path).to_frame()
+
+# long spike table with its cells renamed at once by mapping (see SpikeTable.renamed), read from any of its formats
+def rename_cells_file(input_csv, output_csv, mapping, formats=DEFAULT_SPIKE_FORMATS):
+    write_spikes(load_spike_table(input_csv).renamed(mapping), output_csv, formats)
+
+# arrays of the spill files, one entry per event
+SPILL_ARRAYS = ('cell_ids', 'times', 'values')
+
+# array spilled to a binary file, empty files cannot be memory mapped
+def read_spill(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+# SpikeTable over arrays that are already compact (spilled, or slices of another table)
+def spike_block(names, cell_ids, times, values):
+    table = SpikeTable.__new__(SpikeTable)
+    table.names = names
+    table.cell_ids, table.times, table.values = cell_ids, times, values
+    return table
+
+# sorted runs appended to one binary file per array (spill_dir/<prefix>-cell_ids.bin, ...), a run is every table
+# appended since the last end_run, read back as memory mapped tables
+class SpillRuns(object):
+    def __init__(self, spill_dir, prefix):
+        self.paths = {name: os.path.join(spill_dir, f'{prefix}-{name}.bin') for name in SPILL_ARRAYS}
+        self.files = {name: open(path, 'wb') for name, path in self.paths.items()}
+        self.bounds = [0]
+        self.size = 0
+
+    def append(self, table):
+        for name in SPILL_ARRAYS:
+            self.files[name].write(getattr(table, name).tobytes())
+        self.size += len(table)
+
+    def end_run(self):
+        if self.size > self.bounds[-1]:
+            self.bounds.append(self.size)
+
+    def close(self):
+        for spill in self.files.values():
+            spill.close()
+
+    def runs(self, names):
+        arrays = [read_spill(self.paths[name], dtype)
+                  for name, dtype in zip(SPILL_ARRAYS, (CELL_ID_DTYPE, TIME_DTYPE, VALUE_DTYPE))]
+        return [spike_block(names, *[array[start:stop] for array in arrays])
+                for start, stop in zip(self.bounds[:-1], self.bounds[1:])]
+
+    def remove(self):
+        for path in self.paths.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+# k-way merge of runs sorted by cell then time (memory mapped SpikeTables) handed to write block by block, in order
+# every run is read block_events events at a time and a heap holds the last buffered key (cell id, time, run) of
+# every run: the buffered events up to the smallest of them come before every event not read yet, they are written
+# and the run it belongs to, now empty, is read further. Events with the same cell and time keep the run order
+# memory holds block_events events per run, whatever the length of the session or the number of events of a cell
+def merge_runs(runs, write, block_events=MERGE_BLOCK_EVENTS):
+    positions = [0] * len(runs)
+    buffers = [None] * len(runs)
+    heap = []
+
+    def refill(run_i):
+        run = runs[run_i]
+        start, stop = positions[run_i], min(positions[run_i] + block_events, len(run))
+        positions[run_i] = stop
+        buffers[run_i] = spike_block(run.names, *[np.array(getattr(run, name)[start:stop]) for name in SPILL_ARRAYS])
+        if stop > start:
+            heapq.heappush(heap, (int(run.cell_ids[stop - 1]), float(run.times[stop - 1]), run_i))
+
+    for run_i in range(len(runs)):
+        refill(run_i)
+    while heap:
+        cell_id, time, run_i = heapq.heappop(heap)
+        parts = []
+        for other_i, buffer in enumerate(buffers):
+            # the events before the key, a prefix of the sorted buffer
+            first, last = np.searchsorted(buffer.cell_ids, [cell_id, cell_id + 1])
+            count = first + np.searchsorted(buffer.times[first:last], time, 'right' if other_i <= run_i else 'left')
+            if count:
+                parts.append(buffer.take(slice(0, count)))
+                buffers[other_i] = buffer.take(slice(count, None))
+        if parts:
+            write(spike_block(parts[0].names, *[np.concatenate([getattr(part, name) for part in parts])
+                                                for name in SPILL_ARRAYS]).sorted())
+        refill(run_i)
+
+# writes a spike table block by block under the name csv_path in its formats, each file next to its final path
+# until close renames it in place: the CSV appended as text, Parquet one row group and Feather one record batch for
+# every block_events events, npz spilled and saved from memory mapped arrays once every block is written
+class SpikeTableWriter(object):
+    def __init__(self, csv_path, names, formats, spill_dir, block_events=MERGE_BLOCK_EVENTS):
+        self.names = names
+        self.block_events = block_events
+        self.paths = {spike_format: spike_path(csv_path, spike_format) for spike_format in formats}
+        self.temp_paths = {spike_format: f'{path}.{os.getpid()}.tmp' for spike_format, path in self.paths.items()}
+        self.csv = None
+        if 'csv' in formats:
+            self.csv = open(self.temp_paths['csv'], 'w', newline='')
+            self.csv.write(pd.DataFrame(columns=LONG_COLUMNS).to_csv(index=False))
+        self.arrow_writers = {}
+        self.pending = []
+        self.spill = SpillRuns(spill_dir, 'output') if 'npz' in formats else None
+
+    def write(self, block):
+        if self.csv is not None:
+            block.to_csv(self.csv, header=False)
+        if self.spill is not None:
+            self.spill.append(block)
+        if any(spike_format in ARROW_FORMATS for spike_format in self.paths):
+            self.pending.append(block)
+            if sum(len(pending) for pending in self.pending) >= self.block_events:
+                self.write_arrow()
+
+    # pending blocks as one row group / record batch of every Arrow format, the writers opened by the first one
+    def write_arrow(self):
+        block = spike_block(self.names, *[np.concatenate([getattr(pending, name) for pending in self.pending])
+                                          for name in SPILL_ARRAYS]) if self.pending else \
+            spike_block(self.names, *[np.empty(0, dtype) for dtype in (CELL_ID_DTYPE, TIME_DTYPE, VALUE_DTYPE)])
+        self.pending = []
+        arrow_table = to_arrow(block)
+        for spike_format in ARROW_FORMATS:
+            if spike_format not in self.paths:
+                continue
+            if spike_format not in self.arrow_writers:
+                path = self.temp_paths[spike_format]
+                self.arrow_writers[spike_format] = pyarrow.parquet.ParquetWriter(path, arrow_table.schema) \
+                    if spike_format == 'parquet' else pyarrow.ipc.new_file(path, arrow_table.schema)
+            self.arrow_writers[spike_format].write_table(arrow_table)
+
+    def close(self):
+        if self.csv is not None:
+            self.csv.close()
+        if self.pending or (any(spike_format in ARROW_FORMATS for spike_format in self.paths) and not self.arrow_writers):
+            self.write_arrow()
+        for writer in self.arrow_writers.values():
+            writer.close()
+        if self.spill is not None:
+            self.spill.end_run()
+            self.spill.close()
+            table = self.spill.runs(self.names)
+            table = table[0] if table else \
+                spike_block(self.names, *[np.empty(0, dtype) for dtype in (CELL_ID_DTYPE, TIME_DTYPE, VALUE_DTYPE)])
+            write_npz(table, self.temp_paths['npz'])
+            del table
+        for spike_format, path in self.paths.items():
+            os.replace(self.temp_paths[spike_format], path)
+
+    # temp files of a conversion that failed
+    def discard(self):
+        if self.csv is not None:
+            self.csv.close()
+        for writer in self.arrow_writers.values():
+            writer.close()
+        if self.spill is not None:
+            self.spill.close()
+        for path in self.temp_paths.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+# wide_to_long of a CSV read chunk_rows rows at a time: every chunk is converted and sorted into a spill run in
+# spill_dir, then the runs are merged (see merge_runs), at most MERGE_FAN_IN at a time: with more runs, groups of
+# MERGE_FAN_IN runs are first merged into longer runs. Memory holds a chunk (rows x cells) while reading and
+# MERGE_FAN_IN x MERGE_BLOCK_EVENTS events while merging, the whole table is never loaded
+# the merged blocks are written as they come (see SpikeTableWriter)
+def stream_wide_to_long(input_csv, output_csv, chunk_rows=STREAM_CHUNK_ROWS, skip_rows=SKIPPED_ROWS, spill_dir=None,
+                        formats=DEFAULT_SPIKE_FORMATS):
+    formats = resolve_formats(formats)
+    spill_dir = tempfile.mkdtemp(prefix='spike-runs-', dir=spill_dir or os.path.dirname(os.path.abspath(output_csv)))
+    writer = None
+    try:
+        names = None
+        spill = SpillRuns(spill_dir, 'runs-0')
+        try:
+            first_row = 0
+            for chunk in read_wide_csv(input_csv, chunksize=chunk_rows):
+                skipped = max(skip_rows - first_row, 0)
+                first_row += len(chunk)
+                run = SpikeTable.from_wide(chunk, skip_rows=skipped).sorted()
+                names = run.names
+                spill.append(run)
+                spill.end_run()
+        finally:
+            spill.close()
+        if names is None:
+            names = np.asarray(pd.read_csv(input_csv, nrows=0).columns[1:], dtype=object)
+            names.sort()
+        runs = spill.runs(names)
+        merge_pass = 0
+        while len(runs) > MERGE_FAN_IN:
+            merge_pass += 1
+            merged = SpillRuns(spill_dir, f'runs-{merge_pass}')
+            try:
+                for first in range(0, len(runs), MERGE_FAN_IN):
+                    merge_runs(runs[first:first + MERGE_FAN_IN], merged.append, MERGE_BLOCK_EVENTS)
+                    merged.end_run()
+            finally:
+                merged.close()
+            runs = merged.runs(names)
+            spill.remove()
+            spill = merged
+        writer = SpikeTableWriter(output_csv, names, formats, spill_dir, MERGE_BLOCK_EVENTS)
+        merge_runs(runs, writer.write, MERGE_BLOCK_EVENTS)
+        del runs
+        writer.close()
+        writer = None
+    finally:
+        if writer is not None:
+            writer.discard()
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+# convert the wide spike event CSV written by isx to the long table of the pipeline, in memory or by streaming when
+# chunk_rows is set (0 forces the conversion in memory, None streams files above STREAM_MIN_BYTES)
+# the table is written under the name output_csv in every format (see write_spikes), each file is written next to
+# its final path and renamed, an interrupted conversion never leaves a partial file
+def vertical_alignment(input_csv, output_csv, skip_rows=SKIPPED_ROWS, chunk_rows=None, formats=DEFAULT_SPIKE_FORMATS):
+    if chunk_rows is None and os.path.getsize(input_csv) > STREAM_MIN_BYTES:
+        chunk_rows = STREAM_CHUNK_ROWS
+    if chunk_rows:
+        stream_wide_to_long(input_csv, output_csv, chunk_rows=chunk_rows, skip_rows=skip_rows, formats=formats)
+    else:
+        write_spikes(SpikeTable.from_wide(read_wide_csv(input_csv), skip_rows).sorted(), output_csv, formats)
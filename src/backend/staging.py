@@ -0,0 +1,55 @@
+import os
+import shutil
+
+# Directory next to the outputs in which the steps write their files before they are moved to their final paths.
+# Every output is staged in the folder it goes to (output folder or scratch folder) so the move is an atomic rename.
+STAGING_DIR_NAME = 'staging'
+
+# files of one run of a step (name), written to private staging directories and moved to their final paths only once
+# the whole call succeeded, so an interrupted step never leaves truncated outputs that look finished
+# used as a context manager, staged(path or list of paths) gives the staged path(s) the step has to write to, files
+# it modifies in place (modified) are copied in first so the originals stay intact until commit()
+# leaving the block without commit() (an error) throws the staged files away, the final paths are untouched
+class Staging(object):
+    def __init__(self, name, outputs, modified=()):
+        self.name = name
+        self.outputs = list(outputs)
+        self.modified = list(modified)
+
+    def staging_dir(self, path):
+        return os.path.join(os.path.dirname(os.path.abspath(path)), STAGING_DIR_NAME, self.name)
+
+    def staging_dirs(self):
+        return sorted({self.staging_dir(path) for path in self.outputs + self.modified})
+
+    def __enter__(self):
+        # left over by a run of the same step that was killed
+        self.discard()
+        for staging_dir in self.staging_dirs():
+            os.makedirs(staging_dir)
+        for path in self.modified:
+            shutil.copy2(path, self.path(path))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.discard()
+
+    def path(self, path):
+        return os.path.join(self.staging_dir(path), os.path.basename(path))
+
+    def __call__(self, paths):
+        if isinstance(paths, str):
+            return self.path(paths)
+        return [self.path(path) for path in paths]
+
+    # move every staged file to its final path, each move is an atomic rename that replaces an earlier version
+    def commit(self):
+        missing = [path for path in self.outputs if not os.path.exists(self.path(path))]
+        if missing:
+            raise FileNotFoundError(f'The step did not write {missing}')
+        for path in self.outputs + self.modified:
+            os.replace(self.path(path), path)
+
+    def discard(self):
+        for staging_dir in self.staging_dirs():
+            shutil.rmtree(staging_dir, ignore_errors=True)
@@ -0,0 +1,195 @@
+import os
+import json
+import shutil
+import hashlib
+from src.backend.staging import Staging
+
+# Cache of the outputs of the processing steps, keyed by the step name, its parameters and the identity of its input
+# files, so a step only runs again when one of them changed
+# cache_dir/
+#   <step>/<label>.json      key and output identities of the last successful run of the step for a day (label)
+#   <step>/<key>/<output>    hard links to the outputs of every run, restored when the same key comes back
+#   aliases/<file>.json      identities of files modified in place by a step, mapped to their identity before it
+#   released/<file>.json     identity of intermediate files deleted by the retention policy, and where a copy is kept
+# Released files still count as the outputs and inputs they were, steps that need them to run again get the kept copy
+# back, or fail when no copy was kept.
+# The steps write to a staging directory (see Staging) and their outputs are only moved to their final paths when the
+# call succeeded, the manifest is written last so a run killed at any point is simply run again.
+# Hard links keep the outputs of earlier parameters next to the current ones without copying the movies. When they are
+# not supported (other file system) only the current outputs are kept.
+
+CACHE_DIR_NAME = 'step_cache'
+# Bump when the key computation changes so that every step is run again
+CACHE_VERSION = 1
+HASH_CHUNK_SIZE = 16 << 20
+
+def content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# size and modification time of a file, or the hash of its content with use_content
+def file_identity(path, use_content=False):
+    if use_content:
+        return content_hash(path)
+    stat = os.stat(path)
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+class StepCache(object):
+    def __init__(self, cache_dir, use_content=False):
+        self.cache_dir = str(cache_dir)
+        self.use_content = use_content
+
+    def step_dir(self, step_name):
+        return os.path.join(self.cache_dir, step_name)
+
+    def manifest_path(self, step_name, label):
+        return os.path.join(self.step_dir(step_name), f'{label}.json')
+
+    def alias_path(self, path):
+        return os.path.join(self.cache_dir, 'aliases', os.path.basename(path) + '.json')
+
+    def released_path(self, path):
+        return os.path.join(self.cache_dir, 'released', os.path.basename(path) + '.json')
+
+    def read_json(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_json(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_path, path)
+
+    # identity of an input file as the steps that read it first saw it (see store, files modified in place)
+    # the recorded identity for a released file, None for a missing one
+    def input_identity(self, path):
+        if not os.path.exists(path):
+            return self.released(path).get('identity')
+        identity = file_identity(path, self.use_content)
+        return self.read_json(self.alias_path(path)).get(identity, identity)
+
+    # record of a released file that is not back on disk, empty otherwise
+    def released(self, path):
+        return {} if os.path.exists(path) else self.read_json(self.released_path(path))
+
+    # delete an intermediate file whose consumers are done, moving it to keep_path when given
+    # its hard links in the archives go too, otherwise they would keep the data on disk
+    def release(self, path, keep_path=None):
+        self.write_json(self.released_path(path), {'identity': self.input_identity(path), 'kept': keep_path})
+        for link in self.archived_links(path):
+            os.remove(link)
+        if keep_path is None:
+            os.remove(path)
+        else:
+            # the move keeps the modification time so the copy has the same identity
+            shutil.move(path, keep_path)
+
+    def archived_links(self, path):
+        links = []
+        for step_name in os.listdir(self.cache_dir) if os.path.isdir(self.cache_dir) else []:
+            step_dir = self.step_dir(step_name)
+            for archive in os.listdir(step_dir) if os.path.isdir(step_dir) else []:
+                link = os.path.join(step_dir, archive, os.path.basename(path))
+                if os.path.exists(link) and os.path.samefile(link, path):
+                    links.append(link)
+        return links
+
+    # put released inputs back from their kept copies before a step reads them
+    def bring_back(self, step_name, inputs):
+        for path in inputs:
+            if os.path.exists(path):
+                continue
+            kept = self.released(path).get('kept')
+            if kept is None or not os.path.exists(kept):
+                raise FileNotFoundError(f'{step_name} needs {path}, which is missing or was deleted by the retention '
+                                        f'policy, run the steps that write it again with a policy that keeps it')
+            shutil.copy2(kept, path)
+
+    # hash of the step name, its parameters (any JSON serializable values) and the identity of its input files
+    def key(self, step_name, inputs, params):
+        description = {'version': CACHE_VERSION, 'step': step_name, 'params': params,
+                       'inputs': [[os.path.basename(path), self.input_identity(path)] for path in inputs]}
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    # whether the outputs on disk are the ones written by the last run of the step for this key
+    def is_current(self, step_name, label, key, outputs):
+        manifest = self.read_json(self.manifest_path(step_name, label))
+        if manifest.get('key') != key:
+            return False
+        recorded = manifest.get('outputs', {})
+        for path in outputs:
+            # outputs later modified in place by another step are compared by their identity before the change
+            if recorded.get(os.path.basename(path)) != self.input_identity(path):
+                return False
+        return True
+
+    # put back the outputs of an earlier run with the same key, returns False if they are not all archived
+    # an archived file changed since (a hard link shares the edits made to the output) is not restored
+    def restore(self, step_name, label, key, outputs):
+        archive = os.path.join(self.step_dir(step_name), key[:16])
+        archived = [os.path.join(archive, os.path.basename(path)) for path in outputs]
+        if not outputs or not all(os.path.exists(path) for path in archived):
+            return False
+        recorded = self.read_json(os.path.join(archive, 'manifest.json')).get('outputs', {})
+        if any(recorded.get(os.path.basename(path)) != self.input_identity(path) for path in archived):
+            return False
+        for source, path in zip(archived, outputs):
+            if os.path.exists(path):
+                os.remove(path)
+            try:
+                os.link(source, path)
+            except OSError:
+                shutil.copy2(source, path)
+        self.write_json(self.manifest_path(step_name, label), self.read_json(os.path.join(archive, 'manifest.json')))
+        return True
+
+    # record the outputs of a successful run and archive them under its key
+    # modified lists the inputs the step changed in place, identities_before their identity before the run
+    def store(self, step_name, label, key, outputs, modified=(), identities_before=None):
+        for path in modified:
+            aliases = self.read_json(self.alias_path(path))
+            aliases[file_identity(path, self.use_content)] = identities_before[path]
+            self.write_json(self.alias_path(path), aliases)
+        manifest = {'key': key, 'outputs': {os.path.basename(path): file_identity(path, self.use_content)
+                                             for path in outputs}}
+        archive = os.path.join(self.step_dir(step_name), key[:16])
+        os.makedirs(archive, exist_ok=True)
+        for path in outputs:
+            link = os.path.join(archive, os.path.basename(path))
+            if os.path.exists(link):
+                os.remove(link)
+            try:
+                os.link(path, link)
+            except OSError:
+                # no hard links here, the outputs of other parameters are not kept
+                pass
+        self.write_json(os.path.join(archive, 'manifest.json'), manifest)
+        self.write_json(self.manifest_path(step_name, label), manifest)
+
+    # run call(staged) unless the outputs for these inputs and parameters are already on disk or archived
+    # call writes every output to staged(output) (see Staging) and changes the inputs listed in modified (they are not
+    # outputs of the key) through staged(input), the files only replace the final ones once call returned
+    # returns 'cached', 'restored' or 'ran'
+    def run(self, step_name, label, inputs, outputs, params, call, modified=()):
+        key = self.key(step_name, inputs, params)
+        if self.is_current(step_name, label, key, outputs):
+            print(f'{label} {step_name} is up to date, skipped')
+            return 'cached'
+        if self.restore(step_name, label, key, outputs):
+            print(f'{label} {step_name} restored from the step cache')
+            return 'restored'
+        self.bring_back(step_name, list(inputs) + list(modified))
+        identities_before = {path: self.input_identity(path) for path in modified}
+        with Staging(f'{step_name}-{label}', outputs, modified) as staged:
+            call(staged)
+            staged.commit()
+        self.store(step_name, label, key, outputs, modified=modified, identities_before=identities_before)
+        return 'ran'
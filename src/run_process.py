@@ -1,32 +1,195 @@
+import os
 import sys
-sys.path.append(r"C:\Users\Gianna\Documents\Python Scripts\time_series_and_LR_processing")
+import json
+import time
+import hashlib
+import argparse
 from src.backend.Timeseries import Timeseries
 from src.backend.LongitudinalRegistration import LongitudinalRegistration
+from src.backend.spiketable import DEFAULT_SPIKE_FORMATS
+from src.workutils.StepScheduler import StepScheduler, run_schedulers, NUM_STEP_WORKERS
 
-# command line functions to run without using GUI and manually entering paths
-def run_timeseries(data_dir, output_folder):
-    t = Timeseries(data_dir, output_folder_name=output_folder)
-    t.preprocess(2,4)
-    t.bandpass_filter()
-    t.mean_projection_frame()
-    t.motion_correct()
-    t.cnmfe_apply()
-    t.export_cell_set_to_tiff()
-    t.event_detection_auto_classification()
-    t.deconvolve_cells()
-    t.export_spike_events_to_csv()
-    t.vertical_csv_alignment()
-
-def run_lr(data_dir, output_folder):
-    l = LongitudinalRegistration(data_dir, output_folder)
-    l.calculate_dff()
-    l.longitudinal_registration()
-    l.store_cnmfe_cellset_output()
-    l.rename_cells_from_timeseries()
-
-####** change data_dir variable to the folder path that contains .isxd files**####
-####** change output_folder_name to the name of the subfolder you want to create within the provided data_dir **####
-data_directory = r"H:\Miso\20231007_redownload"
-#t = Timeseries(data_directory, 't')
-run_timeseries(data_directory, 'processed')
-#run_lr(data_directory, 'wait')
\ No newline at end of file
+# Headless batch processing of many experiments without the GUI
+# run from the repository root: python -m src.run_process batch.json [--max-workers 4] [--log run.jsonl] [--resume]
+# the batch file is a JSON object:
+# {
+#     "max_workers": 4,                               optional, steps running at the same time over all experiments
+#     "defaults": {...},                              optional, entries shared by every experiment
+#     "experiments": [
+#         {"name": "miso",                            optional, defaults to the mouse and data folder
+#          "data_dir": "H:/Miso/20231007",           folder holding the .isxd recordings
+#          "output_folder": "processed",             subfolder of data_dir receiving the outputs
+#          "mouse": "miso",
+#          "stages": ["timeseries", "lr"],           optional, both by default
+#          "fused": false,                           optional, fused_motion_correct instead of the four steps
+#          "day_workers": 1, "scratch_dir": null, "retention": "all",     optional, see Process
+#          "spike_formats": ["csv", "columnar"],                         optional, files of the spike tables
+#          "params": {"cnmfe_apply": {"cell_diameter": 9}}}              optional, keyword arguments per step
+#     ]
+# }
+# every step of every experiment is one node of a single graph (see run_schedulers), the LR stage of an experiment
+# waits for the timeseries files it reads. Steps already done are skipped by the step cache, with --resume the
+# experiments the log records as done with the same settings are not even opened.
+# progress is appended to the log as one JSON object per line (event, experiment, step, errors, time)
+
+STAGES = ('timeseries', 'lr')
+TIMESERIES_STEPS = ['preprocess', 'bandpass_filter', 'mean_projection_frame', 'motion_correct', 'cnmfe_apply',
+                    'export_cell_set_to_tiff', 'event_detection_auto_classification', 'deconvolve_cells',
+                    'export_spike_events_to_csv', 'vertical_csv_alignment']
+FUSED_STEPS = ['fused_motion_correct']
+LR_STEPS = ['calculate_dff', 'longitudinal_registration', 'store_cnmfe_cellset_output', 'rename_cells_from_timeseries']
+# keyword arguments of the steps that need some, the values used by the GUI and the isx defaults
+DEFAULT_STEP_PARAMS = {
+    'preprocess': {'tp_downsampling': 2, 'sp_downsampling': 4},
+    'fused_motion_correct': {'tp_downsampling': 2, 'sp_downsampling': 4},
+    'cnmfe_apply': {'cell_diameter': 7},
+    'deconvolve_cells': {'snr_threshold': 3.0},
+}
+DEFAULT_LOG_NAME = 'batch_log.jsonl'
+
+# command line functions to run a single experiment without the GUI
+def run_timeseries(data_dir, output_folder, mouse):
+    return run_batch([{'data_dir': data_dir, 'output_folder': output_folder, 'mouse': mouse, 'stages': ['timeseries']}])
+
+def run_lr(data_dir, output_folder, mouse):
+    return run_batch([{'data_dir': data_dir, 'output_folder': output_folder, 'mouse': mouse, 'stages': ['lr']}])
+
+# appends one JSON object per line, so a crashed run still leaves a readable log
+class BatchLog(object):
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, event, **fields):
+        record = dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), event=event, **fields)
+        if self.path is None:
+            return record
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+        return record
+
+    def read(self):
+        if self.path is None or not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # last line of a run that was killed while writing it
+                    continue
+        return records
+
+    # keys of the experiments whose last run finished without errors
+    def completed(self):
+        status = {}
+        for record in self.read():
+            if record.get('event') == 'experiment_finished':
+                status[record.get('key')] = record.get('status')
+        return {key for key, value in status.items() if value == 'done'}
+
+# settings of an experiment with the batch defaults applied, checked for the entries a run needs
+def experiment_settings(experiment, defaults=None):
+    settings = dict(defaults or {})
+    settings.update(experiment)
+    params = {step: dict(values) for step, values in DEFAULT_STEP_PARAMS.items()}
+    for step, values in (settings.get('params') or {}).items():
+        params.setdefault(step, {}).update(values)
+    settings['params'] = params
+    settings.setdefault('stages', list(STAGES))
+    settings.setdefault('name', f"{settings.get('mouse')}:{settings.get('data_dir')}")
+    missing = [key for key in ('data_dir', 'output_folder', 'mouse') if not settings.get(key)]
+    if missing:
+        raise ValueError(f"Experiment {settings['name']} is missing {missing}")
+    unknown = [stage for stage in settings['stages'] if stage not in STAGES]
+    if unknown:
+        raise ValueError(f"Experiment {settings['name']} has unknown stages {unknown}, expected some of {list(STAGES)}")
+    return settings
+
+# identifies the settings of an experiment in the log, a changed entry is run again with --resume
+def experiment_key(settings):
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+# one scheduler per stage of an experiment, steps queued in pipeline order with their parameters
+def experiment_schedulers(settings, on_step_finished):
+    options = {'scratch_dir': settings.get('scratch_dir'), 'retention': settings.get('retention', 'all'),
+               'spike_formats': settings.get('spike_formats', DEFAULT_SPIKE_FORMATS)}
+    schedulers = []
+    for stage in settings['stages']:
+        if stage == 'timeseries':
+            process_object = Timeseries(settings['data_dir'], settings['output_folder'], settings['mouse'],
+                                        day_workers=settings.get('day_workers', 1), **options)
+            steps = (FUSED_STEPS + TIMESERIES_STEPS[4:]) if settings.get('fused') else TIMESERIES_STEPS
+        else:
+            process_object = LongitudinalRegistration(settings['data_dir'], settings['output_folder'],
+                                                      settings['mouse'], **options)
+            steps = LR_STEPS
+        scheduler = StepScheduler(process_object, on_step_finished=on_step_finished)
+        for step in steps:
+            scheduler.add_step(step, **settings['params'].get(step, {}))
+        schedulers.append(scheduler)
+    return schedulers
+
+# run every experiment, at most max_workers steps at the same time over all of them
+# returns {experiment name: {node name: error}} for the experiments that failed
+def run_batch(experiments, defaults=None, max_workers=NUM_STEP_WORKERS, log_path=None, resume=False):
+    log = BatchLog(log_path)
+    completed = log.completed() if resume else set()
+    log.write('batch_started', experiments=len(experiments), max_workers=max_workers)
+    failures = {}
+    running = []
+    for experiment in experiments:
+        settings = experiment_settings(experiment, defaults)
+        key = experiment_key(settings)
+        name = settings['name']
+        if key in completed:
+            log.write('experiment_skipped', experiment=name, key=key)
+            continue
+        on_step_finished = lambda step, errors, name=name: log.write(
+            'step_finished', experiment=name, step=step, errors=[str(e) for e in errors])
+        try:
+            schedulers = experiment_schedulers(settings, on_step_finished)
+        except Exception as e:
+            # recordings missing or unreadable, the other experiments still run
+            failures[name] = {'setup': e}
+            log.write('experiment_finished', experiment=name, key=key, status='failed', errors={'setup': str(e)})
+            continue
+        log.write('experiment_started', experiment=name, key=key, stages=settings['stages'])
+        running.append((name, key, schedulers))
+    results = run_schedulers([scheduler for _, _, schedulers in running for scheduler in schedulers],
+                             max_workers=max_workers) if running else []
+    position = 0
+    for name, key, schedulers in running:
+        errors = {}
+        for result in results[position:position + len(schedulers)]:
+            errors.update(result)
+        position += len(schedulers)
+        if errors:
+            failures[name] = errors
+        log.write('experiment_finished', experiment=name, key=key, status='failed' if errors else 'done',
+                  errors={node: str(error) for node, error in errors.items()})
+    log.write('batch_finished', failed=sorted(failures))
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the timeseries and longitudinal registration steps of many '
+                                                 'experiments without the GUI')
+    parser.add_argument('batch_file', help='JSON file listing the experiments, see src/run_process.py')
+    parser.add_argument('--max-workers', type=int, help='steps running at the same time over all experiments '
+                                                        f'(default {NUM_STEP_WORKERS}, see StepScheduler.NUM_STEP_WORKERS)')
+    parser.add_argument('--log', help=f'JSON lines progress log, {DEFAULT_LOG_NAME} next to the batch file by default')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the experiments the log records as done with the same settings')
+    args = parser.parse_args(argv)
+    with open(args.batch_file) as f:
+        batch = json.load(f)
+    max_workers = args.max_workers or batch.get('max_workers') or NUM_STEP_WORKERS
+    log_path = args.log or os.path.join(os.path.dirname(os.path.abspath(args.batch_file)), DEFAULT_LOG_NAME)
+    failures = run_batch(batch['experiments'], defaults=batch.get('defaults'), max_workers=max_workers,
+                         log_path=log_path, resume=args.resume)
+    for name, errors in failures.items():
+        print(f'Error: {name} failed: {", ".join(errors)}')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
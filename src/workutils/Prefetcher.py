@@ -0,0 +1,99 @@
+import time
+import queue
+import threading
+
+# read-ahead for sequential consumers: a background thread reads the next blocks while the current one is analysed
+# read_block(start, stop) is called for every [start, stop) range in order and must return the data fully loaded in
+# memory (for memory-mapped arrays copy the view, otherwise the disk access just moves to the consumer)
+# at most depth blocks are held ahead of the consumer (2 = double buffering)
+# iterating yields (start, stop, data) tuples, the time spent by the consumer stalled waiting for the reader (I/O)
+# and working between two blocks (compute) is accumulated in stats
+class Prefetcher(object):
+    _done = object()
+
+    def __init__(self, read_block, ranges, depth=2):
+        self.read_block = read_block
+        self.ranges = list(ranges)
+        self.depth = max(int(depth), 1)
+        self.stats = {'blocks': 0, 'io_wait_seconds': 0.0, 'compute_seconds': 0.0, 'read_seconds': 0.0}
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _read(self):
+        try:
+            for start, stop in self.ranges:
+                if self._stop.is_set():
+                    return
+                read_start = time.perf_counter()
+                data = self.read_block(start, stop)
+                self.stats['read_seconds'] += time.perf_counter() - read_start
+                self._put((start, stop, data))
+            self._put(self._done)
+        except BaseException as e:
+            self._put(e)
+
+    # put that gives up when the consumer stopped iterating, so the thread never blocks on a full queue forever
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                wait_start = time.perf_counter()
+                item = self._queue.get()
+                got_item = time.perf_counter()
+                self.stats['io_wait_seconds'] += got_item - wait_start
+                if item is self._done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                self.stats['blocks'] += 1
+                yield item
+                self.stats['compute_seconds'] += time.perf_counter() - got_item
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+# split [start, stop) in consecutive ranges of block_size
+def block_ranges(start, stop, block_size):
+    return [(block_start, min(block_start + block_size, stop)) for block_start in range(start, stop, block_size)]
+
+# iterate over (start, stop, data) blocks, read ahead on a background thread when depth > 0 and inline otherwise
+# stats is an optional dict in which the prefetcher statistics are accumulated, also when the consumer stops early
+# or raises
+def iterate_blocks(read_block, ranges, depth=2, stats=None):
+    if depth > 0:
+        prefetcher = Prefetcher(read_block, ranges, depth=depth)
+        stats_source = prefetcher.stats
+    else:
+        stats_source = {'blocks': 0, 'io_wait_seconds': 0.0, 'compute_seconds': 0.0, 'read_seconds': 0.0}
+    try:
+        if depth > 0:
+            yield from prefetcher
+        else:
+            for start, stop in ranges:
+                read_start = time.perf_counter()
+                data = read_block(start, stop)
+                read_end = time.perf_counter()
+                stats_source['read_seconds'] += read_end - read_start
+                stats_source['io_wait_seconds'] += read_end - read_start
+                stats_source['blocks'] += 1
+                yield start, stop, data
+                stats_source['compute_seconds'] += time.perf_counter() - read_end
+    finally:
+        if stats is not None:
+            for key, value in stats_source.items():
+                stats[key] = stats.get(key, 0) + value
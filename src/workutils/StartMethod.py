@@ -0,0 +1,3 @@
+# start method of every process pool of the pipeline (corrupt frame scans, days of a stage, steps of the scheduler)
+# isx keeps native threads alive once a file is opened, forked workers can deadlock in them so always spawn
+START_METHOD = 'spawn'
@@ -0,0 +1,230 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from src.workutils.StartMethod import START_METHOD
+
+# Number of steps run at the same time by the scheduler: every step can hold whole movies in memory, so the default
+# stays low enough for 16 GB workstations, larger machines raise it with the STEP_WORKERS_VARIABLE environment variable
+# (GUI and command line) or with --max-workers / "max_workers" (see run_process)
+DEFAULT_STEP_WORKERS = 2
+STEP_WORKERS_VARIABLE = 'INSCOPIX_STEP_WORKERS'
+
+# number of steps run at the same time set in environ, DEFAULT_STEP_WORKERS when unset or invalid
+def configured_step_workers(environ=os.environ):
+    value = environ.get(STEP_WORKERS_VARIABLE)
+    if not value:
+        return DEFAULT_STEP_WORKERS
+    try:
+        workers = int(value)
+    except ValueError:
+        workers = 0
+    if workers < 1:
+        print(f'Ignoring {STEP_WORKERS_VARIABLE}={value}, expected a positive number of steps, '
+              f'running {DEFAULT_STEP_WORKERS} at a time')
+        return DEFAULT_STEP_WORKERS
+    return workers
+
+NUM_STEP_WORKERS = configured_step_workers()
+
+# one call of a step: a single day (day_i set, runs <step>_day) or the whole step (day_i None)
+class StepNode(object):
+    def __init__(self, step, day_i=None, day_label=None, inputs=(), outputs=(), scheduler=None):
+        self.step = step
+        self.scheduler = scheduler
+        self.day_i = day_i
+        self.day_label = day_label
+        self.inputs = set(inputs)
+        self.outputs = set(outputs)
+        self.dependencies = set()
+        self.state = 'waiting'
+        self.error = None
+
+    def __repr__(self):
+        return self.step.name if self.day_label is None else f'{self.step.name}[{self.day_label}]'
+
+class Step(object):
+    def __init__(self, name, args, kwargs, io):
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.io = io
+        self.nodes = []
+
+# runs the steps of a process object as a dependency graph instead of a linear queue
+# the process object declares what every step reads and writes in its step_io dictionary (see Timeseries.step_io):
+#   'inputs' / 'outputs': names of its per-day file lists (or single file attributes)
+#   'after': steps that have to finish first although no file connects them
+#   'local': run in this process (steps that only update the object or start their own pool)
+# steps with a <step>_day method get one node per day, the others one node for the whole experiment
+# a node depends on the nodes of earlier steps that write one of its inputs, and on its 'after' steps (only the same
+# day when both run per day), steps without a declaration depend on the step queued before them
+# nodes are dispatched as soon as their dependencies succeeded and their input files exist, up to max_workers at a
+# time in spawned processes, a failing node skips the nodes that depend on it and leaves the others running
+# a node fails when it raises or returns a non-empty {day label: error} dictionary (see Process.run_days)
+# once every node reading a file succeeded and wrote its outputs, the file is handed to
+# process_object.release_intermediates (retention)
+# on_step_finished(step name, errors) is called once every node of a step is done, after process_object's run report
+# was rewritten (see Process.write_run_report)
+class StepScheduler(object):
+    def __init__(self, process_object, max_workers=NUM_STEP_WORKERS, on_step_finished=None):
+        self.process_object = process_object
+        self.max_workers = max_workers
+        self.on_step_finished = on_step_finished
+        self.steps = []
+        self.consumers = {}
+
+    def add_step(self, method_name, *args, **kwargs):
+        io = getattr(self.process_object, 'step_io', {}).get(method_name)
+        self.steps.append(Step(method_name, args, kwargs, io))
+
+    # per-day files of a step_io attribute, or all of its files when day_i is None
+    def files(self, attribute, day_i=None):
+        value = getattr(self.process_object, attribute)
+        if isinstance(value, str):
+            return [value]
+        if day_i is not None:
+            value = value[day_i]
+            return [value] if isinstance(value, str) else list(value)
+        return [path for day in value for path in ([day] if isinstance(day, str) else day)]
+
+    def is_per_day(self, step):
+        return step.io is not None and hasattr(self.process_object, f'{step.name}_day') and \
+            hasattr(self.process_object, 'day_labels')
+
+    def build_graph(self):
+        nodes = []
+        for step_i, step in enumerate(self.steps):
+            io = step.io or {}
+            if self.is_per_day(step):
+                step.nodes = [StepNode(step, day_i, day_label,
+                                       [f for attribute in io.get('inputs', []) for f in self.files(attribute, day_i)],
+                                       [f for attribute in io.get('outputs', []) for f in self.files(attribute, day_i)],
+                                       scheduler=self)
+                              for day_i, day_label in enumerate(self.process_object.day_labels)]
+            else:
+                step.nodes = [StepNode(step, inputs=[f for attribute in io.get('inputs', []) for f in self.files(attribute)],
+                                       outputs=[f for attribute in io.get('outputs', []) for f in self.files(attribute)],
+                                       scheduler=self)]
+            after = set(io.get('after', []))
+            for node in step.nodes:
+                for other in nodes:
+                    if other.outputs & node.inputs:
+                        node.dependencies.add(other)
+                    elif other.step.name in after and (other.day_i is None or node.day_i is None or other.day_i == node.day_i):
+                        node.dependencies.add(other)
+                if step.io is None and step_i > 0:
+                    node.dependencies.update(self.steps[step_i - 1].nodes)
+            nodes.extend(step.nodes)
+        return nodes
+
+    def is_available(self, path):
+        return getattr(self.process_object, 'is_available', os.path.exists)(path)
+
+    # inputs of a finished node that no other node still has to read, kept while one of its outputs is missing
+    def release_inputs(self, node):
+        release = getattr(self.process_object, 'release_intermediates', None)
+        if release is None:
+            return
+        missing = [path for path in sorted(node.outputs) if not self.is_available(path)]
+        if missing:
+            print(f'Error: {node} did not write {missing}, its inputs are kept')
+            return
+        done = [path for path in sorted(node.inputs) if all(n.state == 'done' for n in self.consumers[path])]
+        if done:
+            try:
+                release(done)
+            except OSError as e:
+                # the files stay where they are, the next run tries again
+                print(f'Error: could not release {done}: {e}')
+
+    def submit(self, node, executor, local_executor):
+        method_name = f'{node.step.name}_day' if node.day_i is not None else node.step.name
+        method = getattr(self.process_object, method_name)
+        args = ((node.day_i, node.day_label) if node.day_i is not None else ()) + tuple(node.step.args)
+        local = (node.step.io or {}).get('local', False) or executor is None
+        return (local_executor if local else executor).submit(method, *args, **node.step.kwargs)
+
+    def finish_node(self, node, state, error=None):
+        node.state = state
+        node.error = error
+        if error is not None:
+            print(f'Error: {node} failed: {error}')
+        step = node.step
+        if not all(n.state in ('done', 'failed', 'skipped') for n in step.nodes):
+            return
+        # days run as separate nodes only append their timings, the report is rebuilt once the step is over
+        write_run_report = getattr(self.process_object, 'write_run_report', None)
+        if write_run_report is not None:
+            write_run_report()
+        if self.on_step_finished is not None:
+            self.on_step_finished(step.name, [n.error for n in step.nodes if n.error is not None])
+
+    # run every step, returns {node name: error} for the nodes that failed or were skipped
+    def run(self):
+        return run_schedulers([self], self.max_workers)[0]
+
+# run the steps of several schedulers (experiments, or the timeseries and LR stages of one) as a single graph with at
+# most max_workers nodes running at the same time, nodes also wait for the nodes of the schedulers listed before
+# theirs that write one of their inputs, and a file is only released once the nodes of every scheduler read it
+# returns the {node name: error} dictionary of every scheduler
+def run_schedulers(schedulers, max_workers=NUM_STEP_WORKERS):
+    nodes = []
+    for scheduler in schedulers:
+        scheduler_nodes = scheduler.build_graph()
+        for node in scheduler_nodes:
+            node.dependencies.update(other for other in nodes if other.outputs & node.inputs)
+        nodes.extend(scheduler_nodes)
+    consumers = {}
+    for node in nodes:
+        for path in node.inputs:
+            consumers.setdefault(path, []).append(node)
+    for scheduler in schedulers:
+        scheduler.consumers = consumers
+    running = {}
+    executor = None
+    if max_workers > 1:
+        # the process objects derive their paths here, once, the spawned nodes get them with the object instead of
+        # all writing the manifest at the same time (see Process.manifest)
+        for scheduler in schedulers:
+            getattr(scheduler.process_object, 'manifest', None)
+        executor = ProcessPoolExecutor(max_workers=max_workers,
+                                       mp_context=multiprocessing.get_context(START_METHOD))
+    local_executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        while True:
+            for node in nodes:
+                if node.state != 'waiting':
+                    continue
+                scheduler = node.scheduler
+                if any(d.state in ('failed', 'skipped') for d in node.dependencies):
+                    scheduler.finish_node(node, 'skipped', RuntimeError(f'{node} skipped, an upstream step failed'))
+                elif all(d.state == 'done' for d in node.dependencies) and len(running) < max_workers:
+                    missing = [path for path in node.inputs if not scheduler.is_available(path)]
+                    if missing:
+                        scheduler.finish_node(node, 'failed', FileNotFoundError(f'{node} is missing {missing}'))
+                        continue
+                    node.state = 'running'
+                    running[scheduler.submit(node, executor, local_executor)] = node
+            if not running:
+                break
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    node.scheduler.finish_node(node, 'failed', e)
+                    continue
+                if isinstance(result, dict) and result:
+                    # whole step running its days itself, some of them failed
+                    node.scheduler.finish_node(node, 'failed', RuntimeError(
+                        f'{node} failed for {", ".join(f"{day}: {error}" for day, error in result.items())}'))
+                    continue
+                node.scheduler.finish_node(node, 'done')
+                node.scheduler.release_inputs(node)
+    finally:
+        local_executor.shutdown()
+        if executor is not None:
+            executor.shutdown()
+    return [{repr(node): node.error for node in nodes if node.scheduler is scheduler and node.error is not None}
+            for scheduler in schedulers]
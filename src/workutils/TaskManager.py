@@ -1,27 +1,38 @@
 from PyQt5.QtCore import Qt, QObject, pyqtSignal as Signal, pyqtSlot as Slot, QThreadPool
 from src.workutils.WorkerThread import Worker
+from src.workutils.StepScheduler import StepScheduler, NUM_STEP_WORKERS
 from src.backend.Timeseries import Timeseries
 from src.backend.LongitudinalRegistration import LongitudinalRegistration
 from typing import Type
 
-# # class to handle the execution of tasks in the queue sequentially-> set up finished signal
+# GIF popups closed when a step finishes, keyed by step name
+STEP_SIGNALS = {
+    'motion_correct': 'snorlax_closed',
+    'fused_motion_correct': 'snorlax_closed',
+    'cnmfe_apply': 'jiggly_closed',
+    'longitudinal_registration': 'eevee_closed',
+}
+
+# class to handle the execution of the queued tasks as a dependency graph (see StepScheduler) -> set up finished signals
 class TaskManager(QObject):
     snorlax_closed = Signal()
     jiggly_closed = Signal()
     bulbasaur_closed = Signal()
     eevee_closed = Signal()
     meowth_closed = Signal()
+    # emitted with the step name when every day of a step is done
+    step_finished = Signal(str)
     # setup finished signal
     tasks_completed = Signal()
     
 
-# initialize queue and index of tasks
-    def __init__(self, parent=None):
+# initialize queue of tasks, max_workers steps run at the same time
+    def __init__(self, parent=None, max_workers=NUM_STEP_WORKERS):
         super(TaskManager, self).__init__(parent)
         self.task_queue = [] # queue
-        self.current_task_index = 0
         self.process_object = None
-        self.workers = []
+        self.max_workers = max_workers
+        self.scheduler = None
         
 # set the type of data process object to perform on-> either timeseries or longitudinal process
     def set_process_object(self, process_object):
@@ -32,57 +43,30 @@ class TaskManager(QObject):
     def add_task(self, method_name, *args, **kwargs):
         self.task_queue.append((method_name, args, kwargs))
 
-# start at beginning of queue and execute task
+# build the step graph from the queue and run it on a worker from the global thread pool
+# the scheduler dispatches the steps whose inputs are ready, finished steps emit step_finished and their GIF signal
     def start_tasks(self):
-        self.current_task_index = 0
-        self.execute_next_task()
+        self.scheduler = StepScheduler(self.process_object, max_workers=self.max_workers,
+                                       on_step_finished=self.on_step_finished)
+        for method_name, args, kwargs in self.task_queue:
+            self.scheduler.add_step(method_name, *args, **kwargs)
+        self.task_queue = []
+        worker = Worker(self.scheduler, 'run')
+        worker.signals.finished.connect(self.on_tasks_finished, Qt.QueuedConnection)
+        QThreadPool.globalInstance().start(worker)
     
     def check_process_attributes(self, attribute_type: Type, target_class: Type) -> bool:
         return attribute_type == target_class
 
+# called from the scheduler thread, the signals are delivered to the GUI thread through queued connections
+    def on_step_finished(self, step_name, errors):
+        self.step_finished.emit(step_name)
+        if step_name in STEP_SIGNALS:
+            getattr(self, STEP_SIGNALS[step_name]).emit()
 
-# for each task construct a worker object that will execute the run function
-# setup finished signal (queued connection) to be emitted when worker is finished with task
-# start thread from global thread pool 
-# if at end of queue emit tasks_completed signal
-# for each step in task queue index is checked to see if it corresponds with a signal to be emitted at that task -> used for signaling GIF closings
-    def execute_next_task(self):
-        if self.current_task_index < len(self.task_queue):
-            method_name, args, kwargs = self.task_queue[self.current_task_index]
-            worker = Worker(self.process_object, method_name, *args, **kwargs)
-            worker.signals.finished.connect(self.on_task_finished, Qt.QueuedConnection)
-            QThreadPool.globalInstance().start(worker)
-            if self.current_task_index == 2:
-                self.eevee_closed.emit()
-            elif self.current_task_index == 4:
-                 self.snorlax_closed.emit()
-            elif self.current_task_index == 5:
-                self.jiggly_closed.emit()
-        else:
-            # All tasks completed
-            self.tasks_completed.emit()
-            self.bulbasaur_closed.emit()
-            self.meowth_closed.emit()
-            self.task_queue.clear()
-
-# hook up finished signal to slot for task and execute next task in queue
+# all steps are done
     @Slot()
-    def on_task_finished(self):
-        self.current_task_index += 1
-        self.execute_next_task()
-
-
-
-    
-
-
-
-
-
-
-
-
-
-
-
-
+    def on_tasks_finished(self):
+        self.tasks_completed.emit()
+        self.bulbasaur_closed.emit()
+        self.meowth_closed.emit()
@@ -0,0 +1,135 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase, mock
+from src import run_process
+from src.workutils.StepScheduler import StepScheduler
+from src.backend.LongitudinalRegistration import LongitudinalRegistration
+
+# stands in for the Timeseries steps of an experiment: one file per step, 'fail' in the folder name fails the first
+class FakeExperiment(object):
+    step_io = {
+        'first': {'outputs': ['first_file']},
+        'second': {'inputs': ['first_file'], 'outputs': ['second_file']},
+    }
+
+    def __init__(self, directory):
+        self.day_labels = []
+        self.directory = directory
+        self.first_file = os.path.join(directory, 'first.txt')
+        self.second_file = os.path.join(directory, 'second.txt')
+
+    def first(self):
+        if 'fail' in self.directory:
+            raise RuntimeError('corrupt recording')
+        open(self.first_file, 'w').close()
+
+    def second(self):
+        open(self.second_file, 'w').close()
+
+def fake_schedulers(settings, on_step_finished):
+    if not os.path.isdir(settings['data_dir']):
+        raise FileNotFoundError(settings['data_dir'])
+    scheduler = StepScheduler(FakeExperiment(settings['data_dir']), on_step_finished=on_step_finished)
+    scheduler.add_step('first')
+    scheduler.add_step('second')
+    return [scheduler]
+
+class TestBatch(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.tmp_dir, 'log.jsonl')
+        self.experiments = []
+        for name in ('mouse_a', 'mouse_fail', 'mouse_missing'):
+            data_dir = os.path.join(self.tmp_dir, name)
+            if name != 'mouse_missing':
+                os.makedirs(data_dir)
+            self.experiments.append({'name': name, 'data_dir': data_dir, 'output_folder': 'processed', 'mouse': name})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_batch(self, **kwargs):
+        with mock.patch.object(run_process, 'experiment_schedulers', side_effect=fake_schedulers):
+            return run_process.run_batch(self.experiments, max_workers=1, log_path=self.log_path, **kwargs)
+
+    def events(self, event):
+        return [record for record in run_process.BatchLog(self.log_path).read() if record['event'] == event]
+
+    def test_settings(self):
+        settings = run_process.experiment_settings({'data_dir': 'd', 'mouse': 'm', 'params': {'cnmfe_apply': {'cell_diameter': 9}}},
+                                                   defaults={'output_folder': 'processed', 'fused': True})
+        self.assertEqual(settings['stages'], ['timeseries', 'lr'])
+        self.assertTrue(settings['fused'])
+        self.assertEqual(settings['params']['cnmfe_apply'], {'cell_diameter': 9})
+        self.assertEqual(settings['params']['deconvolve_cells'], {'snr_threshold': 3.0})
+        self.assertEqual(run_process.experiment_key(settings), run_process.experiment_key(dict(settings)))
+        with self.assertRaises(ValueError):
+            run_process.experiment_settings({'data_dir': 'd', 'mouse': 'm'})
+        with self.assertRaises(ValueError):
+            run_process.experiment_settings({'data_dir': 'd', 'mouse': 'm', 'output_folder': 'o', 'stages': ['cnmfe']})
+
+    def test_failures_do_not_stop_the_batch(self):
+        failures = self.run_batch()
+        self.assertEqual(sorted(failures), ['mouse_fail', 'mouse_missing'])
+        self.assertEqual(sorted(failures['mouse_fail']), ['first', 'second'])
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, 'mouse_a', 'second.txt')))
+        status = {record['experiment']: record['status'] for record in self.events('experiment_finished')}
+        self.assertEqual(status, {'mouse_a': 'done', 'mouse_fail': 'failed', 'mouse_missing': 'failed'})
+        steps = [(record['experiment'], record['step']) for record in self.events('step_finished')]
+        self.assertIn(('mouse_a', 'second'), steps)
+
+    def test_resume_skips_finished_experiments(self):
+        self.run_batch()
+        os.makedirs(self.experiments[2]['data_dir'])
+        failures = self.run_batch(resume=True)
+        self.assertEqual(sorted(failures), ['mouse_fail'])
+        self.assertEqual([record['experiment'] for record in self.events('experiment_skipped')], ['mouse_a'])
+        # a changed entry runs again
+        self.experiments[0]['params'] = {'cnmfe_apply': {'cell_diameter': 9}}
+        self.run_batch(resume=True)
+        self.assertEqual(len(self.events('experiment_skipped')), 2)
+        self.assertEqual(self.events('experiment_started')[-2]['experiment'], 'mouse_a')
+
+    def test_main(self):
+        batch_file = os.path.join(self.tmp_dir, 'batch.json')
+        with open(batch_file, 'w') as f:
+            json.dump({'max_workers': 1, 'experiments': self.experiments[:1]}, f)
+        with mock.patch.object(run_process, 'experiment_schedulers', side_effect=fake_schedulers):
+            self.assertEqual(run_process.main([batch_file]), 0)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, run_process.DEFAULT_LOG_NAME)))
+
+# LR stage of a real experiment: the motion corrected movies are empty files, so calculate_dff fails inside isx
+class TestBatchSteps(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.tmp_dir, 'log.jsonl')
+        for name in ['2023-10-02-15-15-02_video_green.isxd', '2023-10-03-14-29-16_video_green.isxd']:
+            open(os.path.join(self.tmp_dir, name), 'w').close()
+        process = LongitudinalRegistration(self.tmp_dir, 'processed', 'mouse')
+        for path in process.merge_series(process.mc_files_series):
+            open(path, 'w').close()
+        self.experiments = [{'name': 'mouse', 'data_dir': self.tmp_dir, 'output_folder': 'processed',
+                             'mouse': 'mouse', 'stages': ['lr']}]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_failing_step_fails_the_experiment(self):
+        failures = run_process.run_batch(self.experiments, max_workers=1, log_path=self.log_path)
+        self.assertIn('calculate_dff', failures['mouse'])
+        records = run_process.BatchLog(self.log_path).read()
+        finished = [record for record in records if record['event'] == 'experiment_finished']
+        self.assertEqual(finished[-1]['status'], 'failed')
+        # the failed experiment runs again with --resume
+        run_process.run_batch(self.experiments, max_workers=1, log_path=self.log_path, resume=True)
+        events = [record['event'] for record in run_process.BatchLog(self.log_path).read()]
+        self.assertNotIn('experiment_skipped', events)
+        self.assertEqual(events.count('experiment_started'), 2)
+
+if __name__ == '__main__':
+    unittest.main()
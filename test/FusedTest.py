@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase
+import numpy as np
+from scipy import ndimage
+from src.backend import fused
+from src.backend.isxd import IsxdMovie, write_isxd
+
+class TestFusedStages(TestCase):
+
+    def test_downsample_spatial_drops_partial_bins(self):
+        block = np.arange(2 * 5 * 7, dtype=np.float32).reshape(2, 5, 7)
+        binned = fused.downsample_spatial(block, 2)
+        self.assertEqual(binned.shape, (2, 2, 3))
+        self.assertAlmostEqual(binned[0, 0, 0], block[0, :2, :2].mean())
+
+    def test_downsample_temporal_skips_missing_frames(self):
+        block = np.stack([np.full((2, 2), i, dtype=np.float32) for i in range(5)])
+        stored = np.array([True, False, False, False, True])
+        frames, kept = fused.downsample_temporal(block, stored, 2)
+        np.testing.assert_array_equal(kept, [True, False, True])
+        np.testing.assert_allclose(frames[:, 0, 0], [0, 4])
+        self.assertEqual(fused.dropped_groups(stored, 2), [1])
+
+    def test_defective_pixels_are_replaced(self):
+        rng = np.random.default_rng(0)
+        block = rng.normal(100, 1, size=(2, 16, 16)).astype(np.float32)
+        block[1, 5, 7] = 4000
+        fixed = fused.fix_defective_pixels(block.copy())
+        self.assertLess(abs(fixed[1, 5, 7] - 100), 5)
+        np.testing.assert_array_equal(fixed[0], block[0])
+
+    def test_shifts_are_recovered(self):
+        rng = np.random.default_rng(1)
+        reference = ndimage.gaussian_filter(rng.normal(size=(64, 80)), 2).astype(np.float32)
+        true_shifts = np.array([[0, 0], [3, -2], [-5, 4], [1.5, 0]], dtype=np.float32)
+        block = np.stack([ndimage.shift(reference, shift, order=3, mode='wrap') for shift in true_shifts])
+        shifts = fused.estimate_shifts(block, reference, max_translation=8)
+        np.testing.assert_allclose(shifts, true_shifts, atol=0.3)
+        corrected = fused.apply_shifts(block, shifts)
+        self.assertLess(np.abs(corrected[1, 10:-10, 10:-10] - reference[10:-10, 10:-10]).max(), 0.2)
+        self.assertEqual(fused.crop_rect(shifts, reference.shape), (5, 2, 60, 75))
+
+class TestFusedPipeline(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(2)
+        self.scene = ndimage.gaussian_filter(rng.normal(size=(48, 64)), 1.5) * 4000 + 1000
+        # frames 4, 5 and 12, 13 moved by (4, -6) pixels
+        self.shifts = [(4, -6) if i in (4, 5, 12, 13) else (0, 0) for i in range(20)]
+        frames = np.stack([ndimage.shift(self.scene, shift, order=1, mode='nearest') for shift in self.shifts])
+        self.input = os.path.join(self.tmp_dir, 'rec.isxd')
+        write_isxd(self.input, frames.clip(0, 65535).astype(np.uint16)[np.arange(20) != 9], dropped=[9])
+        self.output = os.path.join(self.tmp_dir, 'rec-PP-BP-MC.isxd')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_pipeline(self, max_translation):
+        pipeline = fused.FusedPipeline(temporal_downsample_factor=2, spatial_downsample_factor=2,
+                                       fix_defective_pixels=False, max_translation=max_translation, block_size=3)
+        mean_image, rect = pipeline.run([self.input], [self.output])
+        with IsxdMovie(self.output) as movie:
+            frames = np.array(movie.get_frames(0, len(movie)))
+        return pipeline, mean_image, rect, frames
+
+    # mean difference between the moved output frames (2 and 6) and a still one, away from the borders
+    def misalignment(self, frames):
+        inner = (slice(4, -4), slice(4, -4))
+        return np.mean([np.abs(frames[i][inner] - frames[0][inner]).mean() for i in (2, 6)])
+
+    def test_corrected_movie(self):
+        pipeline, mean_image, rect, frames = self.run_pipeline(max_translation=5)
+        self.assertEqual(pipeline.block_size, 4)
+        self.assertEqual(pipeline.stats['blocks'], 10)
+        self.assertEqual(mean_image.shape, (24, 32))
+        self.assertEqual(frames.shape, (10, 24, 32))
+        with IsxdMovie(self.output) as movie:
+            self.assertEqual(movie.timing.num_samples, 10)
+            self.assertEqual(movie.timing.dropped, [])
+            self.assertAlmostEqual(movie.timing.period, 0.1)
+            self.assertEqual(movie.header['spacingInfo']['pixelSize']['x'], {'num': 6, 'den': 1})
+        self.assertLess(rect[2], 23)
+        self.assertGreater(rect[1], 0)
+        _, _, uncorrected_rect, uncorrected = self.run_pipeline(max_translation=0)
+        self.assertEqual(uncorrected_rect, (0, 0, 23, 31))
+        self.assertLess(self.misalignment(frames), 0.5 * self.misalignment(uncorrected))
+
+    def test_fully_dropped_group_is_dropped(self):
+        write_isxd(self.input, np.ones((3, 8, 8), dtype=np.uint16) * 100, dropped=[2, 3])
+        pipeline = fused.FusedPipeline(temporal_downsample_factor=2, fix_defective_pixels=False, max_translation=2)
+        pipeline.run([self.input], [self.output])
+        with IsxdMovie(self.output) as movie:
+            self.assertEqual(movie.timing.num_samples, 3)
+            self.assertEqual(movie.timing.dropped, [1])
+
+if __name__ == '__main__':
+    unittest.main()
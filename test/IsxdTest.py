@@ -0,0 +1,166 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase
+import numpy as np
+from src.backend.isxd import IsxdMovie, write_isxd, project_movies, trim_isxd, read_header, \
+    FRAME_HEADER_SIZE, FRAME_FOOTER_SIZE
+
+try:
+    import isx
+except ImportError:
+    isx = None
+
+class TestIsxdMovie(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.frames = rng.integers(0, 4096, size=(12, 20, 30)).astype(np.uint16)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, frames, **kwargs):
+        file_path = os.path.join(self.tmp_dir, name)
+        write_isxd(file_path, frames, **kwargs)
+        return file_path
+
+    def test_read_frames(self):
+        file_path = self.write('movie.isxd', self.frames)
+        with IsxdMovie(file_path) as movie:
+            self.assertEqual(movie.timing.num_samples, 12)
+            self.assertEqual(movie.shape, (20, 30))
+            np.testing.assert_array_equal(movie.get_frames(0, 12), self.frames)
+            np.testing.assert_array_equal(movie.get_frame_data(5), self.frames[5])
+
+    def test_roi_is_zero_copy_view(self):
+        file_path = self.write('movie.isxd', self.frames)
+        with IsxdMovie(file_path) as movie:
+            block = movie.get_frames(2, 7, [[4, 16], [10, 15]])
+            np.testing.assert_array_equal(block, self.frames[2:7, 4:16, 10:15])
+            self.assertTrue(np.shares_memory(block, movie.frames))
+            self.assertFalse(block.flags.writeable)
+
+    def test_frame_header_footer_are_skipped(self):
+        file_path = self.write('movie.isxd', self.frames, frame_header_footer=True)
+        with IsxdMovie(file_path) as movie:
+            np.testing.assert_array_equal(movie.get_frames(0, 12), self.frames)
+
+    def test_dropped_frames_are_zeros(self):
+        file_path = self.write('movie.isxd', self.frames[:10], dropped=[3, 4])
+        with IsxdMovie(file_path) as movie:
+            self.assertEqual(movie.timing.num_samples, 12)
+            block = movie.get_frames(2, 6, [[0, 20], [0, 30]])
+            np.testing.assert_array_equal(block[0], self.frames[2])
+            self.assertFalse(block[1:3].any())
+            np.testing.assert_array_equal(block[3], self.frames[3])
+            np.testing.assert_array_equal(movie.get_frame_data(11), self.frames[9])
+
+    def test_truncated_file_is_rejected(self):
+        file_path = self.write('movie.isxd', self.frames)
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        truncated = os.path.join(self.tmp_dir, 'truncated.isxd')
+        with open(truncated, 'wb') as f:
+            f.write(data[100:])
+        with self.assertRaises(ValueError):
+            IsxdMovie(truncated)
+
+    def test_project_movies(self):
+        first = self.write('first.isxd', self.frames[:5])
+        second = self.write('second.isxd', self.frames[5:])
+        np.testing.assert_allclose(project_movies([first, second], 'mean', block_size=3), self.frames.mean(axis=0), rtol=1e-6)
+        np.testing.assert_array_equal(project_movies([first, second], 'max'), self.frames.max(axis=0))
+
+    def test_trim_keeps_timestamps(self):
+        file_path = self.write('movie.isxd', self.frames[:11], dropped=[5], start_secs=100, frame_header_footer=True)
+        trimmed_path = os.path.join(self.tmp_dir, 'movie_processed.isxd')
+        trim_isxd(file_path, trimmed_path, [[0, 1], [4, 6], [11, 11]])
+        with IsxdMovie(trimmed_path) as movie:
+            # frames 0-1 and 11 leave the timeline, 4 and 6 become cropped, 5 stays dropped
+            self.assertEqual(movie.timing.num_samples, 9)
+            self.assertEqual(movie.timing.dropped, [3])
+            self.assertEqual(movie.timing.cropped, [2, 4])
+            start = movie.header['timingInfo']['start']['secsSinceEpoch']
+            self.assertAlmostEqual(start['num'] / start['den'], 100.1)
+            np.testing.assert_array_equal(movie.get_frames(0, 2), self.frames[2:4])
+            np.testing.assert_array_equal(movie.get_frames(5, 9), self.frames[6:10])
+            self.assertFalse(movie.get_frames(2, 5).any())
+
+    def test_trim_everything_is_rejected(self):
+        file_path = self.write('movie.isxd', self.frames)
+        with self.assertRaises(ValueError):
+            trim_isxd(file_path, os.path.join(self.tmp_dir, 'out.isxd'), [[0, 11]])
+
+    @unittest.skipIf(isx is None, 'isx is not installed')
+    def test_trimmed_movie_matches_isx_api(self):
+        file_path = self.write('movie.isxd', self.frames, frame_header_footer=True)
+        trimmed_path = os.path.join(self.tmp_dir, 'movie_processed.isxd')
+        trim_isxd(file_path, trimmed_path, [[3, 5]])
+        isx_movie = isx.Movie.read(trimmed_path)
+        with IsxdMovie(trimmed_path) as movie:
+            self.assertEqual(isx_movie.timing.cropped, [(3, 5)])
+            for i in range(movie.timing.num_samples):
+                np.testing.assert_array_equal(movie.get_frame_data(i), isx_movie.get_frame_data(i))
+        del isx_movie
+
+    @unittest.skipIf(isx is None, 'isx is not installed')
+    def test_matches_isx_api(self):
+        file_path = self.write('movie.isxd', self.frames[:10], dropped=[6, 7], frame_header_footer=True)
+        isx_movie = isx.Movie.read(file_path)
+        with IsxdMovie(file_path) as movie:
+            self.assertEqual(movie.timing.num_samples, isx_movie.timing.num_samples)
+            for i in range(movie.timing.num_samples):
+                np.testing.assert_array_equal(movie.get_frame_data(i), isx_movie.get_frame_data(i))
+        del isx_movie
+
+    # the frame header and footer are 5120 bytes whatever the frame size: filled with markers they must not show up
+    # in the frames isx reads, and a movie written by isx holds nothing but the pixels in front of its JSON header
+    @unittest.skipIf(isx is None, 'isx is not installed')
+    def test_frame_layout_matches_isx(self):
+        file_path = self.write('movie.isxd', self.frames, frame_header_footer=True)
+        pixels_size = 20 * 30 * 2
+        frame_size = FRAME_HEADER_SIZE + pixels_size + FRAME_FOOTER_SIZE
+        self.assertEqual((FRAME_HEADER_SIZE, FRAME_FOOTER_SIZE), (5120, 5120))
+        self.assertEqual(read_header(file_path)[1], 12 * frame_size)
+        raw = np.memmap(file_path, dtype=np.uint8, mode='r+', shape=(12, frame_size))
+        raw[:, :FRAME_HEADER_SIZE] = 0xFF
+        raw[:, FRAME_HEADER_SIZE + pixels_size:] = 0xEE
+        raw.flush()
+        del raw
+        isx_movie = isx.Movie.read(file_path)
+        with IsxdMovie(file_path) as movie:
+            self.assertEqual(movie.frame_size, frame_size)
+            for i in range(12):
+                np.testing.assert_array_equal(isx_movie.get_frame_data(i), self.frames[i])
+                np.testing.assert_array_equal(movie.get_frame_data(i), self.frames[i])
+        del isx_movie
+        isx_path = os.path.join(self.tmp_dir, 'isx.isxd')
+        written = isx.Movie.write(isx_path, isx.Timing(num_samples=3, period=isx.Duration.from_msecs(50)),
+                                  isx.Spacing(num_pixels=(20, 30)), np.uint16)
+        for i in range(3):
+            written.set_frame_data(i, self.frames[i])
+        written.flush()
+        del written
+        header, data_size = read_header(isx_path)
+        self.assertFalse(header.get('hasFrameHeaderFooter', False))
+        self.assertEqual(data_size, 3 * pixels_size)
+
+    @unittest.skipIf(isx is None, 'isx is not installed')
+    def test_reads_isx_written_movie(self):
+        file_path = os.path.join(self.tmp_dir, 'isx.isxd')
+        timing = isx.Timing(num_samples=4, period=isx.Duration.from_msecs(50), dropped=[1])
+        written = isx.Movie.write(file_path, timing, isx.Spacing(num_pixels=(20, 30)), np.float32)
+        for i in [0, 2, 3]:
+            written.set_frame_data(i, self.frames[i].astype(np.float32))
+        written.flush()
+        del written
+        with IsxdMovie(file_path) as movie:
+            self.assertEqual(movie.data_type, np.float32)
+            np.testing.assert_array_equal(movie.get_frame_data(2), self.frames[2])
+            self.assertFalse(movie.get_frame_data(1).any())
+
+if __name__ == '__main__':
+    unittest.main()
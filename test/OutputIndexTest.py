@@ -0,0 +1,78 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase, mock
+from src.backend.outputindex import DirectoryIndex, get_directory_index, update_directory_indexes, DIRECTORY_INDEXES
+from src.backend.process import Process
+
+class TestDirectoryIndex(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.touch('a.csv')
+
+    def tearDown(self):
+        for directory in list(DIRECTORY_INDEXES):
+            if directory.startswith(self.tmp_dir):
+                DIRECTORY_INDEXES.pop(directory).stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def touch(self, name, text=''):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    # move the folder modification time forward, file systems with a coarse clock may not see the change otherwise
+    def bump_mtime(self):
+        mtime = os.stat(self.tmp_dir).st_mtime_ns + 10**9
+        os.utime(self.tmp_dir, ns=(mtime, mtime))
+
+    def test_lookups_do_not_list_the_folder(self):
+        index = DirectoryIndex(self.tmp_dir, refresh_seconds=0)
+        with mock.patch('os.scandir', side_effect=AssertionError('scanned again')):
+            self.assertIn('a.csv', index)
+            self.assertIn(os.path.join(self.tmp_dir, 'a.csv'), index)
+            self.assertNotIn('b.csv', index)
+            self.assertFalse(index.refresh())
+
+    def test_updates_from_steps(self):
+        index = DirectoryIndex(self.tmp_dir, refresh_seconds=0)
+        path = self.touch('b.csv', 'cells')
+        index.update([path, os.path.join(os.path.dirname(self.tmp_dir), 'elsewhere.csv')])
+        self.assertEqual(index.stat('b.csv')[0], 5)
+        os.remove(path)
+        index.update([path])
+        self.assertEqual(index.names(), {'a.csv'})
+
+    def test_external_changes_are_picked_up(self):
+        index = DirectoryIndex(self.tmp_dir, refresh_seconds=0)
+        self.touch('b.csv')
+        self.bump_mtime()
+        self.assertTrue(index.refresh())
+        self.assertIn('b.csv', index)
+
+    def test_shared_index_and_pickling(self):
+        index = get_directory_index(self.tmp_dir)
+        self.assertIs(get_directory_index(self.tmp_dir + os.sep), index)
+        path = self.touch('b.csv')
+        update_directory_indexes([path])
+        self.assertIn('b.csv', index)
+        copy = pickle.loads(pickle.dumps(index))
+        self.assertIn('b.csv', copy)
+        self.assertIsNone(copy._thread)
+
+    def test_completion_check(self):
+        open(os.path.join(self.tmp_dir, '2023-10-02-15-15-02_video_green.isxd'), 'w').close()
+        process = Process(self.tmp_dir, 'processed', 'mouse')
+        self.assertFalse(process.check_all_recordings_processed(process.mc_files_series, 0))
+        # written by a step in another process: found once the index sees the folder changed
+        open(process.mc_files_series[0][0], 'w').close()
+        mtime = os.stat(process.output_dir).st_mtime_ns + 10**9
+        os.utime(process.output_dir, ns=(mtime, mtime))
+        self.assertTrue(process.check_all_recordings_processed(process.mc_files_series, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import time
+import threading
+import unittest
+from unittest import TestCase
+from src.workutils.Prefetcher import Prefetcher, iterate_blocks, block_ranges
+
+class TestPrefetcher(TestCase):
+
+    def test_block_ranges(self):
+        self.assertEqual(block_ranges(2, 9, 3), [(2, 5), (5, 8), (8, 9)])
+        self.assertEqual(block_ranges(4, 4, 3), [])
+
+    def test_blocks_in_order(self):
+        for depth in [0, 1, 3]:
+            stats = {}
+            blocks = list(iterate_blocks(lambda start, stop: list(range(start, stop)), block_ranges(0, 10, 4),
+                                         depth=depth, stats=stats))
+            self.assertEqual(blocks, [(0, 4, [0, 1, 2, 3]), (4, 8, [4, 5, 6, 7]), (8, 10, [8, 9])])
+            self.assertEqual(stats['blocks'], 3)
+            self.assertGreaterEqual(stats['io_wait_seconds'], 0)
+
+    def test_reads_ahead_at_most_depth_blocks(self):
+        read = []
+        prefetcher = Prefetcher(lambda start, stop: read.append(start) or start, block_ranges(0, 10, 1), depth=2)
+        iterator = iter(prefetcher)
+        next(iterator)
+        time.sleep(0.2)
+        # the block being analysed, the depth blocks in the queue and the one waiting to be queued
+        self.assertLessEqual(len(read), 4)
+        iterator.close()
+
+    def test_reader_error_is_raised(self):
+        def read_block(start, stop):
+            if start == 4:
+                raise OSError('read failed')
+            return start
+        with self.assertRaises(OSError):
+            list(iterate_blocks(read_block, block_ranges(0, 10, 2)))
+
+    def test_early_exit_stops_thread(self):
+        threads = threading.active_count()
+        for start, stop, block in iterate_blocks(lambda start, stop: start, block_ranges(0, 1000, 1)):
+            if start == 3:
+                break
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_stats_kept_when_stopping_early(self):
+        for depth in (0, 2):
+            stats = {}
+            for start, stop, block in iterate_blocks(lambda start, stop: start, block_ranges(0, 10, 1), depth=depth,
+                                                     stats=stats):
+                if start == 2:
+                    break
+            self.assertEqual(stats['blocks'], 3)
+            stats = {}
+            with self.assertRaises(ValueError):
+                for start, stop, block in iterate_blocks(lambda start, stop: start, block_ranges(0, 10, 1),
+                                                         depth=depth, stats=stats):
+                    raise ValueError('analysis failed')
+            self.assertEqual(stats['blocks'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
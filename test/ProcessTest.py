@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase, mock
+import pandas as pd
+from src.backend import process as process_module
+from src.backend.process import Process
+from src.backend.Timeseries import Timeseries
+from src.backend.LongitudinalRegistration import LongitudinalRegistration
+from src.backend.spiketable import load_spike_table, spike_path
+from benchmarks.synthetic import synthetic_spike_table
+
+# Process whose per-day step only writes a marker file, day_2 always fails
+class MarkerProcess(Process):
+    def write_marker(self, day_i, day_label, seconds):
+        if day_label == 'day_2':
+            raise RuntimeError('corrupt recording')
+        time.sleep(seconds)
+        with open(os.path.join(self.output_dir, f'{day_label}.done'), 'w') as f:
+            f.write(str(os.getpid()))
+
+# Process whose per-day step records whether it received the manifest from the parent
+class ManifestProcess(Process):
+    def check_manifest(self, day_i, day_label):
+        with open(os.path.join(self.output_dir, f'{day_label}.done'), 'w') as f:
+            f.write(str('manifest' in vars(self)))
+
+class TestRunDays(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for name in ['2023-10-02-15-15-02_video_green.isxd', '2023-10-03-14-29-16_video_green.isxd',
+                     '2023-10-05-11-19-11_video_green.isxd']:
+            open(os.path.join(self.tmp_dir, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_stage(self, day_workers):
+        process = MarkerProcess(self.tmp_dir, 'processed', 'mouse', day_workers=day_workers)
+        errors = process.run_days('markers', process.write_marker, 0.5)
+        self.assertEqual(list(errors), ['day_2'])
+        self.assertIsInstance(errors['day_2'], RuntimeError)
+        done = sorted(f for f in os.listdir(process.output_dir) if f.endswith('.done'))
+        self.assertEqual(done, ['day_1.done', 'day_3.done'])
+        return [open(os.path.join(process.output_dir, f)).read() for f in done]
+
+    def test_failing_day_does_not_stop_the_others(self):
+        self.assertEqual(set(self.run_stage(day_workers=1)), {str(os.getpid())})
+
+    def test_days_run_in_parallel_processes(self):
+        pids = self.run_stage(day_workers=3)
+        self.assertNotIn(str(os.getpid()), pids)
+
+    def test_workers_receive_the_manifest(self):
+        process = ManifestProcess(self.tmp_dir, 'processed', 'mouse', day_workers=3)
+        self.assertEqual(process.run_days('manifest', process.check_manifest), {})
+        written = sorted(os.listdir(process.output_dir))
+        self.assertEqual(written, sorted([process_module.MANIFEST_NAME, 'day_1.done', 'day_2.done', 'day_3.done']))
+        self.assertEqual({open(os.path.join(process.output_dir, f)).read() for f in written if f.endswith('.done')},
+                         {'True'})
+
+class TestManifest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for name in ['2023-10-02-15-15-02_video_green.isxd', '2023-10-02-16-00-00_video_green.isxd']:
+            open(os.path.join(self.tmp_dir, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_paths_are_derived_on_first_use(self):
+        process = Process(self.tmp_dir, 'processed', 'mouse')
+        self.assertNotIn('mc_files_series', vars(process))
+        self.assertEqual(os.listdir(process.output_dir), [])
+        self.assertEqual(len(process.mc_files_json[0]), 2)
+        self.assertEqual(os.listdir(process.output_dir), [process_module.MANIFEST_NAME])
+        with open(os.path.join(process.output_dir, process_module.MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest['version'], process_module.MANIFEST_VERSION)
+        self.assertEqual(manifest['series']['mc_files_series'], process.mc_files_series)
+
+    def test_manifest_is_only_written_when_it_changes(self):
+        Process(self.tmp_dir, 'processed', 'mouse').manifest
+        manifest_path = os.path.join(self.tmp_dir, 'processed', process_module.MANIFEST_NAME)
+        written = os.stat(manifest_path).st_mtime_ns
+        Process(self.tmp_dir, 'processed', 'mouse').manifest
+        self.assertEqual(os.stat(manifest_path).st_mtime_ns, written)
+        Process(self.tmp_dir, 'processed', 'mouse', scratch_dir=os.path.join(self.tmp_dir, 'scratch')).manifest
+        with open(manifest_path) as f:
+            self.assertIn('scratch', json.load(f)['series']['pp_files_series'][0][0])
+
+    def test_concurrent_write_of_the_same_manifest(self):
+        manifest_path = os.path.join(self.tmp_dir, process_module.MANIFEST_NAME)
+        manifest = {'version': process_module.MANIFEST_VERSION, 'series': {}}
+        process_module.write_manifest(manifest_path, manifest)
+        with mock.patch('os.replace', side_effect=PermissionError('in use')):
+            process_module.write_manifest(manifest_path, manifest)
+            with self.assertRaises(PermissionError):
+                process_module.write_manifest(manifest_path, dict(manifest, series={'a': []}))
+        self.assertEqual(os.listdir(self.tmp_dir).count(process_module.MANIFEST_NAME), 1)
+        self.assertFalse([f for f in os.listdir(self.tmp_dir) if f.endswith('.tmp')])
+
+    def test_directory_listing_is_cached_until_it_changes(self):
+        listing = process_module.list_directory(self.tmp_dir)
+        with mock.patch('os.listdir', side_effect=AssertionError('listed again')):
+            self.assertEqual(process_module.list_directory(self.tmp_dir), listing)
+        mtime = os.stat(self.tmp_dir).st_mtime_ns
+        open(os.path.join(self.tmp_dir, '2023-10-03-10-00-00_video_green.isxd'), 'w').close()
+        # make sure the change is visible on file systems with a coarse modification time
+        os.utime(self.tmp_dir, ns=(mtime + 10**9, mtime + 10**9))
+        self.assertEqual(len(process_module.list_directory(self.tmp_dir)), len(listing) + 1)
+        self.assertEqual(Process(self.tmp_dir, 'processed', 'mouse').day_labels, ['day_1', 'day_2'])
+
+class TestRetention(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.scratch_dir = os.path.join(self.tmp_dir, 'scratch')
+        open(os.path.join(self.tmp_dir, '2023-10-02-15-15-02_video_green.isxd'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            Process(self.tmp_dir, 'processed', 'mouse', retention='some')
+
+    def test_intermediates_on_scratch(self):
+        process = Process(self.tmp_dir, 'processed', 'mouse', scratch_dir=self.scratch_dir, retention='mc')
+        self.assertEqual(os.path.dirname(process.mc_files_series[0][0]), self.scratch_dir)
+        self.assertEqual(os.path.dirname(process.cnmfe_files_series[0][0]), str(process.output_dir))
+        self.assertEqual(process.mc_files_json, process.mc_files_series)
+        pp_file, mc_file, cnmfe_file = (process.pp_files_series[0][0], process.mc_files_series[0][0],
+                                        process.cnmfe_files_series[0][0])
+        for path in (pp_file, mc_file, cnmfe_file):
+            open(path, 'w').close()
+        process.release_intermediates([pp_file, mc_file, cnmfe_file])
+        # preprocessed movie deleted, motion corrected one kept in the output folder, final files untouched
+        self.assertFalse(os.path.exists(pp_file))
+        self.assertFalse(os.path.exists(mc_file))
+        self.assertTrue(os.path.exists(os.path.join(process.output_dir, os.path.basename(mc_file))))
+        self.assertTrue(os.path.exists(cnmfe_file))
+        self.assertTrue(process.is_available(pp_file))
+
+class TestSpikeSteps(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for name in ['2023-10-02-15-15-02_video_green.isxd', '2023-10-03-14-29-16_video_green.isxd']:
+            open(os.path.join(self.tmp_dir, name), 'w').close()
+        self.process = Timeseries(self.tmp_dir, 'processed', 'mouse', spike_formats=('npz',))
+        for day_i, seed in enumerate((1, 2)):
+            self.write_events(day_i, seed)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_events(self, day_i, seed):
+        table = synthetic_spike_table(40, 5, event_rate=0.2, seed=seed)
+        table.to_csv(self.process.cnmfe_spike_event_csvs[day_i], index=False)
+
+    def realigned(self, day_i):
+        return load_spike_table(self.process.timeseries_events[day_i]).to_frame()
+
+    # the realigned table follows a new export (a new SNR threshold), whatever the chunk size
+    def test_realignment_follows_the_exported_events(self):
+        self.assertEqual(self.process.vertical_csv_alignment(), {})
+        self.assertFalse(os.path.exists(self.process.timeseries_events[0]))
+        first = self.realigned(0)
+        written = os.stat(spike_path(self.process.timeseries_events[1], 'npz')).st_mtime_ns
+        self.process.vertical_csv_alignment(chunk_rows=7)
+        self.assertEqual(os.stat(spike_path(self.process.timeseries_events[1], 'npz')).st_mtime_ns, written)
+        self.write_events(0, 5)
+        self.process.vertical_csv_alignment()
+        self.assertFalse(self.realigned(0).equals(first))
+        self.assertEqual(os.stat(spike_path(self.process.timeseries_events[1], 'npz')).st_mtime_ns, written)
+
+    def test_renaming_follows_the_realigned_days(self):
+        self.process.vertical_csv_alignment()
+        lr = LongitudinalRegistration(self.tmp_dir, 'processed', 'mouse', spike_formats=('npz',))
+        pd.DataFrame({'global_cell_index': list(range(5)) * 2, 'local_cellset_index': [0] * 5 + [1] * 5,
+                      'local_cell_index': list(range(5)) * 2}).to_csv(lr.lr_csv_file, index=False)
+        lr.rename_cells_from_timeseries()
+        renamed = load_spike_table(lr.lr_cells_from_day[0]).to_frame()
+        self.write_events(0, 5)
+        self.process.vertical_csv_alignment()
+        lr.rename_cells_from_timeseries()
+        self.assertFalse(load_spike_table(lr.lr_cells_from_day[0]).to_frame().equals(renamed))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase, mock
+import numpy as np
+from src.backend import RemoveCorruptFrames as rcf
+from src.backend.isxd import write_isxd
+
+# uint16 noise movie covering the default ROI with black bands in black_segments
+def synthetic_frames(num_frames, black_segments, seed=0):
+    rng = np.random.default_rng(seed)
+    height, width = rcf.DEFAULT_ROI[0][1], rcf.DEFAULT_ROI[1][1] + 10
+    frames = rng.normal(1000, 50, size=(num_frames, height, width)).clip(0, 4095).astype(np.uint16)
+    for first, last in black_segments:
+        frames[first:last + 1, height // 4:, rcf.DEFAULT_ROI[1][0]:rcf.DEFAULT_ROI[1][1]] = 0
+    return frames
+
+class TestCorruptSegments(TestCase):
+
+    def test_runs(self):
+        mask = np.array([1, 1, 0, 0, 1, 0, 1, 1, 1], dtype=bool)
+        self.assertEqual(rcf.corrupt_segments(mask), [[0, 1], [4, 4], [6, 8]])
+
+    def test_no_corrupt_frames(self):
+        self.assertEqual(rcf.corrupt_segments(np.zeros(5, dtype=bool)), [])
+        self.assertEqual(rcf.corrupt_segments(np.zeros(0, dtype=bool)), [])
+
+    def test_all_corrupt_frames(self):
+        self.assertEqual(rcf.corrupt_segments(np.ones(4, dtype=bool)), [[0, 3]])
+
+class TestBlockStatistics(TestCase):
+
+    def test_matches_histogram(self):
+        block = synthetic_frames(6, [[2, 3]])[:, rcf.DEFAULT_ROI[0][0]:rcf.DEFAULT_ROI[0][1], rcf.DEFAULT_ROI[1][0]:rcf.DEFAULT_ROI[1][1]]
+        block[5, :10] = 4095
+        black, white = rcf.block_statistics(block)
+        for i, frame in enumerate(block):
+            histogram = np.histogram(rcf.normalize(frame).flatten(), range(0, 257))[0]
+            self.assertEqual(black[i], histogram[0])
+            self.assertEqual(white[i], np.mean(histogram[-15:]))
+
+class TestDetectCorruptFrames(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.tmp_dir, '2023-10-02-15-15-02_video_green.isxd')
+        write_isxd(self.file_path, synthetic_frames(120, [[5, 9], [60, 61], [119, 119]]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_segments_and_report(self):
+        report = rcf.detect_corrupt_frames(self.file_path, block_size=16)
+        self.assertEqual(report['segments'], [[5, 9], [60, 61], [119, 119]])
+        self.assertEqual(report['frames_scanned'], 120)
+        self.assertEqual(report['corrupt_frames'], 8)
+        self.assertFalse(report['statistics_from_sidecar'])
+        self.assertTrue(os.path.exists(rcf.sidecar_path(self.file_path)))
+        rcf.write_report(self.file_path, report)
+        with open(rcf.report_path(self.file_path)) as f:
+            self.assertEqual(json.load(f)['segments'], report['segments'])
+
+    def test_prefetch_does_not_change_statistics(self):
+        movie = rcf.open_movie(self.file_path)
+        timings = {}
+        black, white = rcf.scan_blocks(movie, block_size=16, prefetch_depth=2, timings=timings)
+        inline_black, inline_white = rcf.scan_blocks(movie, block_size=16, prefetch_depth=0)
+        np.testing.assert_array_equal(black, inline_black)
+        np.testing.assert_array_equal(white, inline_white)
+        self.assertEqual(timings['blocks'], 8)
+        report = rcf.detect_corrupt_frames(self.file_path, use_sidecar=False)
+        self.assertIn('io_wait_seconds', report['prefetch'])
+
+    def test_roi_block_strided_before_loading(self):
+        movie = rcf.open_movie(self.file_path)
+        full, _ = rcf.read_roi_block(movie, 8, 24)
+        view, _ = rcf.read_roi_block(movie, 8, 24, pixel_stride=4)
+        loaded, readable = rcf.read_roi_block(movie, 8, 24, load=True, pixel_stride=4)
+        np.testing.assert_array_equal(loaded, full[:, ::4, ::4])
+        self.assertTrue(np.shares_memory(view, movie.frames))
+        self.assertEqual(loaded.nbytes, full[:, ::4, ::4].size * loaded.itemsize)
+        self.assertTrue(readable.all())
+        cheap_black, _ = rcf.scan_blocks(movie, block_size=16, pixel_stride=4)
+        np.testing.assert_array_equal(cheap_black[8:24], rcf.block_statistics(full[:, ::4, ::4])[0])
+
+    def test_sidecar_reused_and_invalidated(self):
+        rcf.detect_corrupt_frames(self.file_path)
+        report = rcf.detect_corrupt_frames(self.file_path, padding_fraction=0.002)
+        self.assertTrue(report['statistics_from_sidecar'])
+        # rewriting the movie changes its size and mtime, the sidecar must be rebuilt
+        write_isxd(self.file_path, synthetic_frames(100, [[30, 31]], seed=1))
+        report = rcf.detect_corrupt_frames(self.file_path)
+        self.assertFalse(report['statistics_from_sidecar'])
+        self.assertEqual(report['segments'], [[30, 31]])
+
+    def test_coarse_scan_matches_block_scan(self):
+        block = rcf.detect_corrupt_frames(self.file_path, use_sidecar=False)
+        coarse = rcf.detect_corrupt_frames(self.file_path, scan_mode='coarse', use_sidecar=False, stride=16,
+                                           thresholds=(block['thresholds']['black'], block['thresholds']['white']))
+        self.assertEqual(coarse['segments'], block['segments'])
+        self.assertLess(coarse['frames_scanned'], 120)
+
+    def test_coarse_scan_without_subsampled_check_finds_long_runs(self):
+        coarse = rcf.detect_corrupt_frames(self.file_path, scan_mode='coarse', use_sidecar=False, stride=4,
+                                           pixel_stride=None)
+        self.assertIn([5, 9], coarse['segments'])
+
+class TestRoiCalibration(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.frames = rng.normal(1000, 50, size=(200, 160, 240)).clip(0, 4095).astype(np.uint16)
+        self.frames[40:60, 20:, 100:124] = 0
+        self.file_path = os.path.join(self.tmp_dir, 'downsampled.isxd')
+        write_isxd(self.file_path, self.frames)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_calibrated_band(self):
+        with rcf.IsxdMovie(self.file_path) as movie:
+            roi = rcf.calibrate_roi(movie, num_frames=100)
+        self.assertEqual(roi[1], [100, 124])
+        self.assertLessEqual(roi[0][0], 24)
+        self.assertEqual(roi[0][1], 160)
+
+    def test_no_artefacts(self):
+        write_isxd(self.file_path, self.frames[100:])
+        with rcf.IsxdMovie(self.file_path) as movie:
+            self.assertIsNone(rcf.calibrate_roi(movie))
+        config = rcf.CorruptFrameConfig()
+        self.assertEqual(rcf.get_roi(self.file_path, config), [[0, 160], [84, 94]])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, rcf.ROI_CACHE_NAME)))
+        # the outcome is kept in the sidecar of the movie until the movie changes
+        with mock.patch.object(rcf, 'calibrate_roi', side_effect=AssertionError('calibrated again')):
+            self.assertEqual(rcf.get_roi(self.file_path, config), [[0, 160], [84, 94]])
+        write_isxd(self.file_path, self.frames[90:])
+        with mock.patch.object(rcf, 'calibrate_roi', return_value=None) as calibrate:
+            rcf.get_roi(self.file_path, config)
+        calibrate.assert_called_once()
+
+    def test_roi_cached_per_geometry(self):
+        config = rcf.CorruptFrameConfig()
+        roi = rcf.get_roi(self.file_path, config)
+        with open(os.path.join(self.tmp_dir, rcf.ROI_CACHE_NAME)) as f:
+            self.assertEqual(json.load(f), {'160x240': roi})
+        # another movie with the same frame size reuses the calibration even without artefacts
+        other_path = os.path.join(self.tmp_dir, 'other.isxd')
+        write_isxd(other_path, self.frames[100:])
+        self.assertEqual(rcf.get_roi(other_path, config), roi)
+
+    def test_configured_roi_and_report(self):
+        config = rcf.CorruptFrameConfig(roi=[[0, 160], [96, 128]], use_sidecar=False)
+        report = rcf.detect_corrupt_frames(self.file_path, roi=config.roi, **config.detector_kwargs())
+        self.assertEqual(report['segments'], [[40, 59]])
+        self.assertEqual(report['roi'], [[0, 160], [96, 128]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import csv
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from unittest import TestCase
+from src.backend import runreport
+from src.backend.runreport import StepTimer, read_records, write_run_report
+from src.backend.process import Process, timed_step
+
+# process object with a per-day step going through cached_step and a measured step method
+class CountingProcess(Process):
+    step_io = {'count': {'inputs': ['rec_dir_series'], 'outputs': ['count_files']}}
+
+    @property
+    def count_files(self):
+        return [os.path.join(self.output_dir, f'{day_label}-count.txt') for day_label in self.day_labels]
+
+    @timed_step
+    def count(self):
+        for day_i, day_label in enumerate(self.day_labels):
+            self.cached_step('count', day_label, self.rec_dir_series[day_i], [self.count_files[day_i]], {},
+                             lambda staged: self.write(staged(self.count_files[day_i]), day_label))
+        return {}
+
+    def write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+class TestRunReport(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_step_timer(self):
+        data = os.path.join(self.tmp_dir, 'data.bin')
+        with open(data, 'wb') as f:
+            f.write(b'x' * 1000)
+        with StepTimer(self.tmp_dir, 'copy', 'day_1', 'day', [data], run_id='run') as timer:
+            shutil.copy(data, data + '.copy')
+            timer.finish([data + '.copy'], 'ran')
+        record = timer.record
+        self.assertEqual(set(record), set(runreport.RECORD_FIELDS))
+        self.assertEqual((record['status'], record['input_bytes'], record['output_bytes']), ('ran', 1000, 1000))
+        self.assertGreaterEqual(record['wall_s'], 0)
+        # storage writes, 0 when the folder is on a memory filesystem or the pages were not flushed yet
+        if record['written_bytes'] is not None:
+            self.assertGreaterEqual(record['written_bytes'], 0)
+        with self.assertRaises(RuntimeError):
+            with StepTimer(self.tmp_dir, 'copy', 'day_2', 'day', run_id='run'):
+                raise RuntimeError('corrupt recording')
+        self.assertEqual([r['status'] for r in read_records(self.tmp_dir)], ['ran', 'failed'])
+
+    @unittest.skipUnless(runreport.reset_peak_rss(), 'the peak memory of a block can only be measured on Linux')
+    def test_inner_timer_keeps_the_outer_peak(self):
+        size = 100 * 1024 * 1024
+        with StepTimer(self.tmp_dir, 'motion_correct', run_id='run') as outer:
+            block = np.ones(size // 8)
+            del block
+            with StepTimer(self.tmp_dir, 'motion_correct', 'day_1', 'day', run_id='run') as inner:
+                pass
+        self.assertEqual(runreport.open_timers, [])
+        self.assertGreaterEqual(outer.record['peak_rss_bytes'], inner.record['peak_rss_bytes'] + size * 0.9)
+
+    def test_report_sums_days_without_a_step_record(self):
+        for run_id, wall in (('first', 1.0), ('second', 2.0)):
+            for label in ('day_1', 'day_2'):
+                runreport.append_record(self.tmp_dir, dict({field: 0 for field in runreport.RECORD_FIELDS}, run_id=run_id,
+                                        step='motion_correct', label=label, level='day', status='ran', wall_s=wall,
+                                        peak_rss_bytes=10 if label == 'day_1' else 20))
+        report = write_run_report(self.tmp_dir)
+        self.assertEqual(report['second']['motion_correct']['wall_s'], 4.0)
+        self.assertEqual(report['first']['motion_correct']['peak_rss_bytes'], 20)
+        self.assertEqual(sorted(report['first']['motion_correct']['days']), ['day_1', 'day_2'])
+        with open(os.path.join(self.tmp_dir, runreport.REPORT_JSON_NAME)) as f:
+            self.assertEqual(json.load(f), report)
+        with open(os.path.join(self.tmp_dir, runreport.REPORT_CSV_NAME), newline='') as f:
+            self.assertEqual(len(list(csv.DictReader(f))), 4)
+
+    def test_process_steps_are_measured(self):
+        for name in ('2023-10-02-15-15-02_video_green.isxd', '2023-10-03-15-15-02_video_green.isxd'):
+            open(os.path.join(self.tmp_dir, name), 'w').close()
+        process = CountingProcess(self.tmp_dir, 'processed', 'mouse')
+        process.count()
+        process.count()
+        records = read_records(process.output_dir)
+        self.assertEqual([(r['level'], r['status']) for r in records],
+                         [('day', 'ran'), ('day', 'ran'), ('step', 'ok'), ('day', 'cached'), ('day', 'cached'), ('step', 'ok')])
+        self.assertEqual(records[2]['output_bytes'], sum(len(day_label) for day_label in process.day_labels))
+        with open(os.path.join(process.output_dir, runreport.REPORT_JSON_NAME)) as f:
+            report = json.load(f)
+        self.assertEqual(list(report), [process.run_id])
+        self.assertEqual(sorted(report[process.run_id]['count']['days']), process.day_labels)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,242 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase, mock
+import numpy as np
+import pandas as pd
+from src.backend import spiketable
+from src.backend.spiketable import SpikeTable, wide_to_long, vertical_alignment, global_cell_maps, LONG_COLUMNS, \
+    write_spikes, load_spike_table, load_spikes, rename_cells_file, resolve_formats, spike_path
+from benchmarks.synthetic import synthetic_spike_table
+from benchmarks.spike_table_benchmark import loop_wide_to_long
+
+class TestWideToLong(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.table = synthetic_spike_table(60, 12, event_rate=0.2, seed=3)
+        # zero timestamps and the first two rows are not converted, negative and missing values are not events
+        self.table.loc[[5, 17], 'Time (s)'] = 0
+        self.table.iloc[0:2, 1:] = 1.0
+        self.table.iloc[9, 3] = -1.0
+        self.table.iloc[11, 4] = np.nan
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_same_table_as_row_by_row(self):
+        expected = loop_wide_to_long(self.table)
+        converted = wide_to_long(self.table)
+        self.assertEqual(list(converted.columns), LONG_COLUMNS)
+        self.assertEqual(converted.to_csv(index=False), expected.to_csv(index=False))
+        self.assertFalse((converted['Time (s)'] == 0).any())
+
+    def test_same_csv_as_row_by_row(self):
+        input_csv = os.path.join(self.tmp_dir, 'spikes.csv')
+        output_csv = os.path.join(self.tmp_dir, 'aligned.csv')
+        self.table.to_csv(input_csv, index=False)
+        vertical_alignment(input_csv, output_csv)
+        expected_csv = os.path.join(self.tmp_dir, 'expected.csv')
+        loop_wide_to_long(pd.read_csv(input_csv)).to_csv(expected_csv, index=False)
+        with open(output_csv) as converted, open(expected_csv) as expected:
+            self.assertEqual(converted.read(), expected.read())
+
+    def test_values_keep_full_precision(self):
+        rng = np.random.default_rng(5)
+        self.table.iloc[:, 1:] = np.where(self.table.iloc[:, 1:] > 0, rng.gamma(2.0, 0.5, size=(60, 12)), 0.0)
+        input_csv = os.path.join(self.tmp_dir, 'spikes.csv')
+        self.table.to_csv(input_csv, index=False)
+        expected = loop_wide_to_long(pd.read_csv(input_csv)).to_csv(index=False)
+        for chunk_rows in (0, 7):
+            output_csv = os.path.join(self.tmp_dir, f'aligned-{chunk_rows}.csv')
+            vertical_alignment(input_csv, output_csv, chunk_rows=chunk_rows)
+            with open(output_csv) as f:
+                self.assertEqual(f.read(), expected)
+
+    def test_no_events(self):
+        converted = wide_to_long(synthetic_spike_table(5, 3, event_rate=0))
+        self.assertEqual(len(converted), 0)
+        self.assertEqual(list(converted.columns), LONG_COLUMNS)
+
+    def test_streaming_gives_the_same_csv(self):
+        input_csv = os.path.join(self.tmp_dir, 'spikes.csv')
+        self.table.to_csv(input_csv, index=False)
+        expected_csv = os.path.join(self.tmp_dir, 'expected.csv')
+        vertical_alignment(input_csv, expected_csv)
+        with open(expected_csv) as f:
+            expected = f.read()
+        # chunks smaller than the skipped rows, and chunks holding several events of a cell
+        for chunk_rows in (1, 7):
+            output_csv = os.path.join(self.tmp_dir, f'streamed-{chunk_rows}.csv')
+            vertical_alignment(input_csv, output_csv, chunk_rows=chunk_rows)
+            with open(output_csv) as f:
+                self.assertEqual(f.read(), expected)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['expected.csv', 'spikes.csv', 'streamed-1.csv', 'streamed-7.csv'])
+
+    def test_streaming_merges_in_passes(self):
+        # rows sharing their timestamp keep their order across the runs
+        self.table.loc[30:34, 'Time (s)'] = self.table.loc[30, 'Time (s)']
+        input_csv = os.path.join(self.tmp_dir, 'spikes.csv')
+        self.table.to_csv(input_csv, index=False)
+        expected_csv = os.path.join(self.tmp_dir, 'expected.csv')
+        vertical_alignment(input_csv, expected_csv)
+        with open(expected_csv) as f:
+            expected = f.read()
+        # 60 runs merged two at a time, read a few events at a time
+        with mock.patch.object(spiketable, 'MERGE_FAN_IN', 2), mock.patch.object(spiketable, 'MERGE_BLOCK_EVENTS', 3):
+            output_csv = os.path.join(self.tmp_dir, 'streamed.csv')
+            vertical_alignment(input_csv, output_csv, chunk_rows=1, formats=['csv', 'npz'])
+        with open(output_csv) as f:
+            self.assertEqual(f.read(), expected)
+        self.assertEqual(load_spike_table(spike_path(output_csv, 'npz')).to_frame().to_csv(index=False), expected)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['expected.csv', 'spikes.csv', 'streamed.csv', 'streamed.npz'])
+
+# LR index table of two days with two and one sessions, global index = local index + offset on day 1 and
+# local index + offset + 1 on day 2
+def lr_table(num_cells, offset):
+    rows = []
+    for local in range(num_cells):
+        rows += [(local + offset, local, 0), (local + offset, local, 1), (local + offset + 1, local, 2)]
+    return pd.DataFrame(rows, columns=['global_cell_index', 'local_cell_index', 'local_cellset_index'])
+
+# renaming done before global_cell_maps: one replace over the whole day per LR row, walking the rows by day stride
+def loop_rename(lr_df, day_dfs, num_sessions, day_indices):
+    idx = 0
+    for _ in range(len(lr_df)):
+        if idx > len(lr_df) - num_sessions[-1]:
+            break
+        j = day_indices.index(int(lr_df.loc[idx]['local_cellset_index']))
+        old = ' C' + str(int(lr_df.loc[idx]['local_cell_index'])).zfill(3)
+        new = ' C' + str(int(lr_df.loc[idx]['global_cell_index'])).zfill(3)
+        day_dfs[j][' Cell Name'] = day_dfs[j][' Cell Name'].replace(old, new)
+        idx += num_sessions[j]
+    return [df.sort_values(by=[' Cell Name', 'Time (s)']) for df in day_dfs]
+
+class TestRenameCells(TestCase):
+
+    def setUp(self):
+        self.days = [wide_to_long(synthetic_spike_table(200, 12, event_rate=0.1, seed=seed)) for seed in (4, 5)]
+
+    def rename(self, day, mapping):
+        return SpikeTable.from_frame(day).renamed(mapping).to_frame()
+
+    def test_same_tables_as_replace_loop(self):
+        lr_df = lr_table(12, offset=1000)
+        expected = loop_rename(lr_df, [day.astype({' Cell Name': object}) for day in self.days], [2, 1], [0, 2])
+        maps = global_cell_maps(lr_df, [0, 2])
+        self.assertEqual(maps[1][' C003'], ' C1004')
+        for day, mapping, expected_day in zip(self.days, maps, expected):
+            self.assertEqual(self.rename(day, mapping).to_csv(index=False), expected_day.to_csv(index=False))
+
+    def test_renamed_cells_are_not_renamed_again(self):
+        # C001 becomes C002 while C002 becomes C003, a replace chain would merge the two cells into C003
+        renamed = self.rename(self.days[0], global_cell_maps(lr_table(12, offset=1), [0, 2])[0])
+        self.assertEqual(renamed[' Cell Name'].nunique(), self.days[0][' Cell Name'].nunique())
+        before = self.days[0].groupby(' Cell Name', observed=True).size()
+        after = renamed.groupby(' Cell Name', observed=True).size()
+        self.assertEqual(after[' C002'], before[' C001'])
+
+    def test_cells_missing_from_the_table_keep_their_name(self):
+        renamed = self.rename(self.days[0], {' C000': ' C050'})
+        self.assertEqual(sorted(renamed[' Cell Name'].unique())[:2], [' C001', ' C002'])
+        self.assertIn(' C050', set(renamed[' Cell Name']))
+
+class TestSpikeTable(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.spikes = SpikeTable.from_wide(synthetic_spike_table(2000, 50, event_rate=0.05, seed=6)).sorted()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_compact_columns(self):
+        self.assertEqual((self.spikes.cell_ids.dtype, self.spikes.times.dtype, self.spikes.values.dtype),
+                         (np.dtype(np.uint32), np.dtype(np.float64), np.dtype(np.float64)))
+        self.assertEqual(list(self.spikes.names), sorted(self.spikes.names))
+        frame = self.spikes.to_frame().astype({' Cell Name': object})
+        self.assertLess(self.spikes.nbytes * 3, frame.memory_usage(deep=True).sum())
+
+    def test_csv_round_trip(self):
+        path = os.path.join(self.tmp_dir, 'spikes.csv')
+        self.spikes.to_csv(path)
+        read = SpikeTable.read_csv(path)
+        np.testing.assert_array_equal(read.names, self.spikes.names)
+        np.testing.assert_array_equal(read.cell_ids, self.spikes.cell_ids)
+        np.testing.assert_array_equal(read.values, self.spikes.values)
+
+    def test_cells_renamed_to_the_same_name_are_merged(self):
+        renamed = self.spikes.renamed({' C000': ' C100', ' C001': ' C100'})
+        self.assertEqual(len(renamed.names), len(self.spikes.names) - 1)
+        merged = renamed.times[renamed.names[renamed.cell_ids] == ' C100']
+        self.assertEqual(len(merged), np.isin(self.spikes.names[self.spikes.cell_ids], [' C000', ' C001']).sum())
+        self.assertTrue((np.diff(merged) >= 0).all())
+
+class TestSpikeFormats(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.wide_csv = os.path.join(self.tmp_dir, 'spike-events.csv')
+        synthetic_spike_table(300, 20, event_rate=0.1, seed=7).to_csv(self.wide_csv, index=False)
+        self.name = os.path.join(self.tmp_dir, 'day_1_timeseries_spikes_unix.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assert_same_table(self, table, expected):
+        np.testing.assert_array_equal(table.names, expected.names)
+        for name in ('cell_ids', 'times', 'values'):
+            np.testing.assert_array_equal(getattr(table, name), getattr(expected, name))
+
+    def test_npz_next_to_the_csv(self):
+        vertical_alignment(self.wide_csv, self.name, formats=['csv', 'npz'])
+        self.assertTrue(os.path.exists(spike_path(self.name, 'npz')))
+        csv_table = load_spike_table(self.name)  # the npz, written after the CSV
+        self.assert_same_table(csv_table, SpikeTable.read_csv(self.name))
+        self.assertEqual(load_spikes(spike_path(self.name, 'npz')).to_csv(index=False),
+                         pd.read_csv(self.name).to_csv(index=False))
+        # a CSV edited after the npz was written is read instead of it
+        os.utime(spike_path(self.name, 'npz'), (0, 0))
+        with mock.patch.object(spiketable, 'read_npz', side_effect=AssertionError('stale npz read')):
+            load_spike_table(self.name)
+
+    def test_columnar_only(self):
+        vertical_alignment(self.wide_csv, self.name, formats=['npz'])
+        self.assertFalse(os.path.exists(self.name))
+        expected = SpikeTable.from_wide(pd.read_csv(self.wide_csv)).sorted()
+        self.assert_same_table(load_spike_table(self.name), expected)
+        # streamed, and renamed from the npz
+        streamed = os.path.join(self.tmp_dir, 'streamed.csv')
+        vertical_alignment(self.wide_csv, streamed, chunk_rows=40, formats=['npz', 'csv'])
+        self.assert_same_table(load_spike_table(spike_path(streamed, 'npz')), expected)
+        self.assert_same_table(SpikeTable.read_csv(streamed), expected)
+        renamed = os.path.join(self.tmp_dir, 'day_1_longitudinal_spikes_unix.csv')
+        rename_cells_file(self.name, renamed, {' C000': ' C100'}, formats=['npz'])
+        self.assertIn(' C100', load_spike_table(renamed).names)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['day_1_longitudinal_spikes_unix.npz',
+                         'day_1_timeseries_spikes_unix.npz', 'spike-events.csv', 'streamed.csv', 'streamed.npz'])
+
+    def test_formats(self):
+        self.assertEqual(resolve_formats(['csv', 'csv', 'npz']), ('csv', 'npz'))
+        self.assertEqual(resolve_formats(['columnar']), ('parquet',) if spiketable.pyarrow else ('npz',))
+        with self.assertRaises(ValueError):
+            resolve_formats(['xlsx'])
+        with mock.patch.object(spiketable, 'pyarrow', None):
+            self.assertEqual(resolve_formats(['csv', 'parquet']), ('csv', 'npz'))
+
+    @unittest.skipUnless(spiketable.pyarrow, 'pyarrow is not installed')
+    def test_arrow_formats(self):
+        expected = SpikeTable.from_wide(pd.read_csv(self.wide_csv)).sorted()
+        write_spikes(expected, self.name, ['parquet', 'feather'])
+        for spike_format in ('parquet', 'feather'):
+            self.assert_same_table(load_spike_table(spike_path(self.name, spike_format)), expected)
+        # streamed in row groups / record batches of a few events
+        streamed = os.path.join(self.tmp_dir, 'streamed.csv')
+        with mock.patch.object(spiketable, 'MERGE_BLOCK_EVENTS', 16):
+            vertical_alignment(self.wide_csv, streamed, chunk_rows=40, formats=['parquet', 'feather'])
+        for spike_format in ('parquet', 'feather'):
+            self.assert_same_table(load_spike_table(spike_path(streamed, spike_format)), expected)
+
+if __name__ == '__main__':
+    unittest.main()
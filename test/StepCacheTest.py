@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase
+from src.backend.stepcache import StepCache
+
+class TestStepCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = StepCache(os.path.join(self.tmp_dir, 'step_cache'))
+        self.input = self.path('rec-PP.isxd')
+        self.output = self.path('rec-PP-BP.isxd')
+        self.write(self.input, 'raw')
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    # step writing its parameter and input to the output, like a filter would
+    def run_step(self, cutoff, outputs=None, call=None):
+        def step(staged):
+            self.calls.append(cutoff)
+            self.write(staged(self.output), f'{self.read(self.input)} filtered at {cutoff}')
+        return self.cache.run('bandpass_filter', 'day_1', [self.input], outputs or [self.output], {'cutoff': cutoff},
+                              call or step)
+
+    def test_same_inputs_and_params_are_skipped(self):
+        self.assertEqual(self.run_step(0.5), 'ran')
+        self.assertEqual(self.run_step(0.5), 'cached')
+        self.assertEqual(self.calls, [0.5])
+
+    def test_changed_params_run_again_and_earlier_outputs_are_restored(self):
+        self.run_step(0.5)
+        self.assertEqual(self.run_step(0.3), 'ran')
+        self.assertEqual(self.read(self.output), 'raw filtered at 0.3')
+        self.assertEqual(self.run_step(0.5), 'restored')
+        self.assertEqual(self.read(self.output), 'raw filtered at 0.5')
+        self.assertEqual(self.run_step(0.5), 'cached')
+        self.assertEqual(self.calls, [0.5, 0.3])
+
+    def test_changed_input_runs_again(self):
+        self.run_step(0.5)
+        self.write(self.input, 'raw, recorded again')
+        os.utime(self.input, ns=(0, os.stat(self.input).st_mtime_ns + 10**9))
+        self.assertEqual(self.run_step(0.5), 'ran')
+        self.assertEqual(self.read(self.output), 'raw, recorded again filtered at 0.5')
+
+    def test_deleted_or_edited_output_runs_again(self):
+        self.run_step(0.5)
+        os.remove(self.output)
+        shutil.rmtree(os.path.join(self.cache.step_dir('bandpass_filter')))
+        self.assertEqual(self.run_step(0.5), 'ran')
+        self.write(self.output, 'edited by hand, longer than before')
+        self.assertEqual(self.run_step(0.5), 'ran')
+        self.assertEqual(self.read(self.output), 'raw filtered at 0.5')
+
+    def test_crashed_step_leaves_the_outputs_untouched(self):
+        def crash(staged):
+            self.write(staged(self.output), 'partial')
+            raise RuntimeError('killed')
+        with self.assertRaises(RuntimeError):
+            self.run_step(0.5, call=crash)
+        self.assertFalse(os.path.exists(self.output))
+        self.assertEqual(self.run_step(0.5), 'ran')
+        with self.assertRaises(RuntimeError):
+            self.run_step(0.3, call=crash)
+        self.assertEqual(self.read(self.output), 'raw filtered at 0.5')
+        with self.assertRaises(FileNotFoundError):
+            self.run_step(0.7, outputs=[self.output, self.path('missing.csv')])
+        self.assertEqual(self.read(self.output), 'raw filtered at 0.5')
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir, 'staging')), [])
+
+    def test_input_modified_in_place_keeps_downstream_cached(self):
+        self.run_step(0.5)
+        events = self.path('rec-ED.isxd')
+
+        # event detection writes events and updates the cell set (here the bandpass output) in place
+        def classify(staged):
+            self.write(staged(events), 'events')
+            self.write(staged(self.output), self.read(staged(self.output)) + ', classified')
+        run = lambda: self.cache.run('event_detection', 'day_1', [self.output], [events], {}, classify,
+                                     modified=[self.output])
+        self.assertEqual(run(), 'ran')
+        self.assertEqual(run(), 'cached')
+        self.assertEqual(self.run_step(0.5), 'cached')
+        self.assertEqual(self.read(self.output), 'raw filtered at 0.5, classified')
+
+    def test_released_output_stays_cached(self):
+        self.run_step(0.5)
+        self.cache.release(self.output)
+        self.assertFalse(os.path.exists(self.output))
+        # the archived hard link went too
+        archived = [name for _, _, names in os.walk(self.cache.step_dir('bandpass_filter')) for name in names]
+        self.assertNotIn(os.path.basename(self.output), archived)
+        self.assertEqual(self.run_step(0.5), 'cached')
+        # a step reading it can only run again from a kept copy
+        with self.assertRaises(FileNotFoundError):
+            self.cache.run('event_detection', 'day_1', [self.output], [self.path('events.isxd')], {},
+                           lambda staged: None)
+
+    def test_kept_copy_is_brought_back(self):
+        self.run_step(0.5)
+        kept = self.path('kept-rec-PP-BP.isxd')
+        self.cache.release(self.output, keep_path=kept)
+        self.assertEqual(self.read(kept), 'raw filtered at 0.5')
+        events = self.path('events.isxd')
+        run = lambda threshold: self.cache.run('event_detection', 'day_1', [self.output], [events],
+                                               {'threshold': threshold},
+                                               lambda staged: self.write(staged(events), self.read(self.output)))
+        self.assertEqual(run(3), 'ran')
+        self.assertEqual(self.read(events), 'raw filtered at 0.5')
+        self.assertEqual(run(3), 'cached')
+        self.assertEqual(self.run_step(0.5), 'cached')
+
+if __name__ == '__main__':
+    unittest.main()
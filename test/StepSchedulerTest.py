@@ -0,0 +1,182 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase
+from src.workutils.StepScheduler import StepScheduler, run_schedulers, configured_step_workers, \
+    DEFAULT_STEP_WORKERS, STEP_WORKERS_VARIABLE
+
+# two days pipeline: 'extract' and 'filter' run per day, 'merge' reads every day, 'report' is not declared
+class FakeProcess(object):
+    step_io = {
+        'extract': {'inputs': ['raw_files'], 'outputs': ['extract_files']},
+        'filter': {'inputs': ['extract_files'], 'outputs': ['filter_files']},
+        'merge': {'inputs': ['filter_files'], 'outputs': ['merge_file']},
+    }
+
+    def __init__(self, directory, failing_day=None):
+        self.directory = directory
+        self.failing_day = failing_day
+        self.day_labels = ['day_1', 'day_2']
+        self.raw_files = [[os.path.join(directory, f'{day}-raw.txt')] for day in self.day_labels]
+        self.extract_files = [[os.path.join(directory, f'{day}-extract.txt')] for day in self.day_labels]
+        self.filter_files = [os.path.join(directory, f'{day}-filter.txt') for day in self.day_labels]
+        self.merge_file = os.path.join(directory, 'merge.txt')
+        for files in self.raw_files:
+            open(files[0], 'w').close()
+
+    def write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def extract_day(self, day_i, day_label, suffix):
+        if day_label == self.failing_day:
+            raise RuntimeError('corrupt recording')
+        self.write(self.extract_files[day_i][0], day_label + suffix)
+
+    def filter_day(self, day_i, day_label):
+        with open(self.extract_files[day_i][0]) as f:
+            self.write(self.filter_files[day_i], f.read())
+
+    def merge(self):
+        texts = []
+        for path in self.filter_files:
+            with open(path) as f:
+                texts.append(f.read())
+        self.write(self.merge_file, ','.join(texts))
+
+    def report(self):
+        self.write(os.path.join(self.directory, 'report.txt'), str(os.path.exists(self.merge_file)))
+
+# FakeProcess that records the files handed back for deletion by the retention policy
+class RetainingProcess(FakeProcess):
+    def __init__(self, directory, failing_day=None):
+        super().__init__(directory, failing_day)
+        self.released = []
+
+    def release_intermediates(self, paths):
+        self.released.append([os.path.basename(path) for path in paths])
+
+# merge that reports a failed day instead of raising, like the steps running their days with Process.run_days
+class ReportingProcess(RetainingProcess):
+    def merge(self):
+        return {'day_2': RuntimeError('unreadable filter file')}
+
+# merge that returns without writing its output
+class SilentProcess(RetainingProcess):
+    def merge(self):
+        return None
+
+# second stage reading the merged file of a FakeProcess, like the LR steps reading the timeseries outputs
+class CollectProcess(object):
+    step_io = {'collect': {'inputs': ['merge_file'], 'outputs': ['collect_file']}}
+
+    def __init__(self, upstream):
+        self.day_labels = []
+        self.merge_file = upstream.merge_file
+        self.collect_file = os.path.join(upstream.directory, 'collect.txt')
+
+    def collect(self):
+        with open(self.merge_file) as f:
+            text = f.read()
+        with open(self.collect_file, 'w') as f:
+            f.write(text.upper())
+
+class TestStepScheduler(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.finished = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_steps(self, process, max_workers=1):
+        scheduler = StepScheduler(process, max_workers=max_workers,
+                                  on_step_finished=lambda name, errors: self.finished.append((name, len(errors))))
+        scheduler.add_step('extract', '!')
+        scheduler.add_step('filter')
+        scheduler.add_step('merge')
+        scheduler.add_step('report')
+        return scheduler, scheduler.run()
+
+    def read(self, name):
+        with open(os.path.join(self.tmp_dir, name)) as f:
+            return f.read()
+
+    def test_graph(self):
+        scheduler, _ = self.run_steps(FakeProcess(self.tmp_dir))
+        extract, filter_step, merge, report = scheduler.steps
+        self.assertEqual([str(node) for node in filter_step.nodes], ['filter[day_1]', 'filter[day_2]'])
+        # each day only waits for its own inputs, merge waits for every day, report for the step queued before it
+        self.assertEqual(filter_step.nodes[1].dependencies, {extract.nodes[1]})
+        self.assertEqual(merge.nodes[0].dependencies, set(filter_step.nodes))
+        self.assertEqual(report.nodes[0].dependencies, set(merge.nodes))
+
+    def test_runs_every_step(self):
+        _, errors = self.run_steps(FakeProcess(self.tmp_dir))
+        self.assertEqual(errors, {})
+        self.assertEqual(self.read('merge.txt'), 'day_1!,day_2!')
+        self.assertEqual(self.read('report.txt'), 'True')
+        self.assertEqual([name for name, _ in self.finished], ['extract', 'filter', 'merge', 'report'])
+
+    def test_failing_day_only_skips_its_dependents(self):
+        _, errors = self.run_steps(FakeProcess(self.tmp_dir, failing_day='day_2'))
+        self.assertEqual(sorted(errors), ['extract[day_2]', 'filter[day_2]', 'merge', 'report'])
+        self.assertIsInstance(errors['extract[day_2]'], RuntimeError)
+        self.assertEqual(self.read('day_1-filter.txt'), 'day_1!')
+        self.assertEqual(dict(self.finished), {'extract': 1, 'filter': 1, 'merge': 1, 'report': 1})
+
+    def test_missing_input_fails_the_day(self):
+        process = FakeProcess(self.tmp_dir)
+        os.remove(process.raw_files[0][0])
+        _, errors = self.run_steps(process)
+        self.assertIsInstance(errors['extract[day_1]'], FileNotFoundError)
+        self.assertEqual(self.read('day_2-filter.txt'), 'day_2!')
+
+    def test_inputs_are_released_once_every_reader_succeeded(self):
+        process = RetainingProcess(self.tmp_dir, failing_day='day_2')
+        self.run_steps(process)
+        # filter files are read by merge, which did not run because day_2 failed
+        self.assertEqual(process.released, [['day_1-raw.txt'], ['day_1-extract.txt']])
+
+    def test_returned_errors_fail_the_node(self):
+        process = ReportingProcess(self.tmp_dir)
+        scheduler, errors = self.run_steps(process)
+        self.assertEqual(sorted(errors), ['merge', 'report'])
+        self.assertIn('unreadable filter file', str(errors['merge']))
+        # the filter files merge did not read stay for the next run
+        self.assertEqual(sorted(path for paths in process.released for path in paths),
+                         ['day_1-extract.txt', 'day_1-raw.txt', 'day_2-extract.txt', 'day_2-raw.txt'])
+
+    def test_inputs_are_kept_while_outputs_are_missing(self):
+        process = SilentProcess(self.tmp_dir)
+        self.run_steps(process)
+        self.assertNotIn(['day_1-filter.txt', 'day_2-filter.txt'], process.released)
+
+    def test_configured_workers(self):
+        self.assertEqual(configured_step_workers({}), DEFAULT_STEP_WORKERS)
+        self.assertEqual(configured_step_workers({STEP_WORKERS_VARIABLE: '6'}), 6)
+        for invalid in ('0', 'all'):
+            self.assertEqual(configured_step_workers({STEP_WORKERS_VARIABLE: invalid}), DEFAULT_STEP_WORKERS)
+
+    def test_parallel_workers(self):
+        _, errors = self.run_steps(FakeProcess(self.tmp_dir), max_workers=2)
+        self.assertEqual(errors, {})
+        self.assertEqual(self.read('merge.txt'), 'day_1!,day_2!')
+
+    def test_schedulers_share_one_graph(self):
+        first = FakeProcess(self.tmp_dir)
+        upstream = StepScheduler(first)
+        upstream.add_step('extract', '?')
+        upstream.add_step('filter')
+        upstream.add_step('merge')
+        downstream = StepScheduler(CollectProcess(first))
+        downstream.add_step('collect')
+        errors = run_schedulers([upstream, downstream], max_workers=2)
+        self.assertEqual(errors, [{}, {}])
+        self.assertEqual(downstream.steps[0].nodes[0].dependencies, set(upstream.steps[2].nodes))
+        self.assertEqual(self.read('collect.txt'), 'DAY_1?,DAY_2?')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase
+import numpy as np
+from src.backend import RemoveCorruptFrames as rcf
+from src.backend.isxd import IsxdMovie
+from benchmarks.synthetic import SyntheticMovie, write_synthetic_movie, random_segments
+
+class TestSyntheticMovie(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_random_segments_do_not_touch(self):
+        segments = random_segments(500, 12, min_length=1, max_length=30, seed=3)
+        self.assertEqual(len(segments), 12)
+        for (_, last, _), (first, _, _) in zip(segments, segments[1:]):
+            self.assertGreater(first, last + 1)
+        self.assertEqual(SyntheticMovie(500, 8, 8, segments).ground_truth(), [[first, last] for first, last, _ in segments])
+
+    def test_segments_outside_the_movie_are_rejected(self):
+        with self.assertRaises(ValueError):
+            SyntheticMovie(10, 8, 8, [(5, 10, 'black')])
+        with self.assertRaises(ValueError):
+            random_segments(20, 5, min_length=5, max_length=5)
+
+    def test_detector_finds_injected_segments(self):
+        file_path = os.path.join(self.tmp_dir, 'synthetic.isxd')
+        movie = write_synthetic_movie(file_path, 150, 200, 320, segments=random_segments(150, 4, max_length=10))
+        with IsxdMovie(file_path) as written:
+            self.assertEqual(written.timing.num_samples, 150)
+            self.assertFalse(written.get_frame_data(movie.segments[0][0])[movie.band[0][0]:, movie.band[1][0]].any())
+        report = rcf.detect_corrupt_frames(file_path, use_sidecar=False, roi=rcf.scaled_roi((200, 320)))
+        self.assertEqual(report['segments'], movie.ground_truth())
+
+if __name__ == '__main__':
+    unittest.main()
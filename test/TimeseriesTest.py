@@ -50,9 +50,9 @@ class TestTimeseries(TestCase):
                                                              day_i = 0))
         
     def test_one_file_unprocessed(self):
-        # test object with one -BP.isxd recording deleted for a singla day
-        test_object_4.check_all_recordings_processed(test_object_4.bp_files_series, 0)
-        assert os.path.exists(r"F:\LR_miso_20230807_20230810_20230815\processed-diameter-adjust\2023-08-07-14-48-43_video_green_processed-PP-BP.isxd") == False
+        # test object with one -BP.isxd recording deleted for a singla day, the other files of the day are kept
+        self.assertFalse(test_object_4.check_all_recordings_processed(test_object_4.bp_files_series, 0))
+        assert os.path.exists(r"F:\LR_miso_20230807_20230810_20230815\processed-diameter-adjust\2023-08-07-13-44-53_video_green_processed-PP-BP.isxd")
 
         self.assertTrue(test_object_4.check_all_recordings_processed(test_object_4.bp_files_series, 1))
         self.assertTrue(test_object_4.check_all_recordings_processed(test_object_4.bp_files_series, 2))